@@ -0,0 +1,285 @@
+"""Load and soak test for a running server, e.g. the one docker-compose starts for system_test.py.
+
+    python load_test.py [--url http://127.0.0.1:5000] [--kiosks 8] [--duration 60] [--interval 5] [--items 200]
+                        [--hot-items 5] [--hot 0.5] [--members 20] [--pid PID] [--max-growth-mb MB]
+
+Each kiosk is a thread. A member walks up and signs in, and sometimes browses or checks their holds. Half the time
+they bring back what they have out, and staff look those items up and return them. Then the kiosk scans the one to
+three items they want. The member loans each one that is available and places a hold on each one that someone else
+has. A share of the scans (--hot) go to a few hot items, so the kiosks compete for them. The server is switched to
+self-service mode for the run and back afterwards, so members loan items with their own token. An item taken between
+the scan and the loan is then refused (a conflict), where a staff token would silently reassign it.
+
+Every interval it prints requests per second, latency percentiles, and the rates of errors (5xx or no response),
+conflicts (the item had been taken, or was already held) and throttled (429, or 503 when shed) requests. At the end it
+prints the same for each operation, and how many scanned items were already out. With --pid (Linux only) it also prints the resident memory of the server process
+and its workers, and how much it grew after the first interval. --max-growth-mb turns that into a pass/fail check for
+soak runs.
+
+Every kiosk signs in from this host, so raise the server's RATE_LIMIT_IP and RATE_LIMIT_USERNAME first.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+
+import requests
+
+from system_test import admin, admin_creds, url_root
+
+TIMEOUT_SECONDS = 30
+SAMPLE_SIZE = 10000  # Latencies kept per operation for its percentiles
+PASSWORD = "password"
+
+
+class Counts:
+    """Outcomes and a random sample of latencies for a set of requests."""
+    def __init__(self):
+        self.requests = 0
+        self.outcomes = defaultdict(int)  # ok, error, conflict or throttled
+        self.latencies = []
+
+    def add(self, seconds, outcome):
+        self.requests += 1
+        self.outcomes[outcome] += 1
+        if len(self.latencies) < SAMPLE_SIZE:
+            self.latencies.append(seconds)
+        else:
+            index = random.randrange(self.requests)
+            if index < SAMPLE_SIZE:
+                self.latencies[index] = seconds
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.interval = Counts()
+        self.operations = defaultdict(Counts)
+        self.taken = 0  # Scanned items that were already out, which send no loan request
+
+    def count_taken(self):
+        with self._lock:
+            self.taken += 1
+
+    def record(self, operation, seconds, outcome):
+        with self._lock:
+            self.interval.add(seconds, outcome)
+            self.operations[operation].add(seconds, outcome)
+
+    def take_interval(self):
+        with self._lock:
+            interval, self.interval = self.interval, Counts()
+        return interval
+
+
+class Kiosk:
+    def __init__(self, url, stats, members, tokens, args):
+        self.url = url
+        self.stats = stats
+        self.members = members
+        self.tokens = tokens  # username -> token, shared by the kiosks
+        self.args = args
+        self.http = requests.Session()
+        self.staff_token = None
+
+    def run(self, stop):
+        while not stop.is_set():
+            if not self.staff_token:
+                self.staff_token = self.login(admin, admin_creds["password"])
+                if not self.staff_token:
+                    sleep(1)
+                    continue
+            self.visit()
+
+    def visit(self):
+        member = random.choice(self.members)
+        if member not in self.tokens or random.random() < self.args.logins:
+            self.tokens[member] = self.login(member, PASSWORD) or self.tokens.get(member)
+        member_token = self.tokens.get(member)
+        if member_token and random.random() < 0.3:
+            self.call("browse", "GET", "/loan-items?available=true&limit=20", member_token)
+        if member_token and random.random() < 0.1:
+            self.call("holds", "GET", "/holds", member_token)
+
+        if random.random() < 0.5:
+            _, body = self.call("loans", "GET", f"/loan-items?loanedto={member}", self.staff_token)
+            for item in body.get("loan-items", []):
+                self.call("return", "PUT", f"/loan-items/{item['id']}", self.staff_token, {"loanedto": None})
+
+        ids = ",".join({self.pick_item() for _ in range(random.randint(1, 3))})
+        _, body = self.call("scan", "GET", f"/loan-items?ids={ids}", self.staff_token)
+        if not member_token:
+            return
+        for item in body.get("loan-items", []):
+            if item["loanedto"] is None:
+                self.call("loan", "PUT", f"/loan-items/{item['id']}", member_token, {"loanedto": member},
+                          conflicts=(403,))  # Taken by another kiosk since the scan
+            else:
+                self.stats.count_taken()
+                if item["loanedto"] != member:
+                    self.call("hold", "POST", f"/loan-items/{item['id']}/holds", member_token, conflicts=(400,))
+
+    def pick_item(self):
+        if random.random() < self.args.hot:
+            return f"load-{random.randrange(self.args.hot_items)}"
+        return f"load-{random.randrange(self.args.items)}"
+
+    def login(self, username, password):
+        status, body = self.call("login", "POST", "/login", data={"username": username, "password": password})
+        return body.get("auth_token") if status == 200 else None
+
+    def call(self, operation, method, path, token=None, data=None, conflicts=()):
+        """Send a request and record how it went. Returns the status (None if there was no response) and body."""
+        headers = {"access-token": token} if token else {}
+        start = monotonic()
+        try:
+            response = self.http.request(method, self.url + path, headers=headers, json=data,
+                                         timeout=TIMEOUT_SECONDS)
+            status = response.status_code
+            body = response.json() if response.headers.get("Content-Type") == "application/json" else {}
+        except (requests.RequestException, ValueError):
+            status, body = None, {}
+        seconds = monotonic() - start
+        if status == 401 and token:  # Expired, sign in again next time
+            if token == self.staff_token:
+                self.staff_token = None
+            for username, member_token in list(self.tokens.items()):
+                if member_token == token:
+                    self.tokens.pop(username, None)
+        self.stats.record(operation, seconds, _outcome(status, conflicts))
+        return status, body
+
+
+def _outcome(status, conflicts):
+    if status in (429, 503):
+        return "throttled"
+    if status is None or status >= 500:
+        return "error"
+    if status in conflicts:
+        return "conflict"
+    return "ok" if status < 400 else "error"
+
+
+def setup(url, item_count, member_count):
+    """Create the items and members, leaving any that exist from earlier runs, and switch to self-service mode.
+
+    Returns the members, the admin's token and the mode to restore.
+    """
+    token = _send_retrying(url, "POST", "/login", admin_creds).json()["auth_token"]
+    for i in range(item_count):
+        _send_retrying(url, "POST", "/loan-items", {"id": f"load-{i}", "description": f"Load test item {i}"}, token)
+    members = [f"kiosk{i}" for i in range(member_count)]
+    for member in members:
+        _send_retrying(url, "POST", "/users", {"username": member, "password": PASSWORD, "phone": "+441234567890"})
+    mode = _send_retrying(url, "GET", "/mode", token=token).json()["mode"]
+    _send_retrying(url, "PUT", "/mode", {"mode": "self-service"}, token)
+    return members, token, mode
+
+
+def _send_retrying(url, method, path, data=None, token=None):
+    while True:
+        response = requests.request(method, url + path, json=data, headers={"access-token": token} if token else {},
+                                    timeout=TIMEOUT_SECONDS)
+        if response.status_code not in (429, 503):
+            return response
+        sleep(float(response.headers.get("Retry-After", 1)))
+
+
+def server_rss(pid):
+    """Resident memory of the process and its children in MB, or None if it can't be read."""
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    if int(stat.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    total_kb = 0
+    for each_pid in pids:
+        try:
+            with open(f"/proc/{each_pid}/status") as status:
+                total_kb += next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            if each_pid == pid:
+                return None
+    return total_kb / 1024
+
+
+def print_interval(elapsed, interval, seconds, rss):
+    requests_count = interval.requests or 1
+    print(f"{elapsed:>6.0f}s {interval.requests / seconds:>8.1f} "
+          f"{interval.percentile(50) * 1000:>7.1f} {interval.percentile(95) * 1000:>7.1f} "
+          f"{interval.percentile(99) * 1000:>7.1f} "
+          f"{interval.outcomes['error'] / requests_count:>7.1%} {interval.outcomes['conflict'] / requests_count:>9.1%} "
+          f"{interval.outcomes['throttled'] / requests_count:>9.1%} {'' if rss is None else f'{rss:>8.1f}'}",
+          flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulates concurrent kiosks against a running server.")
+    parser.add_argument("--url", default=url_root)
+    parser.add_argument("--kiosks", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run for")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between reports")
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--hot-items", type=int, default=5)
+    parser.add_argument("--hot", type=float, default=0.5, help="Fraction of scans that go to the hot items")
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--logins", type=float, default=0.05, help="Fraction of visits where the member signs in")
+    parser.add_argument("--pid", type=int, help="Server process to watch the memory of, including its workers")
+    parser.add_argument("--max-growth-mb", type=float, help="Fail if the server's memory grows by more than this")
+    args = parser.parse_args(argv)
+
+    members, admin_token, mode = setup(args.url, args.items, args.members)
+    stats = Stats()
+    tokens = {}
+    stop = threading.Event()
+    kiosks = [threading.Thread(target=Kiosk(args.url, stats, members, tokens, args).run, args=(stop,), daemon=True)
+              for _ in range(args.kiosks)]
+    print(f"{'time':>7} {'req/s':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'errors':>7} {'conflicts':>9} "
+          f"{'throttled':>9} {'rss MB' if args.pid else ''}")
+    start = last = monotonic()
+    for kiosk in kiosks:
+        kiosk.start()
+    first_rss = last_rss = None
+    while last - start < args.duration:
+        sleep(min(args.interval, args.duration - (last - start)))
+        now = monotonic()
+        last_rss = server_rss(args.pid) if args.pid else None
+        if first_rss is None:
+            first_rss = last_rss  # After the first interval, so start-up and warm-up don't count as growth
+        print_interval(now - start, stats.take_interval(), now - last, last_rss)
+        last = now
+    stop.set()
+    for kiosk in kiosks:
+        kiosk.join(TIMEOUT_SECONDS)
+    _send_retrying(args.url, "PUT", "/mode", {"mode": mode}, admin_token)
+
+    print(f"\n{'operation':<10} {'requests':>9} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7} "
+          f"{'errors':>7} {'conflicts':>9} {'throttled':>9}")
+    for operation, counts in sorted(stats.operations.items()):
+        print(f"{operation:<10} {counts.requests:>9} {counts.percentile(50) * 1000:>7.1f} "
+              f"{counts.percentile(95) * 1000:>7.1f} {counts.percentile(99) * 1000:>7.1f} "
+              f"{max(counts.latencies, default=0) * 1000:>7.1f} {counts.outcomes['error']:>7} "
+              f"{counts.outcomes['conflict']:>9} {counts.outcomes['throttled']:>9}")
+    print(f"\nScanned items that were already out: {stats.taken}")
+    if first_rss is not None and last_rss is not None:
+        growth = last_rss - first_rss
+        print(f"\nServer memory grew {growth:.1f} MB ({first_rss:.1f} MB to {last_rss:.1f} MB)")
+        if args.max_growth_mb is not None and growth > args.max_growth_mb:
+            sys.exit(f"Memory grew more than {args.max_growth_mb} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Admission control: limits how many requests each worker process runs at once, and sheds the rest quickly.
+
+A request runs when fewer than ADMISSION_MAX_CONCURRENT (default 16, about the database pool's size; 0 turns admission
+control off) requests are running in the process, and fewer than its route's limit. Routes that hash passwords or read
+long lists have lower limits by default (see ROUTE_LIMITS), and ADMISSION_ROUTE_LIMITS, a JSON object such as
+{"GET /loan-items": 4}, overrides them. Other requests wait in a queue of at most ADMISSION_MAX_QUEUE (default 64).
+
+Each route has a priority. Loans, returns and holds are "high", long listings are "low" and the rest are "normal" (see
+PRIORITIES, overridden by ADMISSION_PRIORITIES). A freed slot goes to the highest priority request that can use it,
+oldest first. A request waits at most its priority's time in QUEUE_SECONDS (overridden by ADMISSION_QUEUE_SECONDS).
+When the queue is full, a request with a higher priority pushes out the newest of the lowest priority waiting. A request
+that gets no slot is answered with a 503 and a Retry-After header, without touching the database. The counts of shed
+requests are in /metrics.
+"""
+import json
+import os
+import threading
+from itertools import count
+from time import monotonic
+
+from flask import g, request
+
+import metrics
+from formats import respond
+
+HIGH, NORMAL, LOW = "high", "normal", "low"
+_RANKS = {HIGH: 0, NORMAL: 1, LOW: 2}
+
+MAX_CONCURRENT = int(os.environ["ADMISSION_MAX_CONCURRENT"]) if "ADMISSION_MAX_CONCURRENT" in os.environ else 16
+MAX_QUEUE = int(os.environ["ADMISSION_MAX_QUEUE"]) if "ADMISSION_MAX_QUEUE" in os.environ else 64
+RETRY_AFTER_SECONDS = int(os.environ["ADMISSION_RETRY_AFTER"]) if "ADMISSION_RETRY_AFTER" in os.environ else 1
+ROUTE_LIMITS = {  # "<method> <route>" -> most requests running at once
+    "POST /login": 4,
+    "POST /users": 4,
+    "GET /users": 4,
+    "GET /loan-items": 8,
+    "POST /loan-items/lookup": 4,
+}
+ROUTE_LIMITS.update(json.loads(os.environ["ADMISSION_ROUTE_LIMITS"]) if "ADMISSION_ROUTE_LIMITS" in os.environ else {})
+PRIORITIES = {  # "<method> <route>" -> priority, NORMAL if not listed
+    "PUT /loan-items/<item_id>": HIGH,
+    "POST /loan-items/<item_id>/holds": HIGH,
+    "DELETE /loan-items/<item_id>/holds": HIGH,
+    "GET /metrics": HIGH,
+    "GET /users": LOW,
+    "GET /loan-items": LOW,
+    "GET /loan-items?ids": NORMAL,  # Scans of a few items, not a listing
+    "POST /loan-items/lookup": LOW,
+    "GET /stats": LOW,
+    "GET /tags": LOW,
+}
+PRIORITIES.update(json.loads(os.environ["ADMISSION_PRIORITIES"]) if "ADMISSION_PRIORITIES" in os.environ else {})
+QUEUE_SECONDS = {HIGH: 2.0, NORMAL: 1.0, LOW: 0.25}  # Longest wait for a slot
+if "ADMISSION_QUEUE_SECONDS" in os.environ:
+    QUEUE_SECONDS.update(json.loads(os.environ["ADMISSION_QUEUE_SECONDS"]))
+
+
+class _Waiter:
+    __slots__ = ("route", "rank", "order", "event", "admitted")
+
+    def __init__(self, route, rank, order):
+        self.route = route
+        self.rank = rank
+        self.order = order
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class Controller:
+    def __init__(self, max_concurrent, max_queue, route_limits):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.route_limits = route_limits
+        self._running = 0
+        self._running_routes = {}  # route -> requests running
+        self._waiting = []
+        self._order = count()
+        self._lock = threading.Lock()
+
+    def admit(self, route, priority, timeout):
+        """Wait up to timeout seconds for a slot. Returns None once admitted, otherwise why the request was shed."""
+        with self._lock:
+            if self._has_room(route):
+                self._take(route)
+                return None
+            rank = _RANKS[priority]
+            if len(self._waiting) >= self.max_queue:
+                pushed_out = max(self._waiting, key=lambda waiter: (waiter.rank, waiter.order), default=None)
+                if pushed_out is None or pushed_out.rank <= rank:
+                    return "queue_full"
+                self._waiting.remove(pushed_out)
+                pushed_out.event.set()  # Not admitted, so it is shed
+            waiter = _Waiter(route, rank, next(self._order))
+            self._waiting.append(waiter)
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.admitted:
+                return None
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+                return "timeout"
+            return "pushed_out"
+
+    def release(self, route):
+        with self._lock:
+            self._running -= 1
+            self._running_routes[route] -= 1
+            while self._waiting and self._running < self.max_concurrent:
+                ready = [waiter for waiter in self._waiting if self._has_room(waiter.route)]
+                if not ready:
+                    break
+                waiter = min(ready, key=lambda waiter: (waiter.rank, waiter.order))
+                self._waiting.remove(waiter)
+                self._take(waiter.route)
+                waiter.admitted = True
+                waiter.event.set()
+
+    def status(self):
+        with self._lock:
+            return {"running": self._running, "waiting": len(self._waiting)}
+
+    def _has_room(self, route):
+        limit = self.route_limits.get(route)
+        return self._running < self.max_concurrent and (limit is None or self._running_routes.get(route, 0) < limit)
+
+    def _take(self, route):
+        self._running += 1
+        self._running_routes[route] = self._running_routes.get(route, 0) + 1
+
+
+controller = Controller(MAX_CONCURRENT, MAX_QUEUE, ROUTE_LIMITS)
+
+
+def install(flask_app):
+    flask_app.before_request(_admit)
+    flask_app.teardown_request(_release)
+
+
+def _admit():
+    if not controller.max_concurrent or request.url_rule is None:
+        return None
+    route = f"{request.method} {request.url_rule.rule}"
+    if route == "GET /loan-items" and "ids" in request.args:
+        route += "?ids"
+    priority = PRIORITIES.get(route, NORMAL)
+    started = monotonic()
+    shed = controller.admit(route, priority, QUEUE_SECONDS[priority])
+    if shed is None:
+        g.admitted = (controller, route)
+        metrics.increment("admission_wait_seconds", monotonic() - started)
+        return None
+    metrics.increment("admission_shed")
+    metrics.increment(f"admission_shed_{shed}")
+    metrics.increment(f"admission_shed_{priority}")
+    return respond({"error": "Server busy."}), 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+
+
+def _release(_):
+    admitted = g.pop("admitted", None)
+    if admitted:
+        admitted_controller, route = admitted
+        admitted_controller.release(route)
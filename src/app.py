@@ -1,11 +1,11 @@
 import datetime
 import os
-import traceback
+from time import time
 
 import jwt
 import phonenumbers
 from phonenumbers.phonenumberutil import NumberParseException
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, current_app, g, request
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from exceptions import (
@@ -16,15 +16,34 @@ from exceptions import (
     UnknownUserException,
     InitialAdminRoleException,
     UserAlreadyExistsException,
-    CannotDeleteLoadedItem
+    CannotDeleteLoadedItem,
+    UnknownSiteException,
+    SiteUnavailableException,
+    UnknownHoldException,
+    UnknownCatalogueVersionException
 )
+import admission
+import catalogue
+import compression
+import database
+import metrics
+import modes
+import requestlog
+import slowlog
+import tracing
+from formats import respond
+from idempotency import idempotent
+from profiling import profiled
+from ratelimit import rate_limited
+from shards import DEFAULT_SITE
 from users import Users, UserManagement
 
-app = Flask(__name__)
-app.config["SECRET_KEY"] = (
-    os.environ["SECRET_KEY"] if "SECRET_KEY" in os.environ else "bad_secret"
-)
-mode = "admin-operated"
+api = Blueprint("api", __name__)
+# How long after a write a client's reads keep going to the primary database instead of a replica.
+REPLICA_LAG_SECONDS = float(os.environ["REPLICA_LAG_SECONDS"]) if "REPLICA_LAG_SECONDS" in os.environ else 5.0
+# Endpoints that don't write to the site's database whatever their method. PUT /mode writes the directory database in
+# a session of its own, which must not wait for the write lock of the request's session.
+READ_ONLY_ENDPOINTS = {"api.login", "api.lookup_loan_items_route", "api.mode_route"}
 
 
 def check_token_and_set_session(user_manage):
@@ -32,8 +51,35 @@ def check_token_and_set_session(user_manage):
         token = request.headers["access-token"]
     else:
         raise InvalidTokenException
-    data = jwt.decode(token, app.config["SECRET_KEY"])
+    data = jwt.decode(token, current_app.config["SECRET_KEY"])
+    if data.get("site", DEFAULT_SITE) != current_site():
+        raise NotAllowedException
     user_manage.set_user_session(data["username"])
+    g.username = data["username"]  # For the access log
+
+
+def current_site():
+    """The site (tenant) a request is for. Requests without a "site" header use the default site."""
+    return request.headers.get("site", DEFAULT_SITE)
+
+
+def writes():
+    """Whether the request may write. Other requests get read-only sessions, which don't take SQLite's write lock."""
+    return request.method not in ("GET", "HEAD", "OPTIONS") and request.endpoint not in READ_ONLY_ENDPOINTS
+
+
+def user_management():
+    return UserManagement(current_site(), read_only=not writes(), replica=read_from_replica())
+
+
+def read_from_replica():
+    """GET requests may be served by a replica, unless this client wrote recently (read-your-writes)."""
+    if request.method != "GET":
+        return False
+    try:
+        return float(request.cookies.get("wrote-until", 0)) < time()
+    except ValueError:
+        return False
 
 
 def register(user_manager):
@@ -53,22 +99,22 @@ def register(user_manager):
         hashed_password,
         request_data["phone"],
     )
-    return jsonify({"message": "Successfully registered."})
+    return respond({"message": "Successfully registered."})
 
 
 def read_users(user_manage: Users):
     user_dict = user_manage.read()
-    return jsonify({"users": user_dict})
+    return respond({"users": user_dict})
 
 
 def read_user(user_manage: Users, username):
     user_dict = user_manage.read(username)
-    return jsonify({"user": user_dict})
+    return respond({"user": user_dict})
 
 
 def remove_user(user_manage: Users, username):
     user_dict = user_manage.remove(username)
-    return jsonify({"message": "User successfully deleted.", "user": user_dict})
+    return respond({"message": "User successfully deleted.", "user": user_dict})
 
 
 def update_user(user_manage: Users, username):
@@ -83,107 +129,174 @@ def update_user(user_manage: Users, username):
         user_dict = user_manage.update_phone(
             username, request.json["phone"]
         )
-        return jsonify({"user": user_dict})
+        return respond({"user": user_dict})
     elif "role" in request.json:
         if request.json["role"] not in ["admin", "regular"]:
             raise InvalidRequestException
         user_dict = user_manage.update_role(username, request.json["role"])
-        return jsonify({"user": user_dict})
+        return respond({"user": user_dict})
     else:
         raise InvalidRequestException
-    return jsonify({"message": "Password successfully changed."})
+    return respond({"message": "Password successfully changed."})
 
 
 def create_loan_item(user_manager: Users):
-    loan_item_dict = user_manager.Loans.create(request.json["id"], request.json["description"])
-    return jsonify({"loan-item": loan_item_dict})
+    loan_item_dict = user_manager.Loans.create(request.json["id"], request.json["description"],
+                                               request.json.get("tags"))
+    return respond({"loan-item": loan_item_dict})
 
 
 def read_loan_items(user_manager: Users):
+    if "ids" in request.args:
+        if len(request.args) != 1:
+            raise InvalidRequestException
+        return lookup_loan_items(user_manager, request.args["ids"].split(","))
     loan_item_dict = user_manager.Loans.read(request.args)
-    return jsonify({"loan-items": loan_item_dict})
+    return respond({"loan-items": loan_item_dict})
+
+
+def lookup_loan_items(user_manager: Users, ids=None):
+    """Several items by id, e.g. a shelf of scanned QR codes. Ids not found are listed under "missing"."""
+    if ids is None:
+        if not request.json or "ids" not in request.json:
+            raise InvalidRequestException
+        ids = request.json["ids"]
+    loan_item_dicts, missing = user_manager.Loans.read_many(ids)
+    return respond({"loan-items": loan_item_dicts, "missing": missing})
 
 
 def read_loan_item(user_manager: Users, id):
     loan_dict = user_manager.Loans.read_single_entry(id)
-    return jsonify({"loan-item": loan_dict})
+    return respond({"loan-item": loan_dict})
 
 
 def update_loan_item(user_manager: Users, id):
-    """Only accepts {"loanedto": <username>}"""
-    if "loanedto" not in request.json:
+    """Only accepts {"loanedto": <username>} or {"tags": [<tag>, ...]}"""
+    if "tags" in request.json:
+        loan_dict = user_manager.Loans.update_tags(id, request.json["tags"])
+    elif "loanedto" in request.json:
+        loan_dict = user_manager.Loans.update_loan(id, request.json["loanedto"])
+    else:
         raise InvalidRequestException
-    loan_dict = user_manager.Loans.update_loan(id, request.json["loanedto"])
-    return jsonify({"loan-item": loan_dict})
+    return respond({"loan-item": loan_dict})
 
 
 def remove_loan_item(user_manager: Users, loan_item_id):
     loan_item_dict = user_manager.Loans.remove(loan_item_id)
-    return jsonify({"message": "Loan item successfully deleted.", "loan-item": loan_item_dict})
+    return respond({"message": "Loan item successfully deleted.", "loan-item": loan_item_dict})
 
 
 def login_user(user_manager):
     json = request.get_json()
     user_orm = user_manager.non_session_read(json["username"])
     if not user_orm:
-        return jsonify({"error": "Wrong username or password."}), 401
+        return respond({"error": "Wrong username or password."}), 401
     if check_password_hash(user_orm.hashed_password, json["password"]):
         payload = {
             "username": json["username"],
+            "site": current_site(),
             "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=30),
         }
-        token = jwt.encode(payload, app.config["SECRET_KEY"])
-        return jsonify({"auth_token": token.decode()})
-    return jsonify({"error": "Wrong username or password."}), 401
+        token = jwt.encode(payload, current_app.config["SECRET_KEY"])
+        return respond({"auth_token": token.decode()})
+    return respond({"error": "Wrong username or password."}), 401
 
 
 def get_mode(user_manager: Users):
     role = user_manager.get_current_role()
     if role == "admin":
-        return jsonify({"mode": mode})
+        return respond({"mode": modes.get_mode(current_site())})
     else:
         raise NotAllowedException
 
 
 def change_mode(user_manager: Users):
-    global mode
     role = user_manager.get_current_role()
     if role == "admin":
         request_data = request.get_json()
-        if "mode" in request_data and request_data["mode"] in ["self-service", "admin-operated"]:
-            mode = request_data["mode"]
-            return jsonify({"mode": mode})
+        if "mode" in request_data and request_data["mode"] in modes.MODES:
+            modes.set_mode(request_data["mode"], current_site())
+            return respond({"mode": request_data["mode"]})
         else:
             raise InvalidRequestException
     else:
         raise NotAllowedException
 
 
+def place_hold(user_manager: Users, id):
+    hold_dict = user_manager.Loans.place_hold(id)
+    return respond({"hold": hold_dict})
+
+
+def cancel_hold(user_manager: Users, id):
+    user_manager.Loans.cancel_hold(id)
+    return respond({"message": "Hold successfully cancelled."})
+
+
+def read_holds(user_manager: Users):
+    return respond({"holds": user_manager.Loans.read_holds()})
+
+
+def read_tags(user_manager: Users):
+    return respond({"tags": user_manager.Loans.read_tags()})
+
+
+def read_stats(user_manager: Users):
+    return respond({"stats": user_manager.Loans.read_stats()})
+
+
+def read_catalogue(user_manager: Users):
+    return respond({"catalogue": catalogue.current(current_site())})
+
+
+def send_catalogue(user_manager: Users, version):
+    return catalogue.send(current_site(), version)
+
+
+def read_metrics(user_manager: Users):
+    if user_manager.get_current_role() != "admin":
+        raise NotAllowedException
+    return respond({"metrics": metrics.snapshot(), "admission": admission.controller.status()})
+
+
+def read_slow_queries(user_manager: Users):
+    if user_manager.get_current_role() != "admin":
+        raise NotAllowedException
+    return respond({"slow-queries": slowlog.summary()})
+
+
+@profiled(check_token_and_set_session)
 def eval_and_respond(user_manage, funcs):
     ret_val = {}
     try:
         for func in funcs:
             if isinstance(func, list):
-                ret_val = func[0](user_manage, *func[1:])
+                with tracing.span(func[0].__name__):
+                    ret_val = func[0](user_manage, *func[1:])
             else:
-                ret_val = func(user_manage)
+                with tracing.span(func.__name__):
+                    ret_val = func(user_manage)
     except UnknownLoanItemException:
-        return jsonify({"error": "Loan not found."}), 404
+        return respond({"error": "Loan not found."}), 404
     except NotAllowedException:
-        return jsonify({"error": "Not authorized."}), 403
+        return respond({"error": "Not authorized."}), 403
     except UserAlreadyExistsException:
-        return jsonify({"error": "User already exists."}), 400
+        return respond({"error": "User already exists."}), 400
     except (InvalidRequestException, NumberParseException):
-        return jsonify({"error": "Invalid request."}), 400
+        return respond({"error": "Invalid request."}), 400
     except UnknownUserException:
-        return jsonify({"error": "User not found."}), 404
+        return respond({"error": "User not found."}), 404
     except InitialAdminRoleException:
-        return jsonify({"error": "Can't change admin username or role."}), 400
+        return respond({"error": "Can't change admin username or role."}), 400
     except CannotDeleteLoadedItem:
-        return jsonify({"error": "Cannot delete loan item that is loaned."}), 403
+        return respond({"error": "Cannot delete loan item that is loaned."}), 403
+    except UnknownHoldException:
+        return respond({"error": "Hold not found."}), 404
+    except UnknownCatalogueVersionException:
+        return respond({"error": "Catalogue version not found."}), 404
     except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        requestlog.log_exception()
+        return respond({"error": str(e)}), 500
     return ret_val
 
 
@@ -195,15 +308,36 @@ def create_admin_user():
         user_management.create_initial_admin(password_hash)
 
 
-@app.route("/login", methods=["POST"])
+@api.app_errorhandler(UnknownSiteException)
+def unknown_site(_):
+    return respond({"error": "Site not found."}), 404
+
+
+@api.app_errorhandler(SiteUnavailableException)
+def site_unavailable(_):
+    return respond({"error": "Site temporarily unavailable."}), 503, {"Retry-After": "30"}
+
+
+@api.route("/login", methods=["POST"])
+@rate_limited
 def login():
-    with UserManagement() as user_manage:
+    with user_management() as user_manage:
         return eval_and_respond(user_manage, [login_user])
 
 
-@app.route("/users", methods=["GET", "POST"])
+@api.after_app_request
+def mark_recent_write(response):
+    """Tell the client to send the cookie back so its next reads see its own writes."""
+    if database.replica_engines and writes():
+        response.set_cookie("wrote-until", str(time() + REPLICA_LAG_SECONDS), max_age=int(REPLICA_LAG_SECONDS) + 1)
+    return response
+
+
+@api.route("/users", methods=["GET", "POST"])
+@rate_limited
+@idempotent
 def users():
-    with UserManagement() as user_manage:
+    with user_management() as user_manage:
         if request.method == "GET":
             funcs = [check_token_and_set_session, read_users]
         else:  # POST
@@ -212,9 +346,9 @@ def users():
     return response
 
 
-@app.route("/users/<username>", methods=["GET", "PUT", "DELETE"])
+@api.route("/users/<username>", methods=["GET", "PUT", "DELETE"])
 def user(username):
-    with UserManagement() as user_manage:
+    with user_management() as user_manage:
         if request.method == "GET":
             funcs = [check_token_and_set_session, [read_user, username]]
             response = eval_and_respond(user_manage, funcs)
@@ -227,9 +361,10 @@ def user(username):
     return response
 
 
-@app.route("/loan-items", methods=["GET", "POST"])
+@api.route("/loan-items", methods=["GET", "POST"])
+@idempotent
 def loan_items():
-    with UserManagement() as user_manage:
+    with user_management() as user_manage:
         if request.method == "GET":
             funcs = [check_token_and_set_session, read_loan_items]
         else:  # POST
@@ -238,9 +373,18 @@ def loan_items():
     return response
 
 
-@app.route("/loan-items/<item_id>", methods=["GET", "PUT", "DELETE"])
+@api.route("/loan-items/lookup", methods=["POST"])
+def lookup_loan_items_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, lookup_loan_items]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/loan-items/<item_id>", methods=["GET", "PUT", "DELETE"])
+@idempotent
 def loan_item(item_id):
-    with UserManagement() as user_manage:
+    with user_management() as user_manage:
         if request.method == "GET":
             funcs = [check_token_and_set_session, [read_loan_item, item_id]]
             response = eval_and_respond(user_manage, funcs)
@@ -253,9 +397,9 @@ def loan_item(item_id):
     return response
 
 
-@app.route("/mode", methods=["GET", "PUT"])
-def mode():
-    with UserManagement() as user_manage:
+@api.route("/mode", methods=["GET", "PUT"])
+def mode_route():
+    with user_management() as user_manage:
         if request.method == "GET":
             funcs = [check_token_and_set_session, get_mode]
             response = eval_and_respond(user_manage, funcs)
@@ -265,7 +409,88 @@ def mode():
     return response
 
 
-create_admin_user()
+@api.route("/loan-items/<item_id>/holds", methods=["POST", "DELETE"])
+def loan_item_holds(item_id):
+    with user_management() as user_manage:
+        if request.method == "POST":
+            funcs = [check_token_and_set_session, [place_hold, item_id]]
+        else:  # DELETE
+            funcs = [check_token_and_set_session, [cancel_hold, item_id]]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/holds", methods=["GET"])
+def read_holds_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_holds]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/tags", methods=["GET"])
+def read_tags_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_tags]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/stats", methods=["GET"])
+def read_stats_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_stats]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/catalogue", methods=["GET"])
+def read_catalogue_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_catalogue]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/catalogue/<version>", methods=["GET"])
+def catalogue_snapshot(version):
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, [send_catalogue, version]]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/metrics", methods=["GET"])
+def read_metrics_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_metrics]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+@api.route("/slow-queries", methods=["GET"])
+def read_slow_queries_route():
+    with user_management() as user_manage:
+        funcs = [check_token_and_set_session, read_slow_queries]
+        response = eval_and_respond(user_manage, funcs)
+    return response
+
+
+def create_app():
+    """Build the Flask app and make sure the initial admin user exists."""
+    flask_app = Flask(__name__)
+    flask_app.config["SECRET_KEY"] = (
+        os.environ["SECRET_KEY"] if "SECRET_KEY" in os.environ else "bad_secret"
+    )
+    flask_app.register_blueprint(api)
+    flask_app.after_request(compression.compress_response)
+    tracing.install(flask_app)
+    requestlog.install(flask_app)
+    admission.install(flask_app)
+    slowlog.install()
+    create_admin_user()
+    return flask_app
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,65 @@
+"""Size and encode/decode time of a loan item list in each response format, against the current jsonify output.
+
+    python benchmark_formats.py [--items 1000] [--repeat 50]
+
+Encoding goes through formats.respond(), as a request would. Decoding is what a client does with the body.
+"""
+import argparse
+import gzip
+import json
+import uuid
+from time import perf_counter
+
+from flask import Flask, jsonify
+
+import formats
+
+
+def make_payload(count):
+    return {"loan-items": [
+        {"id": str(uuid.uuid4()), "description": f"cordless drill {i}", "loanedto": f"user{i % 50}" if i % 3 else None}
+        for i in range(count)
+    ]}
+
+
+def decoders():
+    decode = {formats.JSON: json.loads}
+    if formats.msgpack:
+        decode["application/msgpack"] = formats.msgpack.unpackb
+    if formats.cbor2:
+        decode["application/cbor"] = formats.cbor2.loads
+    return decode
+
+
+def timed(function, repeat):
+    """Best time of a number of runs, in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares response formats for a list of loan items.")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    payload = make_payload(args.items)
+    flask_app = Flask(__name__)
+
+    print(f"{'format':<36}{'bytes':>10}{'gzipped':>10}{'encode ms':>11}{'decode ms':>11}")
+    with flask_app.test_request_context():
+        body = jsonify(payload).get_data()
+        encode_ms = timed(lambda: jsonify(payload).get_data(), args.repeat)
+        decode_ms = timed(lambda: json.loads(body), args.repeat)
+        print(f"{'jsonify':<36}{len(body):>10}{len(gzip.compress(body)):>10}{encode_ms:>11.2f}{decode_ms:>11.2f}")
+    for media_type, decode in decoders().items():
+        for accept in (media_type, f"{media_type}; layout={formats.ROWS_LAYOUT}"):
+            with flask_app.test_request_context(headers={"Accept": accept}):
+                body = formats.respond(payload).get_data()
+                encode_ms = timed(lambda: formats.respond(payload).get_data(), args.repeat)
+            decode_ms = timed(lambda: decode(body), args.repeat)
+            print(f"{accept:<36}{len(body):>10}{len(gzip.compress(body)):>10}{encode_ms:>11.2f}{decode_ms:>11.2f}")
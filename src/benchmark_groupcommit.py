@@ -0,0 +1,91 @@
+"""Loan and return throughput with and without group commit.
+
+    DATABASE_URL=<url> python benchmark_groupcommit.py [--threads 16] [--seconds 5] [--items 500] [--wait-ms 2]
+        [--commit-ms 0]
+
+Every thread loans or returns random items, each change in its own session as a request would, first with every
+change committing on its own and then through groupcommit. Prints changes per second, latency percentiles and the
+average batch size. --commit-ms adds that long to every commit, like a disk that is slow to fsync. Without
+DATABASE_URL it uses a temporary SQLite file. The tables of DATABASE_URL are recreated, so don't point it at a database
+you need.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+from time import monotonic, perf_counter, sleep
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'groupcommit.db')}"
+
+from sqlalchemy import event
+
+import database
+import groupcommit
+import metrics
+from database import LoanItem, User
+from loans import Loans
+
+
+def run(threads, seconds, item_count):
+    database.recreate_db()
+    session = database.get_db_session()
+    session.add(User(username="bob", role="regular"))
+    session.add_all(LoanItem(id=str(i), description=f"item {i}") for i in range(item_count))
+    session.commit()
+    session.close()
+    metrics.reset()
+
+    latencies = []
+    lock = threading.Lock()
+    deadline = monotonic() + seconds
+
+    def worker():
+        own = []
+        while monotonic() < deadline:
+            session = database.get_db_session()
+            loans = Loans(session)
+            loans.set_user_session("admin", "admin", "+441234567890")
+            item_id = str(random.randrange(item_count))
+            start = perf_counter()
+            try:
+                loans.update_loan(item_id, random.choice([None, "bob"]))
+                own.append(perf_counter() - start)
+            finally:
+                session.close()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    latencies.sort()
+    counters = metrics.snapshot()
+    batches = counters.get("group_commit_batches")
+    return {
+        "changes/s": len(latencies) / seconds,
+        "p50 ms": latencies[len(latencies) // 2] * 1000,
+        "p99 ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "batch": counters["group_commit_changes"] / batches if batches else 1,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares loan and return throughput with and without group commit.")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--items", type=int, default=500)
+    parser.add_argument("--wait-ms", type=float, default=2.0, help="GROUP_COMMIT_MS for the group commit run")
+    parser.add_argument("--commit-ms", type=float, default=0.0, help="Extra time every commit takes")
+    args = parser.parse_args()
+    if args.commit_ms:
+        event.listen(database.engine, "commit", lambda connection: sleep(args.commit_ms / 1000))
+    print(f"{'commits':<10}{'changes/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'batch':>10}")
+    for name, wait_ms in (("each", 0.0), ("grouped", args.wait_ms)):
+        groupcommit.WAIT_MS = wait_ms
+        rates = run(args.threads, args.seconds, args.items)
+        print(f"{name:<10}{rates['changes/s']:>10.0f}{rates['p50 ms']:>10.1f}{rates['p99 ms']:>10.1f}"
+              f"{rates['batch']:>10.1f}", flush=True)
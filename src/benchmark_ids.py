@@ -0,0 +1,108 @@
+"""Size and lookup speed of UUID loan item ids stored as text and as 16 bytes (LOAN_ITEM_IDS=uuid) in SQLite files.
+
+    python benchmark_ids.py [--items 10000000] [--lookups 100000] [--dir /tmp]
+
+Fills a loan item table with random UUID ids each way, through make_engine and ItemId as the app would. It then reports
+the size of the table and its primary key index, and the time of random single id lookups and 100 id IN lookups. The
+sizes come from SQLite's dbstat table, or the whole file when dbstat isn't compiled in.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import uuid
+from time import perf_counter
+
+from sqlalchemy import Column, MetaData, String, Table
+
+import database
+from database import ItemId
+
+CHUNK_SIZE = 10000
+IN_SIZE = 100
+
+
+def make_ids(count, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def build(path, uuids, count, sample):
+    """Fill the table, keeping the ids at the sample's positions for the lookups."""
+    engine = database.make_engine(f"sqlite:///{path}")
+    items = Table("LoanItem", MetaData(), Column("id", ItemId(uuids=uuids), primary_key=True),
+                  Column("description", String), Column("loanedto", String))
+    items.create(engine)
+    sampled = []
+    chunk = []
+    with engine.begin() as connection:
+        for position, item_id in enumerate(make_ids(count)):
+            chunk.append({"id": item_id, "description": "cordless drill", "loanedto": None})
+            if position in sample:
+                sampled.append(item_id)
+            if len(chunk) == CHUNK_SIZE:
+                connection.execute(items.insert(), chunk)
+                chunk = []
+        if chunk:
+            connection.execute(items.insert(), chunk)
+    engine.dispose()
+    return sampled
+
+
+def sizes(path):
+    """(table bytes, primary key index bytes), or the file size twice without dbstat."""
+    connection = sqlite3.connect(path)
+    try:
+        pages = dict(connection.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name"))
+        return pages.get("LoanItem", 0), pages.get("sqlite_autoindex_LoanItem_1", 0)
+    except sqlite3.OperationalError:
+        return os.path.getsize(path), os.path.getsize(path)
+    finally:
+        connection.close()
+
+
+def time_lookups(path, uuids, ids):
+    """Microseconds per single id lookup and per IN lookup, with the ids already in their stored form."""
+    engine = database.make_engine(f"sqlite:///{path}")
+    item_id = ItemId(uuids=uuids)
+    stored = [item_id.process_bind_param(each_id, engine.dialect) for each_id in ids]
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        start = perf_counter()
+        for each_id in stored:
+            assert cursor.execute('SELECT * FROM "LoanItem" WHERE id = ?', (each_id,)).fetchone()
+        single = (perf_counter() - start) / len(stored) * 1e6
+        batches = [stored[i:i + IN_SIZE] for i in range(0, len(stored) - IN_SIZE + 1, IN_SIZE)]
+        start = perf_counter()
+        for batch in batches:
+            cursor.execute(f'SELECT * FROM "LoanItem" WHERE id IN ({",".join("?" * len(batch))})', batch).fetchall()
+        in_lookup = (perf_counter() - start) / max(len(batches), 1) * 1e6
+    finally:
+        connection.close()
+        engine.dispose()
+    return single, in_lookup
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares text and 16 byte storage of UUID loan item ids.")
+    parser.add_argument("--items", type=int, default=10_000_000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    parser.add_argument("--dir", default=None, help="Where to build the databases, which take a few GB at 10M items")
+    args = parser.parse_args()
+    lookups = min(args.lookups, args.items)
+    sample = set(random.Random(2).sample(range(args.items), lookups))
+
+    print(f"{'ids':<6}{'table MB':>10}{'index MB':>10}{'lookup us':>11}{'IN 100 us':>11}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        for name, uuids in (("text", False), ("uuid", True)):
+            path = os.path.join(tmp_dir, f"{name}.db")
+            ids = build(path, uuids, args.items, sample)
+            random.Random(3).shuffle(ids)
+            table_bytes, index_bytes = sizes(path)
+            single, in_lookup = time_lookups(path, uuids, ids)
+            print(f"{name:<6}{table_bytes / 2 ** 20:>10.1f}{index_bytes / 2 ** 20:>10.1f}{single:>11.1f}{in_lookup:>11.1f}",
+                  flush=True)
+            os.remove(path)
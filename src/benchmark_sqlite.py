@@ -0,0 +1,97 @@
+"""Concurrent read/write throughput on a SQLite file, tuned by database.make_engine and with sqlalchemy's defaults.
+
+    python benchmark_sqlite.py [--threads 8] [--seconds 5] [--writes 0.2] [--items 500]
+
+Every thread repeatedly runs either a write (loan or return an item) or a read (an item and a page of the list), each
+in its own session as a request would. Prints operations per second and "database is locked" failures for each engine.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+from time import monotonic
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import sessionmaker
+
+import database
+from database import Base, DirectoryBase, LoanItem, User
+from loans import Loans
+
+
+def untuned_engine(url):
+    """How make_engine used to connect: sqlalchemy's defaults, and foreign keys on for the first connection only."""
+    engine = create_engine(url)
+    engine.execute("pragma foreign_keys=ON")
+    return engine
+
+
+def run(engine, read_bind, threads, seconds, write_ratio, item_count):
+    Base.metadata.create_all(engine)
+    DirectoryBase.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    ReadSession = sessionmaker(bind=read_bind)
+    session = Session()
+    session.add(User(username="bob", role="regular"))
+    session.add_all(LoanItem(id=str(i), description=f"item {i}") for i in range(item_count))
+    session.commit()
+    session.close()
+
+    results = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = monotonic() + seconds
+
+    def worker():
+        counts = {"reads": 0, "writes": 0, "locked": 0}
+        while monotonic() < deadline:
+            writing = random.random() < write_ratio
+            session = (Session if writing else ReadSession)()
+            loans = Loans(session)
+            loans.set_user_session("admin", "admin", "+441234567890")
+            item_id = str(random.randrange(item_count))
+            try:
+                if writing:
+                    loaned = loans.read_single_entry(item_id)["loanedto"]
+                    loans.update_loan(item_id, None if loaned else "bob")
+                    counts["writes"] += 1
+                else:
+                    loans.read_single_entry(item_id)
+                    loans.read({"limit": 20, "offset": random.randrange(item_count)})
+                    session.rollback()
+                    counts["reads"] += 1
+            except exc.OperationalError:
+                counts["locked"] += 1
+            finally:
+                session.close()
+        with lock:
+            for name, count in counts.items():
+                results[name] += count
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    engine.dispose()
+    return {name: count / seconds for name, count in results.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares tuned and untuned SQLite engines under concurrent load.")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--writes", type=float, default=0.2, help="Fraction of operations that write")
+    parser.add_argument("--items", type=int, default=500)
+    args = parser.parse_args()
+    print(f"{'engine':<10}{'reads/s':>10}{'writes/s':>10}{'locked/s':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ("untuned", "tuned"):
+            url = f"sqlite:///{os.path.join(tmp_dir, name + '.db')}"
+            if name == "tuned":
+                engine = database.make_engine(url)
+                read_bind = database.read_only(engine)
+            else:
+                engine = read_bind = untuned_engine(url)
+            rates = run(engine, read_bind, args.threads, args.seconds, args.writes, args.items)
+            print(f"{name:<10}{rates['reads']:>10.0f}{rates['writes']:>10.0f}{rates['locked']:>10.1f}")
@@ -0,0 +1,185 @@
+"""Streaming bulk import and export of users and loan items.
+
+    python bulk.py export loan-items items.jsonl
+    python bulk.py import users users.csv --site library --chunk-size 5000
+
+The file format comes from the extension (.csv or .jsonl). Rows are processed in fixed size chunks so memory use does
+not grow with the size of the file. PostgreSQL uses COPY, other databases use batched inserts. Each imported chunk is
+committed on its own and recorded in a "<file>.progress" file, so re-running an interrupted import carries on where it
+stopped. Rows that already exist are left alone, which makes re-importing a chunk harmless.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from itertools import islice
+from time import monotonic
+
+from sqlalchemy import select
+
+from database import User, LoanItem
+from shards import qualified_name, session_for
+from stats import rebuild as rebuild_counters
+
+TABLES = {
+    "users": User.__table__,
+    "loan-items": LoanItem.__table__,
+}
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def export_rows(kind, path, site=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Write every row of a table to a .csv or .jsonl file. Returns the number of rows written."""
+    table = TABLES[kind]
+    columns = [column.name for column in table.columns]
+    session = session_for(site, read_only=True)
+    try:
+        connection = session.connection()
+        with open(path, "w", newline="") as out_file:
+            if _is_csv(path) and connection.dialect.name == "postgresql":
+                return _copy_out(connection, table, columns, out_file)
+            writer = _writer(path, out_file, columns)
+            result = connection.execution_options(stream_results=True).execute(select([table]))
+            count = 0
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    writer(dict(row))
+                count += len(rows)
+                _report(progress, "exported", count)
+            return count
+    finally:
+        session.close()
+
+
+def import_rows(kind, path, site=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Insert the rows of a .csv or .jsonl file, resuming from the last committed chunk. Returns rows read."""
+    table = TABLES[kind]
+    columns = [column.name for column in table.columns]
+    progress_path = path + ".progress"
+    done = _read_progress(progress_path)
+    session = session_for(site)
+    try:
+        connection = session.connection()
+        insert_chunk = _copy_in if connection.dialect.name == "postgresql" else _insert_many
+        with open(path, newline="") as in_file:
+            records = islice(_reader(path, in_file, columns), done, None)
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                insert_chunk(connection, table, columns, chunk)
+                session.commit()
+                connection = session.connection()
+                done += len(chunk)
+                _write_progress(progress_path, done)
+                _report(progress, "imported", done)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+    finally:
+        session.close()
+    if kind == "loan-items":  # The inserts bypass the inventory counters
+        rebuild_counters(site)
+    return done
+
+
+def _insert_many(connection, table, columns, chunk):
+    insert = table.insert()
+    if connection.dialect.name == "sqlite":
+        insert = insert.prefix_with("OR IGNORE")
+    connection.execute(insert, chunk)
+
+
+def _copy_in(connection, table, columns, chunk):
+    """COPY the chunk into a temporary table, then move across the rows that don't exist yet."""
+    name = qualified_name(connection, table)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in chunk:
+        writer.writerow(["\\N" if record[column] is None else record[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS bulk_staging (LIKE {name}) ON COMMIT DELETE ROWS")
+    cursor.copy_expert(f"COPY bulk_staging ({', '.join(_quote(c) for c in columns)}) FROM STDIN WITH CSV NULL '\\N'",
+                       buffer)
+    cursor.execute(f"INSERT INTO {name} SELECT * FROM bulk_staging ON CONFLICT DO NOTHING")
+
+
+def _copy_out(connection, table, columns, out_file):
+    name = qualified_name(connection, table)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY (SELECT {', '.join(_quote(c) for c in columns)} FROM {name}) TO STDOUT WITH CSV HEADER",
+                       out_file)
+    return cursor.rowcount
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _writer(path, out_file, columns):
+    if _is_csv(path):
+        csv_writer = csv.DictWriter(out_file, columns)
+        csv_writer.writeheader()
+        return csv_writer.writerow
+    return lambda row: out_file.write(json.dumps(row) + "\n")
+
+
+def _reader(path, in_file, columns):
+    if _is_csv(path):
+        for row in csv.DictReader(in_file):
+            yield {column: row.get(column) or None for column in columns}
+    else:
+        for line in in_file:
+            if line.strip():
+                row = json.loads(line)
+                yield {column: row.get(column) for column in columns}
+
+
+def _is_csv(path):
+    return path.lower().endswith(".csv")
+
+
+def _read_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return 0
+    with open(progress_path) as progress_file:
+        return int(progress_file.read().strip() or 0)
+
+
+def _write_progress(progress_path, done):
+    with open(progress_path + ".tmp", "w") as progress_file:
+        progress_file.write(str(done))
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def _report(progress, action, count):
+    if progress:
+        progress(action, count)
+
+
+class _Progress:
+    """Prints rows done and the rate to stderr."""
+    def __init__(self):
+        self.start = monotonic()
+
+    def __call__(self, action, count):
+        elapsed = monotonic() - self.start
+        print(f"{count} rows {action} ({count / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import and export of users and loan items.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("kind", choices=list(TABLES))
+    parser.add_argument("path", help="A .csv or .jsonl file")
+    parser.add_argument("--site", default=None)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+    run = import_rows if args.action == "import" else export_rows
+    total = run(args.kind, args.path, args.site, args.chunk_size, _Progress())
+    print(f"Done: {total} rows", file=sys.stderr)
@@ -0,0 +1,264 @@
+"""Catalogue snapshots: every loan item of a site in one prebuilt, compressed file, for kiosks starting cold.
+
+    python catalogue.py build [--site library]
+
+A snapshot is gzipped JSON in the rows layout (see formats), {"columns": ["id", "description", "available"], "rows":
+[["42", "drill", true], ...]}, sorted by id. Its version is a hash of the content, so it only changes when the
+catalogue does. Snapshots are written to CATALOGUE_DIR (default "catalogue") as <site>-<version>.json.gz, next to
+<site>.json, which describes the current one.
+
+GET /catalogue answers with the current snapshot's version, building the site's first snapshot if it has none. Once
+the snapshot is older than CATALOGUE_SECONDS (default 300, 0 leaves building to the command above), the request starts
+a rebuild in a background thread. A file lock lets only one process build a site at a time. The newest CATALOGUE_KEEP
+(default 3) snapshots of each site are kept, so downloads of a snapshot that was just replaced can finish.
+
+GET /catalogue/<version> sends a snapshot from a memory map of its file, shared by the process's requests. It
+supports Range requests, so a kiosk can resume an interrupted download, and its ETag is the version.
+"""
+import argparse
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import time
+
+from flask import Response, request
+from sqlalchemy import select
+
+import requestlog
+from database import LoanItem
+from exceptions import UnknownCatalogueVersionException
+from shards import DEFAULT_SITE, session_for
+
+DIRECTORY = os.environ["CATALOGUE_DIR"] if "CATALOGUE_DIR" in os.environ else "catalogue"
+REFRESH_SECONDS = float(os.environ["CATALOGUE_SECONDS"]) if "CATALOGUE_SECONDS" in os.environ else 300.0
+KEEP = int(os.environ["CATALOGUE_KEEP"]) if "CATALOGUE_KEEP" in os.environ else 3
+COLUMNS = ["id", "description", "available"]
+FETCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024  # Bytes per chunk of a response
+MAX_MAPS = 32
+
+_version = re.compile(r"^[0-9a-f]{16}$")
+_maps = {}  # snapshot path -> mmap, oldest first
+_maps_lock = threading.Lock()
+_refreshing = set()  # Sites this process is rebuilding
+_refreshing_lock = threading.Lock()
+
+
+def build(site=None):
+    """Write a new snapshot of the site's loan items if they changed. Returns the current snapshot's details."""
+    site = site or DEFAULT_SITE
+    with _build_lock(site):
+        return _build(site)
+
+
+def current(site=None):
+    """The current snapshot's details. Builds the first one, and starts a rebuild in the background once it's stale."""
+    site = site or DEFAULT_SITE
+    details = _read_details(site)
+    if details is None:
+        with _build_lock(site):
+            details = _read_details(site) or _build(site)  # Another process may have built it meanwhile
+    elif REFRESH_SECONDS and _age(site) > REFRESH_SECONDS:
+        with _refreshing_lock:
+            if site in _refreshing:
+                return details
+            _refreshing.add(site)
+        threading.Thread(target=_refresh, args=(site,), name=f"catalogue-{site}", daemon=True).start()
+    return details
+
+
+def send(site, version):
+    """A response with the snapshot, or with the part of it the request's Range header asks for."""
+    site = site or DEFAULT_SITE
+    if not _version.match(version):
+        raise UnknownCatalogueVersionException
+    snapshot = _map(snapshot_path(site, version))
+    headers = {
+        "ETag": f'"{version}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable",  # A version's content never changes
+    }
+    if request.if_none_match.contains(version):
+        return Response(status=304, headers=headers)
+    length = len(snapshot)
+    start, stop, status = 0, length, 200
+    ranges = request.range
+    if ranges and ranges.units == "bytes" and len(ranges.ranges) == 1 and _if_range_matches(version):
+        span = ranges.range_for_length(length)
+        if span is None:
+            headers["Content-Range"] = f"bytes */{length}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    response = Response(_chunks(snapshot, start, stop), status=status, headers=headers, mimetype="application/gzip",
+                        direct_passthrough=True)  # Already compressed
+    response.content_length = stop - start
+    return response
+
+
+def snapshot_path(site, version):
+    return os.path.join(DIRECTORY, f"{site}-{version}.json.gz")
+
+
+def _details_path(site):
+    return os.path.join(DIRECTORY, f"{site}.json")
+
+
+def _read_details(site):
+    try:
+        with open(_details_path(site)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _age(site):
+    try:
+        return time() - os.path.getmtime(_details_path(site))
+    except FileNotFoundError:
+        return float("inf")
+
+
+@contextmanager
+def _build_lock(site, blocking=True):
+    """Hold the site's build lock, shared by every process. Yields False if not blocking and another has it."""
+    os.makedirs(DIRECTORY, exist_ok=True)
+    with open(os.path.join(DIRECTORY, f".{site}.lock"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _refresh(site):
+    try:
+        with _build_lock(site, blocking=False) as locked:
+            if locked and _age(site) > REFRESH_SECONDS:  # Another process may have just rebuilt it
+                _build(site)
+    except Exception:
+        requestlog.log_exception()
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(site)
+
+
+def _build(site):
+    items = LoanItem.__table__
+    digest = hashlib.sha256()
+    count = 0
+    descriptor, temporary = tempfile.mkstemp(prefix=f".{site}-", suffix=".tmp", dir=DIRECTORY)
+    try:
+        with open(descriptor, "wb") as file, gzip.GzipFile(fileobj=file, mode="wb", mtime=0) as snapshot:
+            def write(text):
+                data = text.encode()
+                digest.update(data)
+                snapshot.write(data)
+
+            session = session_for(site, read_only=True)
+            try:
+                rows = session.connection().execution_options(stream_results=True)\
+                    .execute(select([items.c.id, items.c.description, items.c.loanedto]).order_by(items.c.id))
+                write('{"columns":' + json.dumps(COLUMNS, separators=(",", ":")) + ',"rows":[')
+                while True:
+                    batch = rows.fetchmany(FETCH_SIZE)
+                    if not batch:
+                        break
+                    write(("," if count else "") + ",".join(
+                        json.dumps([item_id, description, loaned_to is None], separators=(",", ":"))
+                        for item_id, description, loaned_to in batch
+                    ))
+                    count += len(batch)
+                write("]}")
+            finally:
+                session.close()
+        version = digest.hexdigest()[:16]
+        path = snapshot_path(site, version)
+        if os.path.exists(path):  # Same content as a snapshot that is still kept
+            os.remove(temporary)
+        else:
+            os.chmod(temporary, 0o644)  # mkstemp makes it private
+            os.replace(temporary, path)
+        details = {
+            "version": version,
+            "built": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "items": count,
+            "bytes": os.path.getsize(path),
+        }
+        _write_details(site, details)
+        _prune(site, version)
+        return details
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def _write_details(site, details):
+    descriptor, temporary = tempfile.mkstemp(prefix=f".{site}-", suffix=".tmp", dir=DIRECTORY)
+    with open(descriptor, "w") as file:
+        json.dump(details, file)
+    os.replace(temporary, _details_path(site))
+
+
+def _prune(site, version):
+    current_path = snapshot_path(site, version)
+    snapshots = sorted(glob.glob(os.path.join(DIRECTORY, f"{site}-*.json.gz")), key=os.path.getmtime, reverse=True)
+    kept = 1
+    for path in snapshots:
+        if path == current_path:
+            continue
+        if kept < KEEP:
+            kept += 1
+        else:
+            os.remove(path)
+
+
+def _map(path):
+    snapshot = _maps.get(path)
+    if snapshot is None:
+        try:
+            with open(path, "rb") as file:
+                snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise UnknownCatalogueVersionException
+        with _maps_lock:
+            snapshot = _maps.setdefault(path, snapshot)
+            while len(_maps) > MAX_MAPS:
+                # Dropped maps close once the responses still sending them finish
+                _maps.pop(next(iter(_maps)))
+    return snapshot
+
+
+def _chunks(snapshot, start, stop):
+    for position in range(start, stop, CHUNK_SIZE):
+        yield snapshot[position:min(position + CHUNK_SIZE, stop)]
+
+
+def _if_range_matches(version):
+    """Whether a Range header applies: without If-Range, or with one naming this version."""
+    if "If-Range" not in request.headers:
+        return True
+    return request.if_range.etag == version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalogue snapshot maintenance.")
+    parser.add_argument("action", choices=["build"])
+    parser.add_argument("--site", default=None)
+    args = parser.parse_args()
+    print(json.dumps(build(args.site), indent=2))
@@ -0,0 +1,170 @@
+"""Negotiated response compression (gzip, deflate and, when installed, brotli and zstd).
+
+Bodies smaller than COMPRESS_MIN_SIZE bytes are sent as they are. Streamed responses are compressed chunk by chunk.
+Compressed copies of recent bodies are cached, so repeated identical payloads (e.g. the same loan item list polled by
+many kiosks) are only compressed once.
+"""
+import gzip
+import hashlib
+import os
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from time import thread_time
+
+from flask import request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # Optional
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # Optional
+    zstandard = None
+
+MIN_SIZE = int(os.environ["COMPRESS_MIN_SIZE"]) if "COMPRESS_MIN_SIZE" in os.environ else 500
+LEVEL = int(os.environ["COMPRESS_LEVEL"]) if "COMPRESS_LEVEL" in os.environ else 6
+CACHE_ENTRIES = int(os.environ["COMPRESS_CACHE_ENTRIES"]) if "COMPRESS_CACHE_ENTRIES" in os.environ else 128
+
+
+def _deflate_stream():
+    return zlib.compressobj(LEVEL)
+
+
+def _gzip_stream():
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+_compressors = {  # encoding -> (compress whole body, make incremental compressor), in order of preference
+    "gzip": (lambda data: gzip.compress(data, LEVEL), _gzip_stream),
+    "deflate": (lambda data: zlib.compress(data, LEVEL), _deflate_stream),
+}
+if zstandard:
+    _compressors = {
+        "zstd": (lambda data: zstandard.ZstdCompressor().compress(data), lambda: zstandard.ZstdCompressor().compressobj()),
+        **_compressors,
+    }
+if brotli:
+    class _BrotliStream:
+        def __init__(self):
+            self._compressor = brotli.Compressor()
+
+        def compress(self, data):
+            return self._compressor.process(data)
+
+        def flush(self):
+            return self._compressor.finish()
+
+    _compressors = {"br": (lambda data: brotli.compress(data), _BrotliStream), **_compressors}
+
+
+class _Cache:
+    """A small LRU cache of compressed bodies, keyed by encoding and a digest of the uncompressed body."""
+    def __init__(self, max_entries):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = _Cache(CACHE_ENTRIES)
+
+
+def choose_encoding(accept_encoding):
+    """Pick the preferred encoding we support from an Accept-Encoding header, or None."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    best = None
+    for encoding in _compressors:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def compress_response(response):
+    """Flask after_request hook."""
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(_compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def _compress(data, encoding):
+    key = (encoding, hashlib.sha1(data).digest())
+    compressed = _cache.get(key)
+    if compressed is not None:
+        metrics.increment("compression_cache_hits")
+    else:
+        start = thread_time()
+        compressed = _compressors[encoding][0](data)
+        metrics.increment("compression_cpu_seconds", thread_time() - start)
+        _cache.put(key, compressed)
+    metrics.increment("compression_bytes_in", len(data))
+    metrics.increment("compression_bytes_saved", len(data) - len(compressed))
+    return compressed
+
+
+def _compress_stream(chunks, encoding):
+    compressor = _compressors[encoding][1]()
+    bytes_in = bytes_out = 0
+    cpu = 0.0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        start = thread_time()
+        compressed = compressor.compress(chunk)
+        cpu += thread_time() - start
+        bytes_in += len(chunk)
+        bytes_out += len(compressed)
+        if compressed:
+            yield compressed
+    start = thread_time()
+    tail = compressor.flush()
+    cpu += thread_time() - start
+    bytes_out += len(tail)
+    metrics.increment("compression_cpu_seconds", cpu)
+    metrics.increment("compression_bytes_in", bytes_in)
+    metrics.increment("compression_bytes_saved", bytes_in - bytes_out)
+    yield tail
@@ -28,3 +28,19 @@ class InvalidRequestException(Exception):
 
 class UserAlreadyExistsException(Exception):
     pass
+
+
+class UnknownSiteException(Exception):
+    pass
+
+
+class SiteUnavailableException(Exception):
+    pass
+
+
+class UnknownHoldException(Exception):
+    pass
+
+
+class UnknownCatalogueVersionException(Exception):
+    pass
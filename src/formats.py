@@ -0,0 +1,97 @@
+"""Negotiated response formats: JSON (the default), and MessagePack and CBOR when their packages are installed.
+
+Clients ask for a format with the Accept header, e.g. "Accept: application/msgpack". Adding "layout=rows" (e.g.
+"Accept: application/msgpack; layout=rows") sends each list of objects with the same keys as
+{"columns": [<key>, ...], "rows": [[<value>, ...], ...]}, so the keys are sent once per list instead of once per
+object. JSON is sent when the client doesn't ask for anything else we support.
+"""
+from operator import itemgetter
+
+from flask import current_app, jsonify, request
+
+import tracing
+
+try:
+    import msgpack
+except ImportError:  # Optional
+    msgpack = None
+try:
+    import cbor2
+except ImportError:  # Optional
+    cbor2 = None
+
+JSON = "application/json"
+ROWS_LAYOUT = "rows"
+_CONTAINERS = (dict, list, tuple)
+
+
+def _default(value):
+    """Values the binary formats can't encode get the same conversion as in JSON, e.g. dates become strings."""
+    return current_app.json_encoder().default(value)
+
+
+_encoders = {}  # media type -> encode function, in order of preference after JSON
+if msgpack:
+    _encoders["application/msgpack"] = lambda data: msgpack.packb(data, use_bin_type=True, default=_default)
+    _encoders["application/x-msgpack"] = _encoders["application/msgpack"]
+if cbor2:
+    _encoders["application/cbor"] = lambda data: cbor2.dumps(data, default=lambda _, value: _default(value))
+
+
+def choose_format(accept):
+    """The preferred (media type, layout) we support from an Accept header. JSON if none is acceptable."""
+    best = None
+    for part in accept.split(","):
+        media_type, *params = [piece.strip() for piece in part.split(";")]
+        media_type = media_type.lower()
+        if media_type != JSON and media_type not in _encoders:
+            continue
+        quality = 1.0
+        layout = None
+        for param in params:
+            name, _, value = param.partition("=")
+            name = name.strip().lower()
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            elif name == "layout":
+                layout = value.strip().lower()
+        if quality > 0 and (best is None or quality > best[2]):
+            best = (media_type, layout, quality)
+    return (best[0], best[1]) if best else (JSON, None)
+
+
+def to_rows(data):
+    """Replace every non-empty list of objects with the same keys by its columns and rows."""
+    if isinstance(data, dict):
+        return {key: to_rows(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        if data and all(isinstance(item, dict) for item in data):
+            keys = data[0].keys()
+            if all(item.keys() == keys for item in data):
+                columns = list(keys)
+                values = itemgetter(*columns) if len(columns) > 1 else lambda item: (item[columns[0]],)
+                return {"columns": columns, "rows": [
+                    [to_rows(value) if isinstance(value, _CONTAINERS) else value for value in values(item)]
+                    for item in data
+                ]}
+        return [to_rows(item) for item in data]
+    return data
+
+
+def respond(data):
+    """Like flask.jsonify(data), in the format the request's Accept header asks for."""
+    media_type, layout = choose_format(request.headers.get("Accept", ""))
+    with tracing.span("encode", format=media_type, layout=layout):
+        if layout == ROWS_LAYOUT:
+            data = to_rows(data)
+        if media_type == JSON:
+            response = jsonify(data)
+        else:
+            response = current_app.response_class(_encoders[media_type](data), mimetype=media_type)
+    if layout == ROWS_LAYOUT:
+        response.headers["Content-Type"] = f"{media_type}; layout={ROWS_LAYOUT}"
+    response.vary.add("Accept")
+    return response
@@ -0,0 +1,115 @@
+"""Group commit for loans and returns.
+
+With GROUP_COMMIT_MS set above 0 (the default 0 turns it off), requests don't each commit their own change. They
+queue it for their site's writer thread, which applies the queued changes in one transaction and commits them
+together, so a rush of kiosks pays for one commit (one fsync) per batch instead of one per request. The writer waits
+up to GROUP_COMMIT_MS for more changes once it has the first one, and takes at most GROUP_COMMIT_MAX_BATCH.
+
+Each change runs in its own savepoint, so a change that fails (e.g. the item is already loaned) is rolled back on its
+own and its request gets its error, while the rest of the batch commits. If the commit itself fails, every change in
+the batch is retried in a transaction of its own. A request only gets its answer once its change is committed.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+import metrics
+from shards import DEFAULT_SITE, session_for
+
+WAIT_MS = float(os.environ["GROUP_COMMIT_MS"]) if "GROUP_COMMIT_MS" in os.environ else 0.0
+MAX_BATCH = int(os.environ["GROUP_COMMIT_MAX_BATCH"]) if "GROUP_COMMIT_MAX_BATCH" in os.environ else 50
+
+_writers = {}  # (process id, site) -> _Writer
+_writers_lock = threading.Lock()
+
+
+def enabled():
+    return WAIT_MS > 0
+
+
+def submit(site, change):
+    """Apply change(db_session) in the site's next batch. Returns its result or raises its exception.
+
+    The change must flush rather than commit, and mustn't have effects outside the database, since it can run twice.
+    """
+    site = site or DEFAULT_SITE
+    pid = os.getpid()
+    writer = _writers.get((pid, site))
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get((pid, site))
+            if writer is None:  # Also after a fork, since the parent's threads don't exist in the child
+                writer = _writers[(pid, site)] = _Writer(site)
+    future = Future()
+    writer.changes.put((change, future))
+    return future.result()
+
+
+class _Writer:
+    def __init__(self, site):
+        self.site = site
+        self.changes = queue.Queue()
+        threading.Thread(target=self._run, name=f"group-commit-{site}", daemon=True).start()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._apply(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    _fail(batch, e)
+                    continue
+                metrics.increment("group_commit_retries")
+                for change in batch:
+                    try:
+                        self._apply([change])
+                    except Exception as change_error:
+                        _fail([change], change_error)
+
+    def _next_batch(self):
+        batch = [self.changes.get()]
+        deadline = monotonic() + WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            try:
+                remaining = deadline - monotonic()
+                batch.append(self.changes.get(timeout=remaining) if remaining > 0 else self.changes.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _apply(self, batch):
+        """Run the batch in one transaction, each change in a savepoint. Answers the callers once it commits."""
+        db_session = session_for(self.site)
+        savepoints = len(batch) > 1  # A change on its own can roll back the whole transaction
+        try:
+            outcomes = []
+            for change, future in batch:
+                if savepoints:
+                    db_session.begin_nested()
+                try:
+                    result = change(db_session)
+                    if savepoints:
+                        db_session.commit()  # Releases the savepoint
+                except Exception as e:
+                    db_session.rollback()  # To the savepoint
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+            db_session.commit()
+        finally:
+            db_session.close()
+        metrics.increment("group_commit_batches")
+        metrics.increment("group_commit_changes", len(batch))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _fail(batch, error):
+    for _, future in batch:
+        future.set_exception(error)
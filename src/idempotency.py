@@ -0,0 +1,223 @@
+"""Idempotency-Key support for clients that retry writes, e.g. kiosks on flaky networks.
+
+A write sent with an "Idempotency-Key" header runs once. Its response (unless it was a 5xx, which may be retried) is
+kept for IDEMPOTENCY_TTL_SECONDS (default a day), and a retry with the same key gets it back, with an
+"Idempotent-Replayed" header, without running the request again. A retry that arrives while the first request is still
+running waits up to IDEMPOTENCY_WAIT_SECONDS (default 10) for it to finish. Reusing a key for a different request (other
+URL, body or access token) gets a 422.
+
+Responses are kept in process by default, up to MemoryStore.MAX_KEYS. Setting IDEMPOTENCY_STORE to a sqlite URL (e.g.
+"sqlite:////tmp/idempotency.db") shares them between worker processes on a host.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from time import monotonic, sleep, time
+
+from flask import Response, current_app, request, jsonify
+
+import metrics
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+TTL_SECONDS = float(os.environ["IDEMPOTENCY_TTL_SECONDS"]) if "IDEMPOTENCY_TTL_SECONDS" in os.environ else 86400.0
+WAIT_SECONDS = float(os.environ["IDEMPOTENCY_WAIT_SECONDS"]) if "IDEMPOTENCY_WAIT_SECONDS" in os.environ else 10.0
+PENDING_SECONDS = 60.0  # A claim older than this belongs to a request that died, so the key can be claimed again
+MAX_KEY_LENGTH = 255
+
+# Results of Store.claim()
+CLAIMED = "claimed"  # The caller must run the request, then save() or release() the key
+IN_PROGRESS = "in-progress"
+DONE = "done"
+MISMATCH = "mismatch"
+
+
+class MemoryStore:
+    MAX_KEYS = 10000
+
+    def __init__(self):
+        self._entries = OrderedDict()  # key -> (fingerprint, expires, (status, headers, body) or None while running)
+        self._lock = Lock()
+
+    def claim(self, key, fingerprint, now=None):
+        """Returns (state, stored response). The key is claimed for the caller when it isn't in use."""
+        now = time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < now:
+                self._entries[key] = (fingerprint, now + PENDING_SECONDS, None)
+                self._entries.move_to_end(key)
+                self._evict(now)
+                return CLAIMED, None
+            return _state(entry[0], fingerprint, entry[2]), entry[2]
+
+    def save(self, key, fingerprint, response, ttl=None, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            self._entries[key] = (fingerprint, now + (TTL_SECONDS if ttl is None else ttl), response)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _evict(self, now):
+        """Oldest first. Every key gets the same TTL, so these are also the first to expire."""
+        while len(self._entries) > self.MAX_KEYS:
+            self._entries.popitem(last=False)
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest[1] >= now:
+                break
+            self._entries.popitem(last=False)
+
+
+class SqliteStore:
+    """Responses in a SQLite file, shared by every process on the host."""
+    MAX_KEYS = 100000
+    PRUNE_EVERY = 100
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._connection = None
+        self._claims = 0
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency "
+                "(key TEXT PRIMARY KEY, fingerprint TEXT, expires REAL, status INTEGER, headers TEXT, body BLOB)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_idempotency_expires ON idempotency (expires)")
+        os.register_at_fork(after_in_child=self._forget_connection)
+
+    def _forget_connection(self):
+        """A forked process must open its own connection."""
+        self._connection = None
+        self._lock = Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, timeout=1, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        return self._connection
+
+    def claim(self, key, fingerprint, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT fingerprint, expires, status, headers, body FROM idempotency WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or row[1] < now:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO idempotency (key, fingerprint, expires) VALUES (?, ?, ?)",
+                        (key, fingerprint, now + PENDING_SECONDS),
+                    )
+                    self._claims += 1
+                    if self._claims % self.PRUNE_EVERY == 0:
+                        self._prune(connection, now)
+                    result = CLAIMED, None
+                else:
+                    response = None if row[2] is None else (row[2], json.loads(row[3]), bytes(row[4]))
+                    result = _state(row[0], fingerprint, response), response
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return result
+
+    def save(self, key, fingerprint, response, ttl=None, now=None):
+        now = time() if now is None else now
+        status, headers, body = response
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO idempotency (key, fingerprint, expires, status, headers, body) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, fingerprint, now + (TTL_SECONDS if ttl is None else ttl), status, json.dumps(headers), body),
+            )
+
+    def release(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    def _prune(self, connection, now):
+        connection.execute("DELETE FROM idempotency WHERE expires < ?", (now,))
+        connection.execute(
+            "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency ORDER BY expires LIMIT "
+            "max((SELECT count(*) FROM idempotency) - ?, 0))",
+            (self.MAX_KEYS,),
+        )
+
+
+def _state(stored_fingerprint, fingerprint, response):
+    if stored_fingerprint != fingerprint:
+        return MISMATCH
+    return IN_PROGRESS if response is None else DONE
+
+
+def make_store(url):
+    if url and url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):])
+    return MemoryStore()
+
+
+store = make_store(os.environ.get("IDEMPOTENCY_STORE"))
+
+
+def idempotent(view):
+    """Route decorator. Runs a write with an Idempotency-Key header at most once and replays its response."""
+    @wraps(view)
+    def idempotent_view(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None or request.method in ("GET", "HEAD", "OPTIONS"):
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": "Invalid request."}), 400
+        key = f"{request.headers.get('site', '')}:{key}"
+        fingerprint = _fingerprint()
+
+        deadline = monotonic() + WAIT_SECONDS
+        delay = 0.01
+        while True:
+            state, stored = store.claim(key, fingerprint)
+            if state != IN_PROGRESS or monotonic() >= deadline:
+                break
+            sleep(delay)
+            delay = min(delay * 2, 0.25)
+        if state == DONE:
+            metrics.increment("idempotent_replays")
+            status, headers, body = stored
+            response = Response(body, status, headers)
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        if state == MISMATCH:
+            return jsonify({"error": "Idempotency-Key was used for a different request."}), 422
+        if state == IN_PROGRESS:
+            return jsonify({"error": "A request with this Idempotency-Key is in progress."}), 409, {"Retry-After": "1"}
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            store.release(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            store.release(key)
+        else:
+            headers = [(name, value) for name, value in response.headers if name.lower() != "content-length"]
+            store.save(key, fingerprint, (response.status_code, headers, response.get_data()))
+        return response
+    return idempotent_view
+
+
+def _fingerprint():
+    """Identifies the request a key was first used for. Includes the token so one user can't replay another's."""
+    digest = hashlib.sha256()
+    for part in (request.method, request.full_path, request.headers.get("access-token", ""),
+                 request.headers.get("Accept", "")):  # The stored response is in the format asked for
+        digest.update(part.encode() + b"\0")
+    digest.update(request.get_data())
+    return digest.hexdigest()
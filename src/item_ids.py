@@ -0,0 +1,107 @@
+"""Moves a site's loan item ids to the compact storage used with LOAN_ITEM_IDS=uuid (see database.ItemId).
+
+    python item_ids.py check [--site library]
+    python item_ids.py migrate [--site library]
+
+check counts the ids that aren't UUIDs. migrate converts the loan item, tag and hold id columns in one transaction;
+stop the app first and start it again with LOAN_ITEM_IDS=uuid. On PostgreSQL the columns become uuid, so it fails if
+any id isn't a UUID. On SQLite ids that are UUIDs are rewritten as 16 byte blobs and other ids stay as text.
+"""
+import argparse
+import json
+import uuid
+
+from sqlalchemy import func, inspect, select
+
+from database import Hold, LoanItem, LoanItemTag
+from shards import qualified_name, session_for
+
+ID_COLUMNS = [(LoanItem.__table__, "id"), (LoanItemTag.__table__, "item_id"), (Hold.__table__, "item_id")]
+MAX_EXAMPLES = 10
+
+
+def check(site=None):
+    """How many of the site's loan item ids aren't UUIDs, with a few examples."""
+    session = session_for(site, read_only=True)
+    try:
+        ids = session.connection().execution_options(stream_results=True)\
+            .execute(select([LoanItem.__table__.c.id]))
+        total = 0
+        not_uuids = []
+        not_uuid_count = 0
+        for item_id, in ids:
+            total += 1
+            if _uuid_bytes(item_id) is None:
+                not_uuid_count += 1
+                if len(not_uuids) < MAX_EXAMPLES:
+                    not_uuids.append(item_id)
+        return {"items": total, "not uuids": not_uuid_count, "examples": not_uuids}
+    finally:
+        session.close()
+
+
+def migrate(site=None):
+    """Convert the site's id columns. Returns the number of rows changed in each table."""
+    session = session_for(site)
+    try:
+        connection = session.connection()
+        if connection.dialect.name == "postgresql":
+            changed = _to_native_uuids(connection)
+        elif connection.dialect.name == "sqlite":
+            changed = _to_blobs(connection)
+        else:
+            raise ValueError(f"Compact ids aren't supported on {connection.dialect.name}.")
+        session.commit()
+        return changed
+    finally:
+        session.close()
+
+
+def _to_native_uuids(connection):
+    """ALTER the columns to uuid. The foreign keys are dropped first, since they can't refer across types."""
+    schema = connection.get_execution_options().get("schema_translate_map", {}).get(None)
+    items = qualified_name(connection, LoanItem.__table__)
+    inspector = inspect(connection)
+    for table, column in ID_COLUMNS[1:]:
+        for foreign_key in inspector.get_foreign_keys(table.name, schema=schema):
+            if foreign_key["referred_table"] == LoanItem.__tablename__:
+                connection.execute(f'ALTER TABLE {qualified_name(connection, table)} '
+                                   f'DROP CONSTRAINT "{foreign_key["name"]}"')
+    changed = {}
+    for table, column in ID_COLUMNS:
+        connection.execute(f'ALTER TABLE {qualified_name(connection, table)} '
+                           f'ALTER COLUMN "{column}" TYPE uuid USING "{column}"::uuid')
+        changed[table.name] = connection.execute(select([func.count()]).select_from(table)).scalar()
+    for table, column in ID_COLUMNS[1:]:
+        connection.execute(f'ALTER TABLE {qualified_name(connection, table)} '
+                           f'ADD FOREIGN KEY ("{column}") REFERENCES {items} (id) ON DELETE CASCADE')
+    return changed
+
+
+def _to_blobs(connection):
+    """Rewrite the UUIDs in place. SQLite keeps a blob as it is whatever the column's declared type."""
+    connection.execute("PRAGMA defer_foreign_keys=ON")  # The tables only agree again once they're all done
+    connection.connection.create_function("uuid_blob", 1, lambda value: _uuid_bytes(value) or value)
+    changed = {}
+    for table, column in ID_COLUMNS:
+        result = connection.execute(
+            f'UPDATE {qualified_name(connection, table)} SET "{column}" = uuid_blob("{column}") '
+            f'WHERE typeof("{column}") = \'text\' AND typeof(uuid_blob("{column}")) = \'blob\''
+        )
+        changed[table.name] = result.rowcount
+    return changed
+
+
+def _uuid_bytes(value):
+    try:
+        return uuid.UUID(value).bytes
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loan item id storage maintenance.")
+    parser.add_argument("action", choices=["check", "migrate"])
+    parser.add_argument("--site", default=None)
+    args = parser.parse_args()
+    print(json.dumps(check(args.site) if args.action == "check" else migrate(args.site), indent=2))
@@ -1,13 +1,32 @@
+from datetime import datetime
+
 from exceptions import NotAllowedException, UnknownLoanItemException, UnknownUserException, InvalidRequestException,\
-    CannotDeleteLoadedItem
-from database import LoanItem
-from sqlalchemy import exc
-import app
+    CannotDeleteLoadedItem, UnknownHoldException
+from database import LoanItem, LoanItemTag, InventoryCounter, Hold, User
+from sqlalchemy import bindparam, exc, func, text
+from sqlalchemy.orm import aliased
+import groupcommit
+import modes
+import notifiers
+import outbox
+from shards import qualified_name
+from tracing import traced_methods
+
+# InventoryCounter names
+ITEMS = "items"
+LOANED = "loaned"
+LOANED_TO = "loanedto:"  # Followed by the username
+TAGGED = "tag:"  # Items with the tag, followed by the tag
+TAG_LOANED = "tagloaned:"  # Loaned items with the tag, followed by the tag
+MAX_TAG_LENGTH = 64
+MAX_LOOKUP_IDS = 500
 
 
+@traced_methods
 class Loans:
-    def __init__(self, db_session):
+    def __init__(self, db_session, site=None):
         self._storage = _Storage(db_session)
+        self._site = site
         self._current_user = None
         self._current_role = None
         self._phone = None
@@ -17,13 +36,25 @@ class Loans:
         self._current_role = role
         self._phone = exp_cal_pd
 
-    def create(self, item_id, description):
+    def _in_session(self, db_session):
+        """The same user's Loans on another session, e.g. the group commit writer's."""
+        loans = Loans(db_session, self._site)
+        loans.set_user_session(self._current_user, self._current_role, self._phone)
+        return loans
+
+    def create(self, item_id, description, tags=None):
         if self._current_role != "admin":
             raise NotAllowedException
+        tags = _clean_tags(tags or [])
+        item_id = self._storage.clean_id(item_id)
+        if item_id is None:
+            raise InvalidRequestException
 
         loan_item = LoanItem(id=item_id, description=description)
-        loan_dict = self._storage.create(loan_item).__dict__.copy()
+        loan_dict = self._storage.create(loan_item, tags).__dict__.copy()
         loan_dict.pop("_sa_instance_state")
+        if tags:
+            loan_dict["tags"] = tags
         return loan_dict
 
     def remove(self, entry_id):
@@ -32,7 +63,7 @@ class Loans:
             raise UnknownLoanItemException
         if self._current_role != "admin":
             raise NotAllowedException
-        loan_dict = self._storage.remove(entry_id).__dict__.copy()
+        loan_dict = self._storage.remove(entry.id).__dict__.copy()
         loan_dict.pop("_sa_instance_state")
         return loan_dict
 
@@ -42,13 +73,14 @@ class Loans:
             raise UnknownLoanItemException
         if self._current_role != "admin":
             raise NotAllowedException
-        entry_dict = vars(entry)
+        entry_dict = vars(entry).copy()
         entry_dict.pop("_sa_instance_state")
+        entry_dict["tags"] = self._storage.get_tags(entry_id)
         return entry_dict
 
     def read(self, filter_offset_args):
-        if filter_offset_args and \
-                not set(filter_offset_args.keys()).intersection({"loanedto", "contains", "limit", "offset"}):
+        if filter_offset_args and not set(filter_offset_args.keys()).intersection(
+                {"loanedto", "contains", "tag", "available", "limit", "offset"}):
             raise InvalidRequestException
         entries = self._storage.get_filter_offset(**filter_offset_args)
         ret_val = []
@@ -58,25 +90,137 @@ class Loans:
             ret_val.append(entry_dict)
         return ret_val
 
+    def read_many(self, ids):
+        """Look up several items in one query. Returns the items in the order asked for, and the ids not found."""
+        if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+            raise InvalidRequestException
+        ids = list(dict.fromkeys(ids))
+        if not ids or len(ids) > MAX_LOOKUP_IDS:
+            raise InvalidRequestException
+        cleaned = {id: self._storage.clean_id(id) for id in ids}
+        storable = [id for id in cleaned.values() if id is not None]
+        entries = {entry.id: entry for entry in self._storage.get_many(storable)}
+        found = []
+        for id in ids:
+            entry = entries.pop(cleaned[id], None)  # Popped, so an id sent in two notations is only found once
+            if entry is not None:
+                entry_dict = vars(entry)
+                entry_dict.pop("_sa_instance_state")
+                found.append(entry_dict)
+        found_ids = {entry_dict["id"] for entry_dict in found}
+        return found, [id for id in ids if cleaned[id] not in found_ids]
+
     def update_loan(self, id, username):
-        if app.mode == "admin-operated" and self._current_role != "admin":
+        if self._current_role != "admin" and modes.get_mode(self._site) == modes.ADMIN_OPERATED:
             raise NotAllowedException
+        if groupcommit.enabled():
+            self._storage.end_transaction()  # So the writer doesn't wait for this session's lock
+            entry_dict, promoted, phone = groupcommit.submit(
+                self._site, lambda db_session: self._in_session(db_session)._change_loan(id, username, commit=False)
+            )
+        else:
+            entry_dict, promoted, phone = self._change_loan(id, username)
+        if promoted:
+            notifiers.notify_hold_ready(promoted, phone, entry_dict)
+        return entry_dict
+
+    def _change_loan(self, id, username, commit=True):
+        """Returns the item, and the user it went to from the hold queue (with their phone) if any."""
         entry = self._storage.get(id)
         if not entry:
             raise UnknownLoanItemException
         if entry.loanedto is not None and self._current_role != "admin":
             raise NotAllowedException
         else:
-            entry.loanedto = username
+            previous = entry.loanedto
+        id = entry.id
+        promoted = None
         try:
-            self._storage.update()
+            if username is None and previous is not None:
+                # Returned, so it goes straight to the first user waiting for it, in the same transaction
+                promoted = username = self._storage.pop_next_hold(id)
+            elif username is not None:
+                self._storage.remove_hold(id, username)
+            entry.loanedto = username
+            entry_dict = vars(entry).copy()  # The commit expires the entry
+            entry_dict.pop("_sa_instance_state")
+            self._storage.count_loan_change(id, previous, username)
+            if previous is not None and previous != username:
+                self._storage.add_events("returned", dict(entry_dict, loanedto=previous))
+            if username is not None and username != previous:
+                self._storage.add_events("loaned", entry_dict)
+            if commit:
+                self._storage.update()
+            else:
+                self._storage.flush()  # So an unknown user fails here rather than the whole group commit
         except exc.IntegrityError:
             raise UnknownUserException
-        entry_dict = vars(entry)
+        return entry_dict, promoted, self._storage.get_phone(promoted) if promoted else None
+
+    def place_hold(self, id):
+        """Join the queue for a loaned item. Returns the user's place in the queue."""
+        entry = self._storage.get(id)
+        if not entry:
+            raise UnknownLoanItemException
+        if entry.loanedto is None or entry.loanedto == self._current_user:
+            raise InvalidRequestException  # Available items can be loaned straight away
+        try:
+            self._storage.add_hold(Hold(item_id=entry.id, username=self._current_user, created=datetime.utcnow()))
+        except exc.IntegrityError:
+            raise InvalidRequestException  # Already holding it
+        # Counted before committing, since a return could take the hold straight away
+        position = self._storage.get_holds(self._current_user, entry.id)[0][1]
+        self._storage.update()
+        return {"id": entry.id, "position": position}
+
+    def cancel_hold(self, id):
+        id = self._storage.clean_id(id)
+        if id is None or not self._storage.remove_hold(id, self._current_user, commit=True):
+            raise UnknownHoldException
+
+    def read_holds(self):
+        """The current user's holds, oldest first, with their place in each queue."""
+        holds = self._storage.get_holds(self._current_user)
+        return [{"id": item_id, "position": position} for item_id, position in holds]
+
+    def update_tags(self, id, tags):
+        """Replace the item's tags."""
+        if self._current_role != "admin":
+            raise NotAllowedException
+        entry = self._storage.get(id)
+        if not entry:
+            raise UnknownLoanItemException
+        tags = _clean_tags(tags)
+        entry_dict = vars(entry).copy()  # The commit expires the entry
         entry_dict.pop("_sa_instance_state")
+        entry_dict["tags"] = tags
+        self._storage.set_tags(entry, tags)
         return entry_dict
 
+    def read_tags(self):
+        """Item and available counts for every tag in use."""
+        counters = self._storage.get_tag_counters()
+        facets = {}
+        for name, value in counters.items():
+            if name.startswith(TAGGED) and value:
+                loaned = counters.get(TAG_LOANED + name[len(TAGGED):], 0)
+                facets[name[len(TAGGED):]] = {"items": value, "loaned": loaned, "available": value - loaned}
+        return facets
+
+    def read_stats(self):
+        """Item counts, and how many items each user has. Regular users only see their own count."""
+        counters = self._storage.get_counters(None if self._current_role == "admin" else self._current_user)
+        loaned_to = {name[len(LOANED_TO):]: value for name, value in counters.items()
+                     if name.startswith(LOANED_TO) and value}
+        return {
+            "items": counters.get(ITEMS, 0),
+            "loaned": counters.get(LOANED, 0),
+            "available": counters.get(ITEMS, 0) - counters.get(LOANED, 0),
+            "loanedto": loaned_to,
+        }
 
+
+@traced_methods
 class _Storage:
     def __init__(self, db_session):
         self._db_session = db_session
@@ -84,30 +228,215 @@ class _Storage:
     def update(self):
         self._db_session.commit()
 
+    def flush(self):
+        self._db_session.flush()
+
+    def end_transaction(self):
+        self._db_session.rollback()
+
     def remove(self, entry_id):
         entry = self._db_session.query(LoanItem).get(entry_id)
         if entry.loanedto is not None:
             raise CannotDeleteLoadedItem
+        self._add_to_tag_counters(TAGGED, entry_id, -1)
+        self._db_session.query(LoanItemTag).filter(LoanItemTag.item_id == entry_id).delete()
         self._db_session.query(LoanItem).filter(LoanItem.id == entry_id).delete()
+        self._add_to_counter(ITEMS, -1)
+        self.add_events("deleted", {"id": entry.id, "description": entry.description, "loanedto": None})
         self._db_session.commit()
         return entry
 
-    def create(self, cal_obj):
+    def create(self, cal_obj, tags=()):
         self._db_session.add(cal_obj)
+        if tags:
+            self._db_session.flush()  # The tags refer to the item
+            self._db_session.add_all(LoanItemTag(tag=tag, item_id=cal_obj.id) for tag in tags)
+        amounts = {ITEMS: 1}
+        for tag in tags:
+            amounts[TAGGED + tag] = 1
+            amounts[TAG_LOANED + tag] = 0
+        self._add_to_counters(amounts)
         self._db_session.commit()
         return self._db_session.query(LoanItem).get(cal_obj.id)
 
+    def count_loan_change(self, item_id, previous, username):
+        if previous == username:
+            return
+        amounts = {LOANED: 0}
+        if previous is None:
+            amounts[LOANED] += 1
+        else:
+            amounts[LOANED_TO + previous] = -1
+        if username is None:
+            amounts[LOANED] -= 1
+        else:
+            amounts[LOANED_TO + username] = 1
+        self._add_to_counters(amounts)
+        if previous is None or username is None:
+            self._add_to_tag_counters(TAG_LOANED, item_id, 1 if previous is None else -1)
+
+    def add_events(self, event, loan_item):
+        events = outbox.make_events(event, loan_item)
+        if events:
+            # Write the item first, so concurrent changes to it take their event ids in the order they commit
+            self._db_session.flush()
+            self._db_session.add_all(events)
+
+    def pop_next_hold(self, item_id):
+        """Remove the hold at the head of the item's queue. Returns its username, or None if nobody is waiting."""
+        hold = self._db_session.query(Hold).filter(Hold.item_id == item_id).order_by(Hold.id).with_for_update().first()
+        if hold is None:
+            return None
+        self._db_session.delete(hold)
+        return hold.username
+
+    def remove_hold(self, item_id, username, commit=False):
+        removed = self._db_session.query(Hold).filter(Hold.item_id == item_id, Hold.username == username)\
+            .delete(synchronize_session=False)
+        if commit:
+            self._db_session.commit()
+        return removed
+
+    def add_hold(self, hold):
+        self._db_session.add(hold)
+        try:
+            self._db_session.flush()
+        except exc.IntegrityError:
+            self._db_session.rollback()
+            raise
+
+    def get_holds(self, username, item_id=None):
+        """(item id, place in queue) for the user's holds. The queue index makes each place a short range count."""
+        earlier = aliased(Hold)
+        position = self._db_session.query(func.count(earlier.id))\
+            .filter(earlier.item_id == Hold.item_id, earlier.id <= Hold.id).correlate(Hold).as_scalar()
+        query = self._db_session.query(Hold.item_id, position).filter(Hold.username == username)
+        if item_id is not None:
+            query = query.filter(Hold.item_id == item_id)
+        return query.order_by(Hold.id).all()
+
+    def get_phone(self, username):
+        return self._db_session.query(User.phone).filter(User.username == username).scalar()
+
+    def set_tags(self, entry, tags):
+        old_tags = set(self.get_tags(entry.id))
+        loaned = entry.loanedto is not None
+        amounts = {}
+        for tag in old_tags.difference(tags):
+            self._db_session.query(LoanItemTag).filter(LoanItemTag.tag == tag, LoanItemTag.item_id == entry.id)\
+                .delete()
+            amounts[TAGGED + tag] = -1
+            if loaned:
+                amounts[TAG_LOANED + tag] = -1
+        for tag in set(tags).difference(old_tags):
+            self._db_session.add(LoanItemTag(tag=tag, item_id=entry.id))
+            amounts[TAGGED + tag] = 1
+            amounts[TAG_LOANED + tag] = 1 if loaned else 0
+        if amounts:
+            self._add_to_counters(amounts)
+        self._db_session.commit()
+
+    def get_tags(self, item_id):
+        query = self._db_session.query(LoanItemTag.tag).filter(LoanItemTag.item_id == item_id)
+        return sorted(tag for tag, in query)
+
+    def _add_to_counter(self, name, amount):
+        self._add_to_counters({name: amount})
+
+    def _add_to_counters(self, amounts):
+        """Changed in the caller's transaction, so the counters commit or roll back with the loan item.
+
+        One upsert (SQLite 3.24+ and PostgreSQL) for all of them, so two transactions creating the same counter can't
+        both insert it. Sorted, so concurrent transactions lock the counters in the same order.
+        """
+        connection = self._db_session.connection()
+        counters = qualified_name(connection, InventoryCounter.__table__)
+        names = sorted(amounts)
+        rows = ", ".join(f"(:name{i}, :amount{i})" for i in range(len(names)))
+        parameters = {}
+        for i, name in enumerate(names):
+            parameters[f"name{i}"] = name
+            parameters[f"amount{i}"] = amounts[name]
+        connection.execute(
+            text(f"INSERT INTO {counters} (name, value) VALUES {rows} "
+                 f"ON CONFLICT (name) DO UPDATE SET value = {counters}.value + excluded.value"),
+            **parameters,
+        )
+
+    def _add_to_tag_counters(self, prefix, item_id, amount):
+        """Change the counter of every tag on the item in one upsert, like _add_to_counters, so a tag whose counter
+        is missing (after stats.rebuild or a bulk import) gets one.
+        """
+        connection = self._db_session.connection()
+        counters = qualified_name(connection, InventoryCounter.__table__)
+        tags = qualified_name(connection, LoanItemTag.__table__)
+        connection.execute(
+            text(f"INSERT INTO {counters} (name, value) "
+                 f"SELECT :prefix || tag, :amount FROM {tags} WHERE item_id = :item_id ORDER BY tag "
+                 f"ON CONFLICT (name) DO UPDATE SET value = {counters}.value + excluded.value")
+            .bindparams(bindparam("item_id", type_=LoanItemTag.__table__.c.item_id.type)),
+            prefix=prefix, amount=amount, item_id=item_id,
+        )
+
+    def get_counters(self, username=None):
+        """Counter values by name. Includes every user's count when no username is given."""
+        query = self._db_session.query(InventoryCounter.name, InventoryCounter.value)
+        if username is not None:
+            query = query.filter(InventoryCounter.name.in_([ITEMS, LOANED, LOANED_TO + username]))
+        return dict(query)
+
+    def get_tag_counters(self):
+        query = self._db_session.query(InventoryCounter.name, InventoryCounter.value).filter(
+            InventoryCounter.name.startswith(TAGGED) | InventoryCounter.name.startswith(TAG_LOANED)
+        )
+        return dict(query)
+
+    def clean_id(self, item_id):
+        """The id as it is stored and read back, see database.ItemId. None if it can't be stored."""
+        id_type = LoanItem.__table__.c.id.type
+        if not id_type.uuids:
+            return item_id
+        return id_type.clean(item_id, self._db_session.get_bind().dialect)
+
     def get(self, entry_id):
-        return self._db_session.query(LoanItem).get(entry_id)
+        entry_id = self.clean_id(entry_id)
+        return None if entry_id is None else self._db_session.query(LoanItem).get(entry_id)
 
-    def get_filter_offset(self, loanedto=None, contains=None, limit=None, offset=None):
+    def get_many(self, ids):
+        return self._db_session.query(LoanItem).filter(LoanItem.id.in_(ids)) if ids else []
+
+    def get_filter_offset(self, loanedto=None, contains=None, tag=None, available=None, limit=None, offset=None):
         query = self._db_session.query(LoanItem)
         if loanedto:
             query = query.filter(LoanItem.loanedto == loanedto)
         if contains:
             query = query.filter(LoanItem.description.ilike(f"%{contains}%"))
+        if tag:  # Comma separated, items must have every tag
+            for each_tag in _clean_tags(tag.split(",")):
+                tagged = self._db_session.query(LoanItemTag.item_id).filter(LoanItemTag.tag == each_tag)
+                query = query.filter(LoanItem.id.in_(tagged.subquery()))
+        if available == "true":
+            query = query.filter(LoanItem.loanedto.is_(None))
+        elif available == "false":
+            query = query.filter(LoanItem.loanedto.isnot(None))
         if limit:
             query = query.limit(limit)
         if offset:
             query = query.offset(offset)
         return query
+
+
+def _clean_tags(tags):
+    """Lower case, trimmed and without duplicates. Tags can't contain commas, which separate them in ?tag= filters."""
+    if not isinstance(tags, list):
+        raise InvalidRequestException
+    cleaned = []
+    for tag in tags:
+        if not isinstance(tag, str):
+            raise InvalidRequestException
+        tag = tag.strip().lower()
+        if not tag or "," in tag or len(tag) > MAX_TAG_LENGTH:
+            raise InvalidRequestException
+        if tag not in cleaned:
+            cleaned.append(tag)
+    return cleaned
@@ -0,0 +1,22 @@
+"""In-process counters, reported by GET /metrics."""
+from collections import defaultdict
+from threading import Lock
+
+_counters = defaultdict(float)
+_lock = Lock()
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+# For testing
+def reset():
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,38 @@
+"""The app's mode: "admin-operated", where only admins loan and return items, or "self-service". MODE sets the default.
+
+Each site has its own mode, kept in the directory (default) database rather than in each process, so every worker
+process of the server sees a change at once, and a restarted worker doesn't fall back to the default.
+"""
+import os
+
+from database import DBSession, Setting, read_engine
+from shards import DEFAULT_SITE
+
+ADMIN_OPERATED = "admin-operated"
+SELF_SERVICE = "self-service"
+MODES = [SELF_SERVICE, ADMIN_OPERATED]
+DEFAULT_MODE = os.environ["MODE"] if "MODE" in os.environ else ADMIN_OPERATED  # Until an admin changes it
+
+
+def get_mode(site=None):
+    db_session = DBSession(bind=read_engine)
+    try:
+        setting = db_session.query(Setting).get(_setting_name(site))
+        return setting.value if setting else DEFAULT_MODE
+    finally:
+        db_session.close()
+
+
+def set_mode(mode, site=None):
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}.")
+    db_session = DBSession()
+    try:
+        db_session.merge(Setting(name=_setting_name(site), value=mode))
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def _setting_name(site):
+    return f"mode:{site or DEFAULT_SITE}"
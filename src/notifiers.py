@@ -0,0 +1,44 @@
+"""Tells users that an item they were holding has been loaned to them.
+
+HOLD_NOTIFIER picks how: "log" (the default) writes the notification to stderr through requestlog's queue, or
+"<module>:<function>" calls function(username, phone, loan_item) from an importable module, e.g. one that sends an
+SMS. Notifications are sent after the loan is committed, and a notifier that fails is reported in the error log
+without failing the request.
+"""
+import importlib
+import os
+
+import requestlog
+
+HOLD_NOTIFIER = os.environ["HOLD_NOTIFIER"] if "HOLD_NOTIFIER" in os.environ else "log"
+
+_notifier = None
+
+
+def log_notifier(username, phone, loan_item):
+    requestlog.log_notification("Hold ready: %s (%s) is now loaned to %s", loan_item["id"], loan_item["description"],
+                                username)
+
+
+def notify_hold_ready(username, phone, loan_item):
+    try:
+        get_notifier()(username, phone, loan_item)
+    except Exception:
+        requestlog.log_exception()
+
+
+def get_notifier():
+    global _notifier
+    if _notifier is None:
+        if HOLD_NOTIFIER == "log":
+            _notifier = log_notifier
+        else:
+            module_name, _, function_name = HOLD_NOTIFIER.partition(":")
+            _notifier = getattr(importlib.import_module(module_name), function_name)
+    return _notifier
+
+
+def set_notifier(notifier):
+    """Replace the notifier, e.g. in tests. None goes back to HOLD_NOTIFIER."""
+    global _notifier
+    _notifier = notifier
@@ -0,0 +1,149 @@
+"""Transactional outbox: tells other systems (e.g. billing and stock) about loans, returns and deletions.
+
+OUTBOX_WEBHOOKS is a JSON object mapping subscriber names to webhook URLs. Loans writes an outbox_event row for every
+subscriber in the same transaction as the change, so an event exists if and only if its change was committed, and the
+request never waits for a subscriber. Nothing is written when no webhooks are configured.
+
+The dispatcher delivers the events:
+
+    python outbox.py [--site library] [--once]
+
+It POSTs each subscriber batches of up to OUTBOX_BATCH_SIZE (default 100) events, oldest first, as {"events": [...]}.
+A 2xx response deletes them, anything else is retried with exponential backoff. Delivery is at least once, so
+subscribers should ignore event ids they have already seen. Each item's events are delivered in order: while one is
+waiting to be retried the item's later events wait too, but other items' events carry on. Run one dispatcher per site.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import sys
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from time import sleep
+
+from database import OutboxEvent
+from shards import session_for
+
+SUBSCRIBERS = json.loads(os.environ["OUTBOX_WEBHOOKS"]) if "OUTBOX_WEBHOOKS" in os.environ else {}
+BATCH_SIZE = int(os.environ["OUTBOX_BATCH_SIZE"]) if "OUTBOX_BATCH_SIZE" in os.environ else 100
+POLL_SECONDS = float(os.environ["OUTBOX_POLL_SECONDS"]) if "OUTBOX_POLL_SECONDS" in os.environ else 1.0
+TIMEOUT_SECONDS = 10.0
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 300.0
+LOOKAHEAD_BATCHES = 10  # How far past events that are waiting for a retry to look for ones that are due
+
+
+def make_events(event, loan_item, now=None):
+    """Outbox rows for a change to a loan item, one per subscriber, for the caller to add to its transaction."""
+    now = now or datetime.utcnow()
+    payload = json.dumps(loan_item)
+    return [
+        OutboxEvent(subscriber=subscriber, item_id=loan_item["id"], event=event, payload=payload, created=now,
+                    attempts=0, next_attempt=now)
+        for subscriber in SUBSCRIBERS
+    ]
+
+
+def dispatch_once(site=None, subscribers=None, now=None):
+    """Send each subscriber its next batch. Returns the number of events delivered."""
+    subscribers = SUBSCRIBERS if subscribers is None else subscribers
+    delivered = 0
+    session = session_for(site)
+    try:
+        for subscriber, url in subscribers.items():
+            delivered += _dispatch_batch(session, subscriber, url, now or datetime.utcnow())
+    finally:
+        session.close()
+    return delivered
+
+
+def run(site=None, poll_seconds=POLL_SECONDS):
+    """Dispatch until SIGTERM or SIGINT, sleeping while there is nothing to send."""
+    running = True
+
+    def stop(*_):
+        nonlocal running
+        running = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while running:
+        if not dispatch_once(site):
+            sleep(poll_seconds)
+
+
+def _dispatch_batch(session, subscriber, url, now):
+    pending = session.query(OutboxEvent).filter(OutboxEvent.subscriber == subscriber)\
+        .order_by(OutboxEvent.id).limit(BATCH_SIZE * LOOKAHEAD_BATCHES).all()
+    batch = _next_batch(pending, now)
+    ids = [event.id for event in batch]
+    body = json.dumps({"events": [_event_json(event) for event in batch]}).encode()
+    attempts = max((event.attempts for event in batch), default=0)
+    session.rollback()  # Don't hold the database open while the subscriber answers
+    if not batch:
+        return 0
+    selected = session.query(OutboxEvent).filter(OutboxEvent.id.in_(ids))
+    if _post(url, body):
+        selected.delete(synchronize_session=False)
+        session.commit()
+        return len(ids)
+    selected.update({
+        OutboxEvent.attempts: OutboxEvent.attempts + 1,
+        OutboxEvent.next_attempt: now + timedelta(seconds=_backoff(attempts + 1)),
+    }, synchronize_session=False)
+    session.commit()
+    return 0
+
+
+def _next_batch(pending, now):
+    """Events that are due, oldest first, leaving out every item's events from the first one that isn't due."""
+    batch = []
+    waiting = set()
+    for event in pending:
+        if event.item_id in waiting:
+            continue
+        if event.next_attempt > now:
+            waiting.add(event.item_id)
+            continue
+        batch.append(event)
+        if len(batch) == BATCH_SIZE:
+            break
+    return batch
+
+
+def _event_json(event):
+    return {
+        "id": event.id,
+        "event": event.event,
+        "item_id": event.item_id,
+        "created": event.created.isoformat(),
+        "loan-item": json.loads(event.payload),
+    }
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, data=body, method="POST", headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS) as response:
+            return 200 <= response.status < 300
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def _backoff(attempts):
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delivers outbox events to the OUTBOX_WEBHOOKS subscribers.")
+    parser.add_argument("--site", default=None)
+    parser.add_argument("--once", action="store_true", help="Send one batch to each subscriber and exit")
+    args = parser.parse_args()
+    if not SUBSCRIBERS:
+        sys.exit("OUTBOX_WEBHOOKS is not set.")
+    if args.once:
+        print(f"Delivered {dispatch_once(args.site)} events", file=sys.stderr)
+    else:
+        run(args.site)
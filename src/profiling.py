@@ -0,0 +1,119 @@
+"""On-demand request profiling.
+
+An admin can profile a request by sending a "profile" header, and PROFILE_SAMPLE_RATE (0 to 1, default 0) profiles
+that fraction of all requests. A profiled request runs eval_and_respond under cProfile and records the SQL it runs.
+Each profile is written to PROFILE_DIR (default "profiles") as a pstats file (open it with python -m pstats, snakeviz
+or convert it for speedscope), plus a JSON file with the route and SQL. Only the newest PROFILE_KEEP (default 100)
+profiles are kept. Requests that aren't profiled only pay for the header check. The token of a request with the header
+is checked before profiling starts, so callers who aren't admins can't make their requests slower with it.
+"""
+import cProfile
+import json
+import os
+import random
+import threading
+from datetime import datetime
+from functools import wraps
+from time import perf_counter
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = "profile"
+PROFILE_DIR = os.environ["PROFILE_DIR"] if "PROFILE_DIR" in os.environ else "profiles"
+SAMPLE_RATE = float(os.environ["PROFILE_SAMPLE_RATE"]) if "PROFILE_SAMPLE_RATE" in os.environ else 0.0
+KEEP = int(os.environ["PROFILE_KEEP"]) if "PROFILE_KEEP" in os.environ else 100
+
+_active = threading.local()
+_listening = False
+_listen_lock = threading.Lock()
+
+
+def profiled(check_token):
+    """Decorator for eval_and_respond. check_token is the function routes run first to authenticate the caller."""
+    def decorator(eval_and_respond):
+        @wraps(eval_and_respond)
+        def wrapper(user_manage, funcs):
+            if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+                profile = _Profile()
+                with profile:
+                    response = eval_and_respond(user_manage, funcs)
+                profile.save(user_manage.get_current_role())
+                return response
+            if PROFILE_HEADER not in request.headers or not funcs or funcs[0] is not check_token:
+                return eval_and_respond(user_manage, funcs)
+            # Check who is asking before starting the profiler, so only admins can make requests pay for it
+            try:
+                check_token(user_manage)
+            except Exception:
+                return eval_and_respond(user_manage, funcs)  # Answers with the token check's error
+            if user_manage.get_current_role() != "admin":
+                return eval_and_respond(user_manage, funcs[1:])
+            profile = _Profile()
+            with profile:
+                response = eval_and_respond(user_manage, funcs[1:])
+            profile.save("admin")
+            return response
+        return wrapper
+    return decorator
+
+
+class _Profile:
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.sql = []
+        self.started = None
+        self.duration = None
+
+    def __enter__(self):
+        _listen_for_sql()
+        _active.profile = self
+        self.started = perf_counter()
+        self.profiler.enable()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.profiler.disable()
+        self.duration = perf_counter() - self.started
+        _active.profile = None
+
+    def save(self, role):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        route = request.path.strip("/").replace("/", "_") or "root"
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{request.method}-{route}"[:150]
+        self.profiler.dump_stats(os.path.join(PROFILE_DIR, name + ".prof"))
+        with open(os.path.join(PROFILE_DIR, name + ".json"), "w") as info_file:
+            json.dump({
+                "method": request.method,
+                "path": request.full_path,
+                "endpoint": request.endpoint,
+                "role": role,
+                "duration": self.duration,
+                "sql": self.sql,
+            }, info_file, indent=2)
+        _rotate()
+
+
+def _record_sql(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.sql.append(statement)
+
+
+def _listen_for_sql():
+    """Only hook into SQL execution once the first profile is taken."""
+    global _listening
+    with _listen_lock:
+        if not _listening:
+            event.listen(Engine, "before_cursor_execute", _record_sql)
+            _listening = True
+
+
+def _rotate():
+    profiles = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".prof"))
+    for name in profiles[:max(len(profiles) - KEEP, 0)]:
+        for path in (name, name[:-len(".prof")] + ".json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, path))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,142 @@
+"""Token bucket rate limiting for the unauthenticated endpoints that hash passwords (login and registration).
+
+Limits are "<requests>/<seconds>" strings, e.g. RATE_LIMIT_IP="20/60" allows bursts of 20 requests from an IP and
+refills at 20 requests per minute. Buckets are kept in process by default. Setting RATE_LIMIT_STORE to a sqlite URL
+(e.g. "sqlite:////tmp/ratelimit.db") shares them between worker processes on a host. Any object with the same
+take() method can be used as a store. Set the app's RATE_LIMIT config to False to turn limiting off.
+"""
+import math
+import os
+import sqlite3
+from functools import wraps
+from threading import Lock
+from time import time
+
+from flask import current_app, request, jsonify
+
+import metrics
+
+IP_LIMIT = os.environ["RATE_LIMIT_IP"] if "RATE_LIMIT_IP" in os.environ else "20/60"
+USERNAME_LIMIT = os.environ["RATE_LIMIT_USERNAME"] if "RATE_LIMIT_USERNAME" in os.environ else "5/60"
+
+
+def parse_limit(limit):
+    """'20/60' -> (burst of 20, refill rate of 20/60 tokens a second)."""
+    count, seconds = limit.split("/")
+    return float(count), float(count) / float(seconds)
+
+
+class MemoryStore:
+    MAX_KEYS = 100000  # Beyond this the least recently used buckets are forgotten
+    PRUNE_SECONDS = 60  # How often buckets that have refilled are forgotten
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, last updated, time it's full again), least recently used first
+        self._next_prune = 0
+        self._lock = Lock()
+
+    def take(self, key, burst, rate, now=None):
+        """Take a token from the key's bucket. Returns 0 if allowed, otherwise seconds until a token is available."""
+        now = time() if now is None else now
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            tokens, updated, _ = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.MAX_KEYS:
+                del self._buckets[next(iter(self._buckets))]
+            return wait
+
+    def _prune(self, now):
+        """Forget buckets that have refilled, each by its own limit."""
+        for key in [key for key, (_, _, refilled) in self._buckets.items() if refilled <= now]:
+            del self._buckets[key]
+        self._next_prune = now + self.PRUNE_SECONDS
+
+
+class SqliteStore:
+    """Buckets in a SQLite file, shared by every process on the host."""
+    PRUNE_SECONDS = 60  # How often each process deletes buckets that have refilled
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._connection = None
+        self._next_prune = 0
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL, refilled REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_bucket_refilled ON bucket (refilled)")
+        os.register_at_fork(after_in_child=self._forget_connection)
+
+    def _forget_connection(self):
+        """A forked process must open its own connection."""
+        self._connection = None
+        self._lock = Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, timeout=1, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        return self._connection
+
+    def take(self, key, burst, rate, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if now >= self._next_prune:
+                    connection.execute("DELETE FROM bucket WHERE refilled <= ?", (now,))
+                    self._next_prune = now + self.PRUNE_SECONDS
+                row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (burst, now)
+                tokens = min(burst, tokens + (now - updated) * rate)
+                wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                if not wait:
+                    tokens -= 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO bucket (key, tokens, updated, refilled) VALUES (?, ?, ?, ?)",
+                    (key, tokens, now, now + (burst - tokens) / rate),
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return wait
+
+
+def make_store(url):
+    if url and url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):])
+    return MemoryStore()
+
+
+store = make_store(os.environ.get("RATE_LIMIT_STORE"))
+
+
+def rate_limited(view):
+    """Route decorator. Applies the IP and username limits to POST requests before any other work is done."""
+    ip_burst, ip_rate = parse_limit(IP_LIMIT)
+    username_burst, username_rate = parse_limit(USERNAME_LIMIT)
+
+    @wraps(view)
+    def limited_view(*args, **kwargs):
+        if request.method == "POST" and current_app.config.get("RATE_LIMIT", True):
+            wait = store.take(f"ip:{request.endpoint}:{request.remote_addr}", ip_burst, ip_rate)
+            if not wait:
+                json = request.get_json(silent=True)
+                if isinstance(json, dict) and isinstance(json.get("username"), str):
+                    wait = store.take(f"user:{request.endpoint}:{json['username']}", username_burst, username_rate)
+            if wait:
+                metrics.increment(f"rate_limited_{request.endpoint}")
+                response = jsonify({"error": "Too many requests."})
+                response.headers["Retry-After"] = str(math.ceil(wait))
+                return response, 429
+        return view(*args, **kwargs)
+    return limited_view
@@ -0,0 +1,219 @@
+"""Structured access and error logs.
+
+Every request gets a JSON line in ACCESS_LOG (default "access.log") with its route, user, site, status, latency, the
+number of SQL statements it ran and its trace id when it was traced. ACCESS_LOG_SAMPLE_RATE (0 to 1, default 1) keeps
+that fraction of the entries for successful requests, which are logged with the rate so counts can be scaled back up.
+Requests that fail are always logged. Unexpected exceptions go to ERROR_LOG (default "error.log") with their traceback.
+Set either path to "" to turn that log off. Notifications (see notifiers) are written to stderr as plain lines.
+
+Requests only put their entries on a queue. A background thread turns them into JSON and writes them to the files,
+which are rotated at LOG_MAX_BYTES (default 10MB), keeping LOG_BACKUPS (default 5) old files. When the writer falls
+LOG_QUEUE_SIZE (default 10000) entries behind, new entries are dropped and counted in /metrics instead of making
+requests wait.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+import tracing
+
+ACCESS_LOG = os.environ["ACCESS_LOG"] if "ACCESS_LOG" in os.environ else "access.log"
+ERROR_LOG = os.environ["ERROR_LOG"] if "ERROR_LOG" in os.environ else "error.log"
+SAMPLE_RATE = float(os.environ["ACCESS_LOG_SAMPLE_RATE"]) if "ACCESS_LOG_SAMPLE_RATE" in os.environ else 1.0
+MAX_BYTES = int(os.environ["LOG_MAX_BYTES"]) if "LOG_MAX_BYTES" in os.environ else 10 * 2 ** 20
+BACKUPS = int(os.environ["LOG_BACKUPS"]) if "LOG_BACKUPS" in os.environ else 5
+QUEUE_SIZE = int(os.environ["LOG_QUEUE_SIZE"]) if "LOG_QUEUE_SIZE" in os.environ else 10000
+
+access_logger = logging.getLogger("loans.access")
+error_logger = logging.getLogger("loans.error")
+notify_logger = logging.getLogger("loans.notify")
+for _logger in (access_logger, error_logger, notify_logger):
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+
+
+class _Request(threading.local):
+    started = None  # perf_counter() at the start of the current request, None outside requests
+    sql_count = 0
+
+
+_current = _Request()
+_installed = False
+_install_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks: when the queue is full the entry is dropped."""
+    def prepare(self, record):
+        """Leaves the JSON to the writer, apart from the traceback, whose frames belong to the request."""
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment("log_entries_dropped")
+
+
+class _Writer:
+    """The background thread writing queued entries, started in each process that logs (server.py forks workers)."""
+    def __init__(self):
+        self.queue = None
+        self.listener = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(QUEUE_SIZE)
+            handlers = []
+            for logger, path in ((access_logger, ACCESS_LOG), (error_logger, ERROR_LOG)):
+                for handler in list(logger.handlers):
+                    logger.removeHandler(handler)
+                if not path:
+                    logger.disabled = True
+                    continue
+                logger.disabled = False
+                file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUPS,
+                                                                    delay=True)
+                file_handler.setFormatter(JsonFormatter())
+                file_handler.addFilter(lambda record, name=logger.name: record.name == name)
+                handlers.append(file_handler)
+                logger.addHandler(_DroppingQueueHandler(self.queue))
+            for handler in list(notify_logger.handlers):
+                notify_logger.removeHandler(handler)
+            stderr_handler = logging.StreamHandler(sys.stderr)
+            stderr_handler.addFilter(lambda record: record.name == notify_logger.name)
+            handlers.append(stderr_handler)
+            notify_logger.addHandler(_DroppingQueueHandler(self.queue))
+            self.listener = logging.handlers.QueueListener(self.queue, *handlers)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def flush(self):
+        """Wait until the entries logged so far are written."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def stop(self):
+        """Write what is queued and stop the thread. The next entry starts it again, e.g. with new settings."""
+        with self.lock:
+            if self.pid == os.getpid():
+                self.listener.stop()
+                for handler in self.listener.handlers:
+                    handler.close()
+            self.pid = None
+
+
+_writer = _Writer()
+flush = _writer.flush
+stop = _writer.stop
+
+
+def install(flask_app):
+    global _installed
+    flask_app.before_request(_start_request)
+    flask_app.after_request(_log_request)
+    with _install_lock:
+        if not _installed:
+            event.listen(Engine, "before_cursor_execute", _count_sql)
+            _installed = True
+
+
+def log_exception():
+    """Log the exception being handled to the error log, with the request it happened in."""
+    if _writer.pid != os.getpid():
+        _writer.start()
+    fields = _request_fields() if has_request_context() else {}
+    fields["error"] = str(sys.exc_info()[1])
+    if has_request_context():
+        error_logger.error("%s %s failed: %s", request.method, request.path, fields["error"], exc_info=True,
+                           extra={"fields": fields})
+    else:
+        error_logger.error("Unexpected error: %s", fields["error"], exc_info=True, extra={"fields": fields})
+
+
+def log_notification(message, *args):
+    """Write a line to stderr from the background thread, so a slow terminal or pipe doesn't hold up the request."""
+    if _writer.pid != os.getpid():
+        _writer.start()
+    notify_logger.info(message, *args)
+
+
+def _start_request():
+    _current.started = perf_counter()
+    _current.sql_count = 0
+
+
+def _log_request(response):
+    if _current.started is None:
+        return response
+    latency = perf_counter() - _current.started
+    _current.started = None
+    if response.status_code < 400 and SAMPLE_RATE < 1 and random.random() >= SAMPLE_RATE:
+        return response
+    if _writer.pid != os.getpid():
+        _writer.start()
+    fields = _request_fields()
+    fields.update({
+        "status": response.status_code,
+        "latency_ms": round(latency * 1000, 3),
+        "sql_count": _current.sql_count,
+        "bytes": response.calculate_content_length(),
+    })
+    if response.status_code < 400 and SAMPLE_RATE < 1:
+        fields["sample_rate"] = SAMPLE_RATE
+    access_logger.info("%s %s %s", request.method, request.path, response.status_code, extra={"fields": fields})
+    return response
+
+
+def _request_fields():
+    trace = tracing.current_trace_id()
+    fields = {
+        "method": request.method,
+        "route": request.url_rule.rule if request.url_rule else None,
+        "path": request.path,
+        "user": g.get("username"),
+        "site": request.headers.get("site"),
+        "remote_addr": request.remote_addr,
+    }
+    if trace:
+        fields["trace_id"] = trace
+    return fields
+
+
+def _count_sql(conn, cursor, statement, parameters, context, executemany):
+    if _current.started is not None:
+        _current.sql_count += 1
@@ -0,0 +1,192 @@
+"""Pre-forking production server.
+
+    python server.py [--host 0.0.0.0] [--port 5000] [--workers N] [--max-requests N]
+
+The app is created once in the master process and then forked, so workers share its memory copy-on-write. The
+master keeps the listening socket and restarts workers that exit. Signals to the master:
+
+    SIGTERM/SIGINT  Stop accepting connections, let workers finish their current requests and exit.
+    SIGHUP          Graceful reload: workers finish their current requests while the master re-executes itself
+                    (re-importing the code) on the same listening socket and forks new workers.
+
+Workers default to WEB_CONCURRENCY, or two per CPU plus one. Setting MAX_REQUESTS (or --max-requests) recycles each
+worker after roughly that many requests, to bound memory growth.
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import sys
+from time import sleep
+
+from werkzeug.serving import make_server
+
+DEFAULT_WORKERS = int(os.environ["WEB_CONCURRENCY"]) if "WEB_CONCURRENCY" in os.environ \
+    else multiprocessing.cpu_count() * 2 + 1
+DEFAULT_MAX_REQUESTS = int(os.environ["MAX_REQUESTS"]) if "MAX_REQUESTS" in os.environ else 0
+LISTEN_FD_VARIABLE = "LOAN_ITEM_API_LISTEN_FD"
+MASTER_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+
+class Master:
+    def __init__(self, listen_socket, workers, max_requests):
+        self.flask_app = None
+        self.socket = listen_socket
+        self.worker_count = workers
+        self.max_requests = max_requests
+        self.workers = set()
+        self.running = True
+        self.reloading = False
+        # Installed before the app is loaded so a signal during a (re)start isn't lost. A reload blocks these signals
+        # across the exec, so any that arrived in the meantime are delivered here.
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+
+    def run(self, flask_app):
+        self.flask_app = flask_app
+        while self.running:
+            self._reap()
+            while len(self.workers) < self.worker_count and self.running:
+                self._spawn()
+            sleep(0.2)
+        self._terminate_workers()
+        if self.reloading:
+            os.set_inheritable(self.socket.fileno(), True)
+            os.environ[LISTEN_FD_VARIABLE] = str(self.socket.fileno())
+            signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        while self.workers:
+            self._reap()
+            sleep(0.1)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+        exit_code = 0
+        try:
+            _Worker(self.flask_app, self.socket, self.max_requests).run()
+        except Exception:
+            exit_code = 1
+        finally:
+            _flush_background_writers()
+            os._exit(exit_code)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.workers.discard(pid)
+
+    def _terminate_workers(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _stop(self, *_):
+        self.running = False
+        self.reloading = False  # Stopping wins over a reload that hasn't happened yet
+
+    def _reload(self, *_):
+        self.reloading = True
+        self.running = False
+
+
+class _Worker:
+    def __init__(self, flask_app, listen_socket, max_requests):
+        self.running = True
+        self.handled = 0
+        # Spread recycling out so workers don't all restart at once
+        self.max_requests = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        host = listen_socket.getsockname()[0]
+        self.server = make_server(host, 0, self._count_requests(flask_app), threaded=True, fd=listen_socket.fileno())
+        self.server.daemon_threads = False
+        self.server.block_on_close = True
+        # Every worker wakes up for a new connection but only one gets it, the rest must not block in accept()
+        os.set_blocking(self.server.socket.fileno(), False)
+        self.master_pid = os.getppid()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        while self.running and not (self.max_requests and self.handled >= self.max_requests):
+            readable, _, _ = select.select([self.server.socket], [], [], 0.5)
+            if readable:
+                self.server._handle_request_noblock()  # Returns straight away if another worker got the connection
+            if os.getppid() != self.master_pid:  # The master was killed
+                break
+        self.server.server_close()  # Waits for requests still in progress
+
+    def _count_requests(self, wsgi_app):
+        def counting_app(environ, start_response):
+            self.handled += 1
+            return wsgi_app(environ, start_response)
+        return counting_app
+
+    def _stop(self, *_):
+        self.running = False
+
+
+def _flush_background_writers():
+    """Write out the log entries and traces the worker's background threads still hold, which os._exit would lose."""
+    import requestlog
+    import tracing
+    for flush in (requestlog.stop, tracing.flush):
+        try:
+            flush()
+        except Exception:
+            pass
+
+
+def listen(host, port):
+    if LISTEN_FD_VARIABLE in os.environ:  # Re-executed by a graceful reload
+        fd = int(os.environ.pop(LISTEN_FD_VARIABLE))
+        return socket.socket(fileno=fd)
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(1024)
+    return listen_socket
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-forking server for the loan item API.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--max-requests", type=int, default=DEFAULT_MAX_REQUESTS)
+    args = parser.parse_args(argv)
+
+    master = Master(listen(args.host, args.port), args.workers, args.max_requests)
+
+    import app
+    import database
+    import shards
+    if database.in_memory():
+        sys.exit("An in-memory database can't be shared by worker processes. Set DATABASE_URL or run app.py.")
+    flask_app = app.create_app()
+    # Workers must open their own database connections
+    database.dispose_engines()
+    shards.dispose_engines()
+    # Keep the preloaded objects out of the garbage collector so collections in workers don't copy their pages
+    gc.collect()
+    gc.freeze()
+    master.run(flask_app)
+
+
+if __name__ == "__main__":
+    main()
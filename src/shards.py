@@ -0,0 +1,214 @@
+"""Routes each site (tenant) to the database shard that holds its data.
+
+Shards are configured with the DATABASE_SHARDS environment variable, a JSON object mapping shard names to
+sqlalchemy URLs. A shard URL containing "{site}" gives every site its own database (e.g. one SQLite file per site),
+otherwise every site gets its own schema within the shard (e.g. PostgreSQL schemas). The "default" site is the
+original single database and is used when a request does not name a site.
+
+Admin tool:
+    python shards.py list
+    python shards.py add <site> <shard>
+    python shards.py move <site> <shard>
+"""
+import json
+import os
+import re
+import sys
+from time import monotonic, sleep
+
+from sqlalchemy import Integer, select, text
+from sqlalchemy.orm import sessionmaker
+from werkzeug.security import generate_password_hash
+
+import database
+from database import Base, Site, DBSession, get_read_session
+from exceptions import UnknownSiteException, SiteUnavailableException
+
+DEFAULT_SITE = "default"
+SHARDS = json.loads(os.environ["DATABASE_SHARDS"]) if "DATABASE_SHARDS" in os.environ else {}
+CACHE_SECONDS = float(os.environ["SITE_CACHE_SECONDS"]) if "SITE_CACHE_SECONDS" in os.environ else 30.0
+COPY_CHUNK_SIZE = 1000
+
+_site_name = re.compile(r"^[a-z0-9_]{1,48}$")
+_engines = {}  # url -> engine
+_session_makers = {}  # site -> (expiry time, sessionmaker, read-only sessionmaker)
+
+
+def session_for(site=None, read_only=False, replica=True):
+    """Return a new database session for the site's shard.
+
+    Read-only sessions don't take SQLite's write lock. For the default site they go to a replica when replicas are
+    configured, unless replica is False.
+    """
+    if not site or site == DEFAULT_SITE:
+        return get_read_session(replica) if read_only else DBSession()
+    cached = _session_makers.get(site)
+    if cached is None or cached[0] < monotonic():
+        site_orm = _directory_get(site)
+        if not site_orm:
+            raise UnknownSiteException
+        if site_orm.locked:
+            _session_makers.pop(site, None)
+            raise SiteUnavailableException
+        bind = bind_for(site, site_orm.shard)
+        cached = (monotonic() + CACHE_SECONDS, sessionmaker(bind=bind), sessionmaker(bind=database.read_only(bind)))
+        _session_makers[site] = cached
+    return cached[2]() if read_only else cached[1]()
+
+
+def bind_for(site, shard):
+    """Return the engine (or schema translating engine) holding the site's tables."""
+    if not _site_name.match(site):
+        raise UnknownSiteException
+    if shard not in SHARDS:
+        raise UnknownSiteException
+    url = SHARDS[shard]
+    if "{site}" in url:
+        return _engine(url.format(site=site))
+    if url.startswith("sqlite"):
+        raise ValueError(f"SQLite shard {shard} needs a {{site}} placeholder in its URL.")
+    return _engine(url).execution_options(schema_translate_map={None: _schema(site)})
+
+
+def add_site(site, shard):
+    """Create the site's tables on a shard, record it in the directory and create its initial admin."""
+    _create_tables(site, shard)
+    with _directory() as directory:
+        if directory.query(Site).get(site):
+            raise ValueError(f"Site {site} already exists.")
+        directory.add(Site(name=site, shard=shard, locked=False))
+        directory.commit()
+    from users import UserManagement
+    with UserManagement(site) as user_management:
+        user_management.create_initial_admin(generate_password_hash(
+            os.environ["ADMIN_PASSWORD"] if "ADMIN_PASSWORD" in os.environ else "admin"
+        ))
+
+
+def move_site(site, shard, settle_seconds=None):
+    """Copy a site's rows to another shard, repoint the directory and remove the old copy.
+
+    The site is locked (requests get a 503) while it is copied. We wait for every worker's cached routing to
+    expire before copying so nothing can still be writing to the old shard.
+    """
+    with _directory() as directory:
+        site_orm = directory.query(Site).get(site)
+        if not site_orm:
+            raise UnknownSiteException
+        if site_orm.shard == shard:
+            return
+        source = bind_for(site, site_orm.shard)
+        target = bind_for(site, shard)
+        site_orm.locked = True
+        directory.commit()
+        _session_makers.pop(site, None)
+        sleep(CACHE_SECONDS if settle_seconds is None else settle_seconds)
+        try:
+            _create_tables(site, shard)
+            _copy_rows(source, target)
+        except Exception:
+            site_orm.locked = False
+            directory.commit()
+            raise
+        site_orm.shard = shard
+        site_orm.locked = False
+        directory.commit()
+    _drop_tables(source)
+
+
+def qualified_name(connection, table):
+    """Raw SQL skips the schema translation used for sites on a shared shard, so apply it here."""
+    schema = connection.get_execution_options().get("schema_translate_map", {}).get(None)
+    name = '"' + table.name.replace('"', '""') + '"'
+    return f'"{schema}".{name}' if schema else name
+
+
+def list_sites():
+    with _directory(read_only=True) as directory:
+        return {site.name: site.shard for site in directory.query(Site)}
+
+
+def _copy_rows(source, target):
+    with source.connect() as source_connection, target.begin() as target_connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            target_connection.execute(table.delete())
+        for table in Base.metadata.sorted_tables:
+            result = source_connection.execute(select([table]))
+            while True:
+                rows = result.fetchmany(COPY_CHUNK_SIZE)
+                if not rows:
+                    break
+                target_connection.execute(table.insert(), [dict(row) for row in rows])
+        if target_connection.dialect.name == "postgresql":
+            _reset_sequences(target_connection)
+
+
+def _reset_sequences(connection):
+    """Copied rows keep their ids without drawing them from the serial sequences, so move those past the ids."""
+    for table in Base.metadata.sorted_tables:
+        columns = list(table.primary_key)
+        if len(columns) != 1 or not isinstance(columns[0].type, Integer):
+            continue
+        name = qualified_name(connection, table)
+        column = '"' + columns[0].name.replace('"', '""') + '"'
+        connection.execute(
+            text(f"SELECT setval(pg_get_serial_sequence(:table, :column), coalesce(max({column}), 0) + 1, false) "
+                 f"FROM {name}"),
+            table=name, column=columns[0].name,
+        )
+
+
+def _create_tables(site, shard):
+    bind = bind_for(site, shard)
+    if "{site}" not in SHARDS[shard]:
+        bind.execute(f'CREATE SCHEMA IF NOT EXISTS "{_schema(site)}"')
+    Base.metadata.create_all(bind)
+
+
+def _drop_tables(bind):
+    Base.metadata.drop_all(bind)
+
+
+def _schema(site):
+    return f"site_{site}"
+
+
+def _engine(url):
+    if url not in _engines:
+        _engines[url] = database.make_engine(url)
+    return _engines[url]
+
+
+def dispose_engines():
+    """Close pooled shard connections. Call before forking so worker processes don't share connections."""
+    for shard_engine in _engines.values():
+        shard_engine.dispose()
+
+
+def _directory_get(site):
+    with _directory(read_only=True) as directory:
+        return directory.query(Site).get(site)
+
+
+class _directory:
+    """The site directory lives in the default database. Read-only lookups don't take SQLite's write lock."""
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+
+    def __enter__(self):
+        bind = database.read_engine if self.read_only else database.engine
+        self.db_session = DBSession(bind=bind, expire_on_commit=False)
+        return self.db_session
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.db_session.close()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "add":
+        add_site(sys.argv[2], sys.argv[3])
+    elif command == "move":
+        move_site(sys.argv[2], sys.argv[3])
+    else:
+        print(json.dumps(list_sites(), indent=2))
@@ -0,0 +1,153 @@
+"""Slow query log.
+
+Statements slower than SLOW_QUERY_SECONDS (default 0.5, 0 turns the log off) are grouped by their normalised SQL
+(literals, and lists of values after IN, replaced by "?"). The first time a statement is slow its EXPLAIN (EXPLAIN QUERY PLAN on SQLite) is
+captured and a JSON line is appended to SLOW_QUERY_LOG (default "slow_queries.log") with the route it came from and
+its parameters, redacted to their types. Every slow run adds to the statement's count and times, reported by
+GET /slow-queries. At most SLOW_QUERY_STATEMENTS (default 1000) statements are kept; slow runs of statements beyond
+those are only counted in /metrics.
+"""
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from time import perf_counter
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+THRESHOLD_SECONDS = float(os.environ["SLOW_QUERY_SECONDS"]) if "SLOW_QUERY_SECONDS" in os.environ else 0.5
+LOG_PATH = os.environ["SLOW_QUERY_LOG"] if "SLOW_QUERY_LOG" in os.environ else "slow_queries.log"
+MAX_STATEMENTS = int(os.environ["SLOW_QUERY_STATEMENTS"]) if "SLOW_QUERY_STATEMENTS" in os.environ else 1000
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_whitespace = re.compile(r"\s+")
+_placeholder = r"(?:\?|%s|%\(\w+\)s|:\w+)"  # Parameter styles of SQLite and PostgreSQL drivers
+_in_list = re.compile(rf"\bIN ?\(\s*{_placeholder}(?:\s*,\s*{_placeholder})*\s*\)", re.IGNORECASE)
+_explainable = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+_statements = {}  # normalised SQL -> aggregate
+_lock = threading.Lock()
+_installed = False
+
+
+def install():
+    global _installed
+    if THRESHOLD_SECONDS <= 0 or _installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+    _installed = True
+
+
+def summary():
+    """Slow statements, slowest total time first."""
+    with _lock:
+        entries = [dict(aggregate, statement=statement) for statement, aggregate in _statements.items()]
+    return sorted(entries, key=lambda entry: entry["total_seconds"], reverse=True)
+
+
+def normalise(statement):
+    """One key for a statement whatever its literals, and however many values its IN lists have."""
+    statement = _whitespace.sub(" ", _literals.sub("?", statement)).strip()
+    return _in_list.sub("IN (?)", statement)
+
+
+def redact(parameters):
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) if isinstance(value, (list, tuple, dict)) else _redact_value(value)
+                for value in parameters]
+    return _redact_value(parameters)
+
+
+def _redact_value(value):
+    return None if value is None else f"<{type(value).__name__}>"
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's context rather than the pooled connection, so a statement that fails leaves nothing behind
+    context._slowlog_start = perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_slowlog_start", None)
+    if started is None:
+        return
+    seconds = perf_counter() - started
+    if seconds < THRESHOLD_SECONDS:
+        return
+    key = normalise(statement)
+    route = f"{request.method} {request.endpoint}" if has_request_context() else None
+    with _lock:
+        first = key not in _statements
+        if first and len(_statements) >= MAX_STATEMENTS:
+            metrics.increment("slow_statements_untracked")
+            return
+    # Explained before the aggregate is added, so /slow-queries never returns it without its plan
+    plan = _explain(conn, statement, parameters, executemany) if first else None
+    with _lock:
+        aggregate = _statements.get(key)
+        if aggregate is None:
+            if len(_statements) >= MAX_STATEMENTS:
+                metrics.increment("slow_statements_untracked")
+                return
+            aggregate = _statements[key] = {
+                "count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "routes": {}, "plan": plan,
+            }
+        else:
+            first = False  # Another thread added it meanwhile, and logs it
+        aggregate["count"] += 1
+        aggregate["total_seconds"] += seconds
+        aggregate["max_seconds"] = max(aggregate["max_seconds"], seconds)
+        aggregate["routes"][route or "-"] = aggregate["routes"].get(route or "-", 0) + 1
+    if first:
+        _write({
+            "time": datetime.utcnow().isoformat(),
+            "seconds": seconds,
+            "route": route,
+            "statement": key,
+            "parameters": redact(parameters),
+            "plan": plan,
+        })
+
+
+def _explain(conn, statement, parameters, executemany):
+    if executemany or not _explainable.match(statement):
+        return None
+    sqlite = conn.dialect.name == "sqlite"
+    cursor = conn.connection.cursor()
+    try:
+        if not sqlite:  # A failed EXPLAIN mustn't abort the request's transaction
+            cursor.execute("SAVEPOINT slowlog_explain")
+        try:
+            cursor.execute(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + statement, parameters)
+            plan = [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+        except Exception as e:
+            if not sqlite:
+                cursor.execute("ROLLBACK TO SAVEPOINT slowlog_explain")
+            return [f"EXPLAIN failed: {e}"]
+        if not sqlite:
+            cursor.execute("RELEASE SAVEPOINT slowlog_explain")
+        return plan
+    finally:
+        cursor.close()
+
+
+def _write(entry):
+    try:
+        with open(LOG_PATH, "a") as log_file:
+            log_file.write(json.dumps(entry) + "\n")
+    except OSError:
+        pass
+
+
+# For testing
+def reset():
+    with _lock:
+        _statements.clear()
@@ -0,0 +1,62 @@
+"""Reconciliation for the inventory counters behind GET /stats.
+
+    python stats.py rebuild [--site library]
+
+loans.py keeps the counters up to date as items are created, loaned, returned and deleted. Anything that changes
+loan items without going through it (bulk imports, manual SQL, restoring a backup) leaves them wrong, so this
+recounts them from the loan items and replaces them in one transaction.
+"""
+import argparse
+import json
+
+from sqlalchemy import func, select
+
+from database import InventoryCounter, LoanItem, LoanItemTag
+from loans import ITEMS, LOANED, LOANED_TO, TAGGED, TAG_LOANED
+from shards import qualified_name, session_for
+
+
+def rebuild(site=None):
+    """Recount the site's counters from its loan items. Returns the new counter values by name."""
+    counters = InventoryCounter.__table__
+    items = LoanItem.__table__
+    tags = LoanItemTag.__table__
+    session = session_for(site)
+    try:
+        connection = session.connection()
+        # Hold off loan item writes until the new counters are committed, so none are counted twice or missed.
+        # On SQLite deleting the counters first takes the database's write lock.
+        if connection.dialect.name == "postgresql":
+            connection.execute(f"LOCK TABLE {qualified_name(connection, items)}, {qualified_name(connection, tags)} "
+                               "IN SHARE MODE")
+        connection.execute(counters.delete())
+        values = {
+            ITEMS: connection.execute(select([func.count()]).select_from(items)).scalar(),
+            LOANED: connection.execute(
+                select([func.count()]).select_from(items).where(items.c.loanedto.isnot(None))
+            ).scalar(),
+        }
+        per_user = connection.execute(
+            select([items.c.loanedto, func.count()]).where(items.c.loanedto.isnot(None)).group_by(items.c.loanedto)
+        )
+        values.update({LOANED_TO + username: count for username, count in per_user})
+        per_tag = connection.execute(select([tags.c.tag, func.count()]).group_by(tags.c.tag))
+        values.update({TAGGED + tag: count for tag, count in per_tag})
+        loaned_per_tag = connection.execute(
+            select([tags.c.tag, func.count()]).select_from(tags.join(items, tags.c.item_id == items.c.id))
+            .where(items.c.loanedto.isnot(None)).group_by(tags.c.tag)
+        )
+        values.update({TAG_LOANED + tag: count for tag, count in loaned_per_tag})
+        connection.execute(counters.insert(), [{"name": name, "value": value} for name, value in values.items()])
+        session.commit()
+        return values
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inventory counter maintenance.")
+    parser.add_argument("action", choices=["rebuild"])
+    parser.add_argument("--site", default=None)
+    args = parser.parse_args()
+    print(json.dumps(rebuild(args.site), indent=2))
@@ -0,0 +1,104 @@
+import threading
+import unittest
+from time import monotonic, sleep
+
+import admission
+import app
+import metrics
+from admission import HIGH, LOW, NORMAL, Controller
+
+LIST = "GET /loan-items"
+LOAN = "PUT /loan-items/<item_id>"
+MODE = "GET /mode"
+
+
+class TestController(unittest.TestCase):
+    def admit_later(self, controller, route, priority, admitted=None):
+        """Start waiting for a slot from another thread. Join the returned thread for its result."""
+        waiting = set(controller._waiting)
+
+        def wait():
+            thread.shed = controller.admit(route, priority, 5.0)
+            if admitted is not None:
+                admitted.append((route, priority))
+        thread = threading.Thread(target=wait)
+        thread.start()
+        while not set(controller._waiting) - waiting and thread.is_alive():
+            sleep(0.001)
+        return thread
+
+    def test_limits(self):
+        controller = Controller(3, 10, {LIST: 1})
+        self.assertIsNone(controller.admit(LIST, LOW, 0))
+        self.assertEqual("timeout", controller.admit(LIST, LOW, 0.01))  # Its route is full
+        self.assertIsNone(controller.admit(MODE, NORMAL, 0))
+        self.assertIsNone(controller.admit(LOAN, HIGH, 0))
+        self.assertEqual("timeout", controller.admit(LOAN, HIGH, 0.01))  # Everything is full
+        self.assertEqual({"running": 3, "waiting": 0}, controller.status())
+
+    def test_freed_slots_go_to_higher_priorities_first(self):
+        controller = Controller(1, 10, {})
+        controller.admit(MODE, NORMAL, 0)
+        admitted = []
+        waiting = [self.admit_later(controller, route, priority, admitted)
+                   for route, priority in ((LIST, LOW), (MODE, NORMAL), (LOAN, HIGH), (MODE, NORMAL))]
+        route = MODE
+        for count in range(1, len(waiting) + 1):
+            controller.release(route)
+            while len(admitted) < count:
+                sleep(0.001)
+            route = admitted[-1][0]
+        self.assertEqual([(LOAN, HIGH), (MODE, NORMAL), (MODE, NORMAL), (LIST, LOW)], admitted)
+        self.assertEqual([None] * len(waiting), [thread.shed for thread in waiting])
+
+    def test_a_full_queue_pushes_out_lower_priorities(self):
+        controller = Controller(1, 2, {})
+        controller.admit(MODE, NORMAL, 0)
+        low = self.admit_later(controller, LIST, LOW)
+        normal = self.admit_later(controller, MODE, NORMAL)
+        self.assertEqual("queue_full", controller.admit(LIST, LOW, 5))
+        high = self.admit_later(controller, LOAN, HIGH)
+        low.join()
+        self.assertEqual("pushed_out", low.shed)
+        controller.release(MODE)
+        high.join()
+        self.assertIsNone(high.shed)
+        self.assertTrue(normal.is_alive())
+        controller.release(LOAN)
+        normal.join()
+        self.assertIsNone(normal.shed)
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self) -> None:
+        self.old_controller = admission.controller
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        self.token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+        metrics.reset()
+
+    def tearDown(self):
+        admission.controller = self.old_controller
+
+    def test_requests_are_released(self):
+        for _ in range(20):
+            self.assertEqual(200, self.client.get("/mode", headers={"access-token": self.token}).status_code)
+        self.assertEqual({"running": 0, "waiting": 0}, admission.controller.status())
+
+    def test_overload_is_shed_quickly(self):
+        admission.controller = Controller(1, 10, {})
+        admission.controller.admit(LOAN, HIGH, 0)  # A request that is still running
+        start = monotonic()
+        response = self.client.get("/loan-items", headers={"access-token": self.token})
+        self.assertLess(monotonic() - start, 1)
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("1", response.headers["Retry-After"])
+        self.assertEqual({"error": "Server busy."}, response.json)
+        counters = metrics.snapshot()
+        self.assertEqual((1, 1, 1), (counters["admission_shed"], counters["admission_shed_timeout"],
+                                     counters["admission_shed_low"]))
+
+        admission.controller.release(LOAN)
+        response = self.client.get("/metrics", headers={"access-token": self.token})
+        self.assertEqual({"running": 1, "waiting": 0}, response.json["admission"])  # Just the metrics request
@@ -1,5 +1,6 @@
 from flask_testing import TestCase
 import app
+import modes
 
 
 class TestLoanItemApi(TestCase):
@@ -167,6 +168,29 @@ class TestLoanItemApi(TestCase):
         self.assertEqual(200, code, body.get("error", ""))
         self.assertEqual(expected, body["loan-items"])
 
+    def test_lookup_by_ids(self):
+        self.post("/loan-items", admin, {"id": "01", "description": "wheelbarrow"})
+        self.post("/loan-items", admin, {"id": "02", "description": "drill"})
+        expected = {
+            "loan-items": [
+                {"id": "02", "loanedto": None, "description": "drill"},
+                {"id": "01", "loanedto": None, "description": "wheelbarrow"},
+            ],
+            "missing": ["99"],
+        }
+        body, code = self.get("/loan-items?ids=02,99,01,02", admin)
+        self.assertEqual(200, code, body.get("error", ""))
+        self.assertEqual(expected, body)
+
+        body, code = self.post("/loan-items/lookup", admin, {"ids": ["02", "99", "01"]})
+        self.assertEqual(200, code, body.get("error", ""))
+        self.assertEqual(expected, body)
+
+        body, code = self.get("/loan-items?ids=01&limit=5", admin)
+        self.assertEqual(400, code)
+        body, code = self.post("/loan-items/lookup", admin, {"ids": [str(i) for i in range(501)]})
+        self.assertEqual(400, code)
+
     def test_loaning(self):
         self.post("/loan-items", admin, {"id": "01", "description": "wheelbarrow"})
         self.post("/loan-items", admin, {"id": "02", "description": "drill"})
@@ -243,8 +267,10 @@ class TestLoanItemApi(TestCase):
 
     def test_change_mode(self):
         body, code = self.put("/mode", admin, {"mode": "self-service"})
+        self.addCleanup(modes.set_mode, modes.ADMIN_OPERATED)
         self.assertEqual(200, code)
         self.assertEqual({"mode": "self-service"}, body)
+        self.assertEqual("self-service", modes.get_mode())  # Stored, so every worker process sees it
 
         body, code = self.get("/mode", admin)
         self.assertEqual(200, code)
@@ -260,6 +286,37 @@ class TestLoanItemApi(TestCase):
         body, code = self.put("/loan-items/11", bob, {"loanedto": "bob"})
         self.assertEqual(403, code)
 
+    def test_holds(self):
+        self.post("/loan-items", admin, {"id": "12", "description": "cement mixer"})
+        body, code = self.post("/loan-items/12/holds", bob)
+        self.assertEqual(400, code)  # Available, so it can be loaned straight away
+        self.put("/loan-items/12", admin, {"loanedto": "admin"})
+
+        body, code = self.post("/loan-items/12/holds", bob)
+        self.assertEqual(200, code)
+        self.assertEqual({"hold": {"id": "12", "position": 1}}, body)
+        body, code = self.post("/loan-items/12/holds", bob)
+        self.assertEqual(400, code)
+        self.assertEqual({"error": "Invalid request."}, body)
+        body, code = self.get("/holds", bob)
+        self.assertEqual(200, code)
+        self.assertEqual({"holds": [{"id": "12", "position": 1}]}, body)
+
+        body, code = self.delete("/loan-items/12/holds", bob)
+        self.assertEqual(200, code)
+        body, code = self.delete("/loan-items/12/holds", bob)
+        self.assertEqual(404, code)
+        self.assertEqual({"error": "Hold not found."}, body)
+        body, code = self.delete("/loan-items/99/holds", bob)
+        self.assertEqual(404, code)
+
+        self.post("/loan-items/12/holds", bob)
+        body, code = self.put("/loan-items/12", admin, {"loanedto": None})
+        self.assertEqual(200, code)
+        self.assertEqual("bob", body["loan-item"]["loanedto"])  # Went straight to the first in the queue
+        body, code = self.get("/holds", bob)
+        self.assertEqual({"holds": []}, body)
+
     def setUp(self) -> None:
         self.bob_token = None
         self.admin_token = None
@@ -339,7 +396,9 @@ class TestLoanItemApi(TestCase):
         return response.json, response.status_code
 
     def create_app(self):
-        return app.app
+        flask_app = app.create_app()
+        flask_app.config["RATE_LIMIT"] = False
+        return flask_app
 
     def make_loan_item(self, item_id, description):
         return { "id": item_id, "description": description}
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+import bulk
+import database
+from database import LoanItem
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        database.recreate_db()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w") as out_file:
+            out_file.write(text)
+        return path
+
+    def descriptions(self):
+        session = database.get_db_session()
+        descriptions = sorted(item.description for item in session.query(LoanItem))
+        session.close()
+        return descriptions
+
+    def test_import_csv_and_export_jsonl(self):
+        path = self.write("items.csv", "id,description,loanedto\n1,drill,\n2,saw,\n3,ladder,\n")
+        self.assertEqual(3, bulk.import_rows("loan-items", path, chunk_size=2))
+        self.assertEqual(["drill", "ladder", "saw"], self.descriptions())
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+        out_path = os.path.join(self.tmp_dir.name, "out.jsonl")
+        progress = []
+        self.assertEqual(3, bulk.export_rows("loan-items", out_path, chunk_size=2,
+                                             progress=lambda action, count: progress.append(count)))
+        self.assertEqual([2, 3], progress)
+        with open(out_path) as in_file:
+            self.assertEqual(3, len(in_file.readlines()))
+
+    def test_resume_interrupted_import(self):
+        path = self.write("items.jsonl", "".join(
+            f'{{"id": "{i}", "description": "item {i}", "loanedto": null}}\n' for i in range(5)
+        ))
+        # Pretend the first chunk (and part of the second) was committed before the import was interrupted
+        bulk.import_rows("loan-items", self.write("first.jsonl", open(path).readlines()[0]))
+        self.write("items.jsonl.progress", "1")
+        self.assertEqual(5, bulk.import_rows("loan-items", path, chunk_size=2))
+        self.assertEqual(5, len(self.descriptions()))
+
+        # Re-importing the whole file leaves existing rows alone
+        self.assertEqual(5, bulk.import_rows("loan-items", path, chunk_size=2))
+        self.assertEqual(5, len(self.descriptions()))
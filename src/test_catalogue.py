@@ -0,0 +1,109 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from time import sleep
+
+import app
+import catalogue
+import database
+
+
+class TestCatalogue(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_settings = catalogue.DIRECTORY, catalogue.REFRESH_SECONDS, catalogue.KEEP
+        catalogue.DIRECTORY = self.tmp_dir.name
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+        self.headers = {"access-token": token}
+        for i in range(3):
+            self.client.post("/loan-items", json={"id": f"0{i}", "description": f"drill {i}"}, headers=self.headers)
+        self.client.put("/loan-items/01", json={"loanedto": "admin"}, headers=self.headers)
+
+    def tearDown(self):
+        catalogue.DIRECTORY, catalogue.REFRESH_SECONDS, catalogue.KEEP = self.old_settings
+        self.tmp_dir.cleanup()
+        database.recreate_db()
+
+    def download(self, version, **headers):
+        return self.client.get(f"/catalogue/{version}", headers=dict(self.headers, **headers))
+
+    def test_snapshot(self):
+        response = self.client.get("/catalogue", headers=self.headers)
+        self.assertEqual(200, response.status_code)
+        details = response.json["catalogue"]
+        self.assertEqual(3, details["items"])
+
+        response = self.download(details["version"])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/gzip", response.content_type)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(details["bytes"], len(response.data))
+        self.assertEqual({
+            "columns": ["id", "description", "available"],
+            "rows": [["00", "drill 0", True], ["01", "drill 1", False], ["02", "drill 2", True]],
+        }, json.loads(gzip.decompress(response.data)))
+
+        self.assertEqual(304, self.download(details["version"], **{"If-None-Match": response.headers["ETag"]})
+                         .status_code)
+        self.assertEqual(404, self.download("0123456789abcdef").status_code)
+        self.assertEqual(404, self.download("..").status_code)
+        self.assertNotEqual(200, self.client.get(f"/catalogue/{details['version']}").status_code)  # No token
+
+    def test_ranges(self):
+        version = self.client.get("/catalogue", headers=self.headers).json["catalogue"]["version"]
+        whole = self.download(version).data
+        catalogue.CHUNK_SIZE = 7
+        self.addCleanup(setattr, catalogue, "CHUNK_SIZE", 64 * 1024)
+
+        response = self.download(version, Range="bytes=10-")
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(f"bytes 10-{len(whole) - 1}/{len(whole)}", response.headers["Content-Range"])
+        self.assertEqual(whole[10:], response.data)
+        self.assertEqual(whole[:10], self.download(version, Range="bytes=0-9").data)
+        self.assertEqual(whole[-5:], self.download(version, Range="bytes=-5").data)
+
+        response = self.download(version, Range=f"bytes={len(whole)}-")
+        self.assertEqual(416, response.status_code)
+        self.assertEqual(f"bytes */{len(whole)}", response.headers["Content-Range"])
+        # A range of an older version gets the whole of this one
+        self.assertEqual(200, self.download(version, Range="bytes=10-", **{"If-Range": '"1234"'}).status_code)
+        self.assertEqual(206, self.download(version, Range="bytes=10-", **{"If-Range": f'"{version}"'}).status_code)
+
+    def test_a_stale_snapshot_is_rebuilt(self):
+        first = self.client.get("/catalogue", headers=self.headers).json["catalogue"]
+        self.client.put("/loan-items/01", json={"loanedto": None}, headers=self.headers)
+        self.assertEqual(first, self.client.get("/catalogue", headers=self.headers).json["catalogue"])
+
+        catalogue.REFRESH_SECONDS = 0.01
+        sleep(0.02)
+        self.client.get("/catalogue", headers=self.headers)  # Rebuilds in the background
+        for _ in range(500):
+            second = self.client.get("/catalogue", headers=self.headers).json["catalogue"]
+            if second["version"] != first["version"]:
+                break
+            sleep(0.01)
+        self.assertNotEqual(first["version"], second["version"])
+        while catalogue._refreshing:
+            sleep(0.01)
+        rows = json.loads(gzip.decompress(self.download(second["version"]).data))["rows"]
+        self.assertTrue(all(available for _, _, available in rows))
+        self.assertEqual(200, self.download(first["version"]).status_code)  # Kept for downloads that started on it
+
+    def test_unchanged_catalogue_keeps_its_version(self):
+        first = catalogue.build()
+        self.assertEqual(first["version"], catalogue.build()["version"])
+
+    def test_old_snapshots_are_removed(self):
+        catalogue.KEEP = 2
+        versions = []
+        for i in range(4):
+            self.client.post("/loan-items", json={"id": f"1{i}", "description": "saw"}, headers=self.headers)
+            versions.append(catalogue.build()["version"])
+        self.assertEqual(sorted(f"default-{version}.json.gz" for version in versions[-2:]),
+                         sorted(name for name in os.listdir(self.tmp_dir.name) if name.endswith(".gz")))
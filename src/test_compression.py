@@ -0,0 +1,57 @@
+import gzip
+import json
+import unittest
+import zlib
+
+from flask import Flask, Response
+
+import app
+import compression
+import metrics
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+        self.headers = {"access-token": token}
+        for i in range(30):
+            self.client.post("/loan-items", json={"id": f"c{i}", "description": "cordless drill"}, headers=self.headers)
+
+    def tearDown(self):
+        for i in range(30):
+            self.client.delete(f"/loan-items/c{i}", headers=self.headers)
+
+    def test_choose_encoding(self):
+        self.assertEqual("gzip", compression.choose_encoding("gzip, deflate"))
+        self.assertEqual("deflate", compression.choose_encoding("gzip;q=0.5, deflate"))
+        self.assertEqual("deflate", compression.choose_encoding("gzip;q=0, deflate"))
+        self.assertIsNone(compression.choose_encoding("identity"))
+        self.assertIsNone(compression.choose_encoding(""))
+
+    def test_large_list_is_compressed(self):
+        metrics.reset()
+        response = self.client.get("/loan-items", headers={"Accept-Encoding": "gzip", **self.headers})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        body = json.loads(gzip.decompress(response.data))
+        self.assertEqual(30, len([item for item in body["loan-items"] if item["id"].startswith("c")]))
+        self.assertGreater(metrics.snapshot()["compression_bytes_saved"], 0)
+
+        # The same payload again comes from the cache
+        self.client.get("/loan-items", headers={"Accept-Encoding": "gzip", **self.headers})
+        self.assertEqual(1, metrics.snapshot()["compression_cache_hits"])
+
+    def test_small_body_is_not_compressed(self):
+        response = self.client.get("/loan-items/c1", headers={"Accept-Encoding": "gzip", **self.headers})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_streamed_response(self):
+        stream_app = Flask(__name__)
+        stream_app.after_request(compression.compress_response)
+        stream_app.route("/stream")(lambda: Response(("chunk %d\n" % i for i in range(100))))
+        response = stream_app.test_client().get("/stream", headers={"Accept-Encoding": "deflate"})
+        self.assertEqual("deflate", response.headers["Content-Encoding"])
+        self.assertEqual("".join("chunk %d\n" % i for i in range(100)), zlib.decompress(response.data).decode())
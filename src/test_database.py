@@ -0,0 +1,108 @@
+import os
+import tempfile
+import threading
+import unittest
+from time import sleep
+
+from sqlalchemy.orm import sessionmaker
+
+import database
+
+
+class TestMemoryDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.engine = database.make_engine("sqlite://")
+        self.engine.execute("CREATE TABLE item (id TEXT PRIMARY KEY)")
+        self.Session = sessionmaker(bind=self.engine)
+
+    def insert(self, item_id, hold_seconds=0.0, commit=True):
+        session = self.Session()
+        session.execute("INSERT INTO item VALUES (:id)", {"id": item_id})
+        sleep(hold_seconds)
+        if commit:
+            session.commit()
+        session.close()
+
+    def ids(self):
+        session = self.Session()
+        ids = sorted(item_id for item_id, in session.execute("SELECT id FROM item"))
+        session.close()
+        return ids
+
+    def test_threads_share_the_database(self):
+        thread = threading.Thread(target=self.insert, args=("1",))
+        thread.start()
+        thread.join()
+        self.assertEqual(["1"], self.ids())
+
+    def test_threads_dont_see_each_others_transactions(self):
+        thread = threading.Thread(target=self.insert, args=("1", 0.3, False))
+        thread.start()
+        sleep(0.1)
+        self.assertEqual([], self.ids())  # Waits for the other thread's transaction to end instead of reading it
+        thread.join()
+
+    def test_snapshot_and_restore(self):
+        self.insert("1")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "snapshot.db")
+            self.engine.memory_database.snapshot(path)
+            restored = database.make_engine("sqlite://")
+            restored.memory_database.restore(path)
+            self.assertEqual([("1",)], restored.execute("SELECT id FROM item").fetchall())
+
+
+class TestSqliteFile(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.engine = database.make_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'loans.db')}")
+        self.engine.execute("CREATE TABLE item (id TEXT PRIMARY KEY)")
+        self.Session = sessionmaker(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_every_connection_is_tuned(self):
+        connections = [self.engine.connect() for _ in range(2)]
+        for connection in connections:
+            self.assertEqual("wal", connection.scalar("PRAGMA journal_mode"))
+            self.assertEqual(1, connection.scalar("PRAGMA foreign_keys"))
+            self.assertEqual(database.SQLITE_BUSY_TIMEOUT_MS, connection.scalar("PRAGMA busy_timeout"))
+            self.assertEqual(1, connection.scalar("PRAGMA synchronous"))  # NORMAL
+        for connection in connections:
+            connection.close()
+
+    def test_writers_queue_for_the_write_lock(self):
+        errors = []
+
+        def read_then_write(item_id):
+            session = self.Session()
+            try:
+                session.execute("SELECT count(*) FROM item").scalar()
+                sleep(0.2)
+                session.execute("INSERT INTO item VALUES (:id)", {"id": item_id})
+                session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.close()
+
+        threads = [threading.Thread(target=read_then_write, args=(str(i),)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(3, self.engine.scalar("SELECT count(*) FROM item"))
+
+    def test_readers_dont_wait_for_writers(self):
+        writer = self.Session()
+        writer.execute("INSERT INTO item VALUES ('1')")
+        reader = sessionmaker(bind=database.read_only(self.engine))()
+        self.assertEqual([], reader.execute("SELECT id FROM item").fetchall())
+        writer.commit()
+        reader.rollback()
+        self.assertEqual([("1",)], reader.execute("SELECT id FROM item").fetchall())
+        reader.close()
+        writer.close()
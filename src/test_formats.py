@@ -0,0 +1,74 @@
+import json
+import unittest
+
+import app
+import database
+import formats
+
+
+class TestFormats(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+        self.headers = {"access-token": token}
+        for i in range(3):
+            self.client.post("/loan-items", json={"id": f"f{i}", "description": "spade"}, headers=self.headers)
+
+    def tearDown(self):
+        database.recreate_db()
+        app.create_admin_user()
+
+    def get_items(self, accept):
+        return self.client.get("/loan-items", headers={"Accept": accept, **self.headers})
+
+    def test_choose_format(self):
+        self.assertEqual((formats.JSON, None), formats.choose_format(""))
+        self.assertEqual((formats.JSON, None), formats.choose_format("*/*"))
+        self.assertEqual((formats.JSON, None), formats.choose_format("text/html, application/xml"))
+        self.assertEqual((formats.JSON, "rows"), formats.choose_format("application/json; layout=rows"))
+        if formats.msgpack:
+            self.assertEqual(("application/msgpack", None),
+                             formats.choose_format("application/json;q=0.5, application/msgpack"))
+            self.assertEqual((formats.JSON, None), formats.choose_format("application/json, application/msgpack;q=0"))
+
+    def test_to_rows(self):
+        self.assertEqual(
+            {"items": {"columns": ["id", "loanedto"], "rows": [["1", None], ["2", "bob"]]}, "missing": ["3"]},
+            formats.to_rows({"items": [{"id": "1", "loanedto": None}, {"id": "2", "loanedto": "bob"}],
+                             "missing": ["3"]}),
+        )
+        # Lists of objects with different keys, and empty lists, stay as they are
+        self.assertEqual([{"id": "1"}, {"name": "x"}], formats.to_rows([{"id": "1"}, {"name": "x"}]))
+        self.assertEqual({"items": []}, formats.to_rows({"items": []}))
+
+    def test_json_is_the_default(self):
+        response = self.get_items("*/*")
+        self.assertEqual("application/json", response.mimetype)
+        self.assertIn("Accept", response.headers["Vary"])
+        self.assertEqual(3, len(response.json["loan-items"]))
+
+    def test_json_rows(self):
+        response = self.get_items("application/json; layout=rows")
+        self.assertEqual("application/json; layout=rows", response.headers["Content-Type"])
+        loan_items = json.loads(response.data)["loan-items"]
+        self.assertEqual(["f0", "f1", "f2"], [row[loan_items["columns"].index("id")] for row in loan_items["rows"]])
+
+    @unittest.skipUnless(formats.msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.get_items("application/msgpack")
+        self.assertEqual("application/msgpack", response.mimetype)
+        self.assertEqual(self.get_items("application/json").json, formats.msgpack.unpackb(response.data))
+
+        error = self.client.get("/loan-items/missing", headers={"Accept": "application/msgpack", **self.headers})
+        self.assertEqual(404, error.status_code)
+        self.assertEqual({"error": "Loan not found."}, formats.msgpack.unpackb(error.data))
+
+    @unittest.skipUnless(formats.cbor2, "cbor2 is not installed")
+    def test_cbor_rows(self):
+        response = self.get_items("application/cbor; layout=rows")
+        self.assertEqual("application/cbor; layout=rows", response.headers["Content-Type"])
+        loan_items = formats.cbor2.loads(response.data)["loan-items"]
+        self.assertEqual(self.get_items("application/json").json["loan-items"],
+                         [dict(zip(loan_items["columns"], row)) for row in loan_items["rows"]])
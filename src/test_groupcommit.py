@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+import database
+import groupcommit
+import metrics
+import modes
+from database import LoanItem, User
+from exceptions import NotAllowedException, UnknownUserException
+from loans import Loans
+
+KIOSKS = 8
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.old_settings = groupcommit.WAIT_MS, groupcommit.MAX_BATCH
+        groupcommit.WAIT_MS = 100  # Long enough for every kiosk's change to join the first batch
+        db_session = database.get_db_session()
+        db_session.add_all(User(username=f"user{i}", role="regular", phone="+441234567890") for i in range(KIOSKS))
+        db_session.commit()
+        loans = Loans(db_session)
+        loans.set_user_session("admin", "admin", "+441234567890")
+        for i in range(KIOSKS):
+            loans.create(str(i), "drill")
+        db_session.close()
+        metrics.reset()
+
+    def tearDown(self):
+        groupcommit.WAIT_MS, groupcommit.MAX_BATCH = self.old_settings
+        database.recreate_db()
+
+    def run_kiosks(self, changes):
+        """Run each (username, role, item id, loaned to) change from its own thread at once."""
+        results = [None] * len(changes)
+        start = threading.Barrier(len(changes))
+
+        def kiosk(position, username, role, item_id, loaned_to):
+            db_session = database.get_db_session()
+            try:
+                loans = Loans(db_session)
+                loans.set_user_session(username, role, "+441234567890")
+                start.wait()
+                results[position] = loans.update_loan(item_id, loaned_to)
+            except Exception as e:
+                results[position] = e
+            finally:
+                db_session.close()
+
+        threads = [threading.Thread(target=kiosk, args=(position, *change)) for position, change in enumerate(changes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def loaned_to(self):
+        db_session = database.get_db_session()
+        try:
+            return dict(db_session.query(LoanItem.id, LoanItem.loanedto))
+        finally:
+            db_session.close()
+
+    def test_changes_share_a_commit_but_not_their_errors(self):
+        last = str(KIOSKS - 1)
+        self.run_kiosks([("admin", "admin", last, "user0")])
+        modes.set_mode(modes.SELF_SERVICE)
+        self.addCleanup(modes.set_mode, modes.ADMIN_OPERATED)
+        metrics.reset()
+        changes = [(f"user{i}", "regular", str(i), f"user{i}") for i in range(KIOSKS - 2)]
+        changes.append(("admin", "admin", str(KIOSKS - 2), "nobody"))  # Unknown user
+        changes.append(("user1", "regular", last, "user1"))  # Already loaned, so not allowed
+        results = self.run_kiosks(changes)
+
+        for i, result in enumerate(results[:KIOSKS - 2]):
+            self.assertEqual({"id": str(i), "description": "drill", "loanedto": f"user{i}"}, result)
+        self.assertIsInstance(results[-2], UnknownUserException)
+        self.assertIsInstance(results[-1], NotAllowedException)
+        loaned = self.loaned_to()
+        self.assertEqual(dict({str(i): f"user{i}" for i in range(KIOSKS - 2)}, **{last: "user0"}),
+                         {item_id: user for item_id, user in loaned.items() if user})
+        self.assertLess(metrics.snapshot()["group_commit_batches"], len(changes))
+        self.assertEqual(len(changes), metrics.snapshot()["group_commit_changes"])
+
+        db_session = database.get_db_session()
+        loans = Loans(db_session)
+        loans.set_user_session("admin", "admin", "+441234567890")
+        self.assertEqual(KIOSKS - 1, loans.read_stats()["loaned"])  # Counters of the failed changes rolled back
+        db_session.close()
+
+    def test_batches_are_limited(self):
+        groupcommit.MAX_BATCH = 2
+        results = self.run_kiosks([("admin", "admin", str(i), f"user{i}") for i in range(KIOSKS)])
+        self.assertEqual([f"user{i}" for i in range(KIOSKS)], [result["loanedto"] for result in results])
+        self.assertGreaterEqual(metrics.snapshot()["group_commit_batches"], KIOSKS / 2)
+
+    def test_failed_change_on_its_own(self):
+        self.assertRaises(ZeroDivisionError, groupcommit.submit, None, lambda db_session: 1 / 0)
+        self.assertEqual(3, groupcommit.submit(None, lambda db_session: 3))
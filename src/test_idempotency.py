@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+import unittest
+from time import sleep
+
+from flask import Flask, jsonify
+
+import app
+import database
+import idempotency
+
+
+class TestStores(unittest.TestCase):
+    def check_store(self, store):
+        response = (200, [("Content-Type", "application/json")], b'{"ok": true}')
+        self.assertEqual((idempotency.CLAIMED, None), store.claim("k", "request", now=100))
+        self.assertEqual((idempotency.IN_PROGRESS, None), store.claim("k", "request", now=101))
+        self.assertEqual(idempotency.MISMATCH, store.claim("k", "other request", now=101)[0])
+        store.save("k", "request", response, ttl=10, now=102)
+        state, stored = store.claim("k", "request", now=103)
+        self.assertEqual(idempotency.DONE, state)
+        self.assertEqual(response, (stored[0], [tuple(header) for header in stored[1]], stored[2]))
+        self.assertEqual(idempotency.CLAIMED, store.claim("k", "request", now=113)[0])  # Expired
+        store.release("k")
+        self.assertEqual(idempotency.CLAIMED, store.claim("k", "other request", now=114)[0])
+
+    def test_memory_store(self):
+        self.check_store(idempotency.MemoryStore())
+
+    def test_memory_store_is_bounded(self):
+        store = idempotency.MemoryStore()
+        store.MAX_KEYS = 3
+        for key in "abcd":
+            store.claim(key, "request", now=100)
+        self.assertEqual(idempotency.CLAIMED, store.claim("a", "request", now=100)[0])  # Evicted
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.check_store(idempotency.make_store(f"sqlite:///{os.path.join(tmp_dir, 'idempotency.db')}"))
+
+
+class TestIdempotentRoutes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.old_store = idempotency.store
+        idempotency.store = idempotency.MemoryStore()
+        database.recreate_db()
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        idempotency.store = self.old_store
+        database.recreate_db()
+        app.create_admin_user()
+
+    def test_retried_registration_is_replayed(self):
+        user = {"username": "bob", "password": "password", "phone": "+441234567890"}
+        headers = {"Idempotency-Key": "kiosk-1-42"}
+        first = self.client.post("/users", json=user, headers=headers)
+        retry = self.client.post("/users", json=user, headers=headers)
+        self.assertEqual(200, retry.status_code)
+        self.assertEqual(first.json, retry.json)
+        self.assertEqual("true", retry.headers["Idempotent-Replayed"])
+
+        # Without the key it's a new request
+        self.assertEqual({"error": "User already exists."}, self.client.post("/users", json=user).json)
+        # The same key can't be used for another request
+        response = self.client.post("/users", json=dict(user, username="carol"), headers=headers)
+        self.assertEqual(422, response.status_code)
+
+    def test_concurrent_duplicates_wait_for_the_first(self):
+        calls = []
+        test_app = Flask(__name__)
+
+        @test_app.route("/slow", methods=["POST"])
+        @idempotency.idempotent
+        def slow():
+            calls.append(1)
+            sleep(0.3)
+            return jsonify({"call": len(calls)})
+
+        responses = []
+
+        def post():
+            responses.append(test_app.test_client().post("/slow", headers={"Idempotency-Key": "same"}).json)
+
+        threads = [threading.Thread(target=post) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{"call": 1}] * 3, responses)
@@ -0,0 +1,67 @@
+import unittest
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Column, MetaData, Table, create_engine, select
+from sqlalchemy.dialects import postgresql
+
+import database
+import item_ids
+from database import ItemId
+
+DRILL = "0b8a3f0e-5c1d-4c52-9a77-2f0d5c6e8f10"
+
+
+class TestItemId(unittest.TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine("sqlite://")
+        self.items = Table("item", MetaData(), Column("id", ItemId(uuids=True), primary_key=True))
+        self.items.create(self.engine)
+
+    def test_uuids_are_stored_in_16_bytes(self):
+        self.engine.execute(self.items.insert(), [{"id": DRILL.upper()}, {"id": "drill-7"}])
+        self.assertEqual([("blob", 16), ("text", 7)],
+                         self.engine.execute("SELECT typeof(id), length(id) FROM item ORDER BY 1").fetchall())
+        self.assertEqual({DRILL, "drill-7"}, {item_id for item_id, in self.engine.execute(select([self.items]))})
+        braces = "{" + DRILL + "}"
+        self.assertEqual(DRILL, self.engine.execute(select([self.items]).where(self.items.c.id == braces)).scalar())
+
+    def test_clean(self):
+        item_id = ItemId(uuids=True)
+        self.assertEqual(DRILL, item_id.clean(DRILL.replace("-", "").upper(), self.engine.dialect))
+        self.assertEqual("drill-7", item_id.clean("drill-7", self.engine.dialect))
+        self.assertIsNone(item_id.clean("drill-7", postgresql.dialect()))  # A native uuid column can't hold it
+        self.assertIsInstance(item_id.load_dialect_impl(postgresql.dialect()), postgresql.UUID)
+        self.assertEqual("DRILL-7", ItemId(uuids=False).clean("DRILL-7", postgresql.dialect()))
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        # Raw SQL stores the ids as text, as they were before migrating, whatever LOAN_ITEM_IDS is
+        for statement, values in (
+            ('INSERT INTO "user" (username, role) VALUES (?, ?)', ("bob", "regular")),
+            ('INSERT INTO "LoanItem" (id, description, loanedto) VALUES (?, ?, ?)', (DRILL, "drill", "bob")),
+            ('INSERT INTO "LoanItem" (id, description) VALUES (?, ?)', ("saw-1", "saw")),
+            ("INSERT INTO loan_item_tag (tag, item_id) VALUES (?, ?)", ("power tools", DRILL)),
+            ("INSERT INTO loan_item_tag (tag, item_id) VALUES (?, ?)", ("saws", "saw-1")),
+            ("INSERT INTO hold (item_id, username, created) VALUES (?, ?, ?)", (DRILL, "bob", datetime.utcnow())),
+        ):
+            database.engine.execute(statement, values)
+
+    def tearDown(self):
+        database.recreate_db()
+
+    def stored(self, table, column):
+        return sorted(database.engine.execute(f'SELECT typeof("{column}"), "{column}" FROM {table}').fetchall())
+
+    def test_check(self):
+        self.assertEqual({"items": 2, "not uuids": 1, "examples": ["saw-1"]}, item_ids.check())
+
+    def test_migrate_sqlite(self):
+        self.assertEqual({"LoanItem": 1, "loan_item_tag": 1, "hold": 1}, item_ids.migrate())
+        drill = uuid.UUID(DRILL).bytes
+        self.assertEqual([("blob", drill), ("text", "saw-1")], self.stored('"LoanItem"', "id"))
+        self.assertEqual([("blob", drill), ("text", "saw-1")], self.stored("loan_item_tag", "item_id"))
+        self.assertEqual([("blob", drill)], self.stored("hold", "item_id"))
+        self.assertEqual({"LoanItem": 0, "loan_item_tag": 0, "hold": 0}, item_ids.migrate())  # Already done
@@ -1,8 +1,10 @@
 import unittest
 
 from loans import Loans
-from exceptions import NotAllowedException
+from exceptions import NotAllowedException, InvalidRequestException, UnknownHoldException
+from database import User
 import database
+import notifiers
 
 BOB = "bob"
 ALICE = "alice"
@@ -17,6 +19,7 @@ class TestLoans(unittest.TestCase):
 
     def tearDown(self):
         self.db_session.close()
+        database.recreate_db()
 
     def create(self, username, role, *args, **kwargs):
         """Helper function."""
@@ -38,3 +41,63 @@ class TestLoans(unittest.TestCase):
             NotAllowedException, self.create, ALICE, "regular", *self.args
         )
         self.create(ALICE, "admin", *self.args)
+
+    def test_tags(self):
+        self.db_session.add(User(username=BOB, role="regular"))
+        self.db_session.commit()
+        self.create(ALICE, "admin", "1", "hammer drill", ["Power tools", "drills", "drills"])
+        self.create(ALICE, "admin", "2", "cordless drill", ["power tools", "drills"])
+        self.create(ALICE, "admin", "3", "sander", ["power tools"])
+        self.assertEqual(["drills", "power tools"], self.Loans.read_single_entry("1")["tags"])
+
+        self.Loans.update_loan("1", BOB)
+        ids = [item["id"] for item in self.read(ALICE, "admin", {"tag": "power tools,drills", "available": "true"})]
+        self.assertEqual(["2"], ids)
+        self.assertEqual({
+            "drills": {"items": 2, "loaned": 1, "available": 1},
+            "power tools": {"items": 3, "loaned": 1, "available": 2},
+        }, self.Loans.read_tags())
+
+        self.Loans.update_tags("1", ["garden"])
+        self.Loans.update_loan("1", None)
+        self.remove(ALICE, "admin", "3")
+        self.assertEqual({
+            "drills": {"items": 1, "loaned": 0, "available": 1},
+            "garden": {"items": 1, "loaned": 0, "available": 1},
+            "power tools": {"items": 1, "loaned": 0, "available": 1},
+        }, self.Loans.read_tags())
+
+    def test_holds(self):
+        for username in (BOB, ALICE, "carol"):
+            self.db_session.add(User(username=username, role="regular", phone="+441234567890"))
+        self.db_session.commit()
+        self.create(ALICE, "admin", *self.args)
+        notified = []
+        notifiers.set_notifier(lambda username, phone, loan_item: notified.append((username, loan_item["id"])))
+        self.addCleanup(notifiers.set_notifier, None)
+
+        self.Loans.set_user_session(ALICE, "regular", "+441234567890")
+        self.assertRaises(InvalidRequestException, self.Loans.place_hold, "1")  # Not loaned, so borrow it instead
+        self.Loans.set_user_session(ALICE, "admin", "+441234567890")
+        self.Loans.update_loan("1", BOB)
+        for position, username in enumerate((ALICE, "carol"), 1):
+            self.Loans.set_user_session(username, "regular", "+441234567890")
+            self.assertEqual({"id": "1", "position": position}, self.Loans.place_hold("1"))
+        self.assertRaises(InvalidRequestException, self.Loans.place_hold, "1")
+
+        self.Loans.set_user_session(ALICE, "admin", "+441234567890")
+        self.assertEqual(ALICE, self.Loans.update_loan("1", None)["loanedto"])
+        self.assertEqual([(ALICE, "1")], notified)
+        self.assertEqual([], self.Loans.read_holds())
+        self.Loans.set_user_session("carol", "regular", "+441234567890")
+        self.assertEqual([{"id": "1", "position": 1}], self.Loans.read_holds())
+        self.Loans.cancel_hold("1")
+        self.assertRaises(UnknownHoldException, self.Loans.cancel_hold, "1")
+
+        self.Loans.set_user_session(ALICE, "admin", "+441234567890")
+        self.assertIsNone(self.Loans.update_loan("1", None)["loanedto"])
+        self.assertEqual(1, len(notified))
+
+    def test_invalid_tags(self):
+        for tags in ("drills", ["a,b"], [""], [3]):
+            self.assertRaises(InvalidRequestException, self.create, ALICE, "admin", "1", "drill", tags)
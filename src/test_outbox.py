@@ -0,0 +1,91 @@
+import json
+import threading
+import unittest
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import database
+import outbox
+from database import OutboxEvent, User
+from exceptions import UnknownUserException
+from loans import Loans
+
+
+class _Stub(BaseHTTPRequestHandler):
+    """Records the events posted to it. Fails while server.failures is above zero."""
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+        else:
+            self.server.received.extend(body["events"])
+            self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.server = HTTPServer(("127.0.0.1", 0), _Stub)
+        self.server.received = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.subscribers = {"billing": f"http://127.0.0.1:{self.server.server_port}/events"}
+        self.old_subscribers = outbox.SUBSCRIBERS
+        outbox.SUBSCRIBERS = self.subscribers
+
+        self.db_session = database.get_db_session()
+        self.db_session.add(User(username="bob", role="regular"))
+        self.db_session.commit()
+        self.loans = Loans(self.db_session)
+        self.loans.set_user_session("admin", "admin", "+441234567890")
+
+    def tearDown(self):
+        outbox.SUBSCRIBERS = self.old_subscribers
+        self.server.shutdown()
+        self.server.server_close()
+        self.db_session.close()
+        database.recreate_db()
+
+    def events(self):
+        return [(event["event"], event["item_id"]) for event in self.server.received]
+
+    def test_events_are_written_with_the_change_and_delivered(self):
+        for item_id in ("1", "2"):
+            self.loans.create(item_id, "drill")
+        self.loans.update_loan("1", "bob")
+        self.loans.update_loan("1", None)
+        self.loans.remove("2")
+        self.assertRaises(UnknownUserException, self.loans.update_loan, "1", "nobody")  # Rolled back, so no event
+        self.db_session.rollback()
+
+        self.assertEqual(3, outbox.dispatch_once())
+        self.assertEqual([("loaned", "1"), ("returned", "1"), ("deleted", "2")], self.events())
+        self.assertEqual("bob", self.server.received[1]["loan-item"]["loanedto"])
+        self.assertEqual(0, outbox.dispatch_once())
+
+    def test_failed_batches_are_retried_in_order_per_item(self):
+        self.loans.create("1", "drill")
+        self.loans.create("2", "saw")
+        self.loans.update_loan("1", "bob")
+        self.server.failures = 1
+        self.assertEqual(0, outbox.dispatch_once())
+        self.loans.update_loan("1", None)
+        self.loans.update_loan("2", "bob")
+
+        # Item 1's return waits behind its loan, which is backing off, but item 2's loan can go
+        self.assertEqual(1, outbox.dispatch_once())
+        self.assertEqual([("loaned", "2")], self.events())
+        self.assertEqual(2, outbox.dispatch_once(now=datetime.utcnow() + timedelta(seconds=outbox.RETRY_MAX_SECONDS)))
+        self.assertEqual([("loaned", "2"), ("loaned", "1"), ("returned", "1")], self.events())
+        self.assertEqual(0, self.db_session.query(OutboxEvent).count())
+
+    def test_nothing_is_written_without_subscribers(self):
+        outbox.SUBSCRIBERS = {}
+        self.loans.create("1", "drill")
+        self.loans.update_loan("1", "bob")
+        self.assertEqual(0, self.db_session.query(OutboxEvent).count())
@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import unittest
+
+import app
+import profiling
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_dir, self.old_keep = profiling.PROFILE_DIR, profiling.KEEP
+        profiling.PROFILE_DIR = self.tmp_dir.name
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        app.create_admin_user()
+        self.client.post("/users", json={"username": "bob", "password": "password", "phone": "+441234567890"})
+        self.tokens = {
+            user: self.client.post("/login", json={"username": user, "password": password}).json["auth_token"]
+            for user, password in (("admin", "admin"), ("bob", "password"))
+        }
+
+    def tearDown(self):
+        self.client.delete("/users/bob", headers={"access-token": self.tokens["admin"]})
+        profiling.PROFILE_DIR, profiling.KEEP = self.old_dir, self.old_keep
+        self.tmp_dir.cleanup()
+
+    def profiles(self):
+        return sorted(name for name in os.listdir(self.tmp_dir.name) if name.endswith(".json"))
+
+    def test_admin_can_profile(self):
+        response = self.client.get("/loan-items", headers={"access-token": self.tokens["admin"], "profile": "1"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(self.profiles()))
+        with open(os.path.join(self.tmp_dir.name, self.profiles()[0])) as info_file:
+            info = json.load(info_file)
+        self.assertEqual("api.loan_items", info["endpoint"])
+        self.assertTrue(any("FROM \"LoanItem\"" in statement for statement in info["sql"]))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, self.profiles()[0][:-5] + ".prof")))
+
+    def test_regular_users_cant_profile(self):
+        self.client.get("/users/bob", headers={"access-token": self.tokens["bob"], "profile": "1"})
+        self.client.get("/users/bob", headers={"access-token": self.tokens["admin"]})
+        self.assertEqual([], self.profiles())
+
+    def test_only_admins_start_the_profiler(self):
+        started = []
+        original = profiling._Profile.__enter__
+        self.addCleanup(setattr, profiling._Profile, "__enter__", original)
+        profiling._Profile.__enter__ = lambda profile: started.append(profile) or original(profile)
+        response = self.client.get("/users/bob", headers={"access-token": self.tokens["bob"], "profile": "1"})
+        self.assertEqual(200, response.status_code)
+        response = self.client.get("/users/bob", headers={"access-token": "not a token", "profile": "1"})
+        self.assertEqual(500, response.status_code)
+        self.client.post("/login", json={"username": "bob", "password": "password"}, headers={"profile": "1"})
+        self.assertEqual([], started)
+
+        self.client.get("/users/bob", headers={"access-token": self.tokens["admin"], "profile": "1"})
+        self.assertEqual(1, len(started))
+
+    def test_old_profiles_are_removed(self):
+        profiling.KEEP = 2
+        for _ in range(4):
+            self.client.get("/mode", headers={"access-token": self.tokens["admin"], "profile": "1"})
+        self.assertEqual(2, len(self.profiles()))
@@ -0,0 +1,90 @@
+from flask_testing import TestCase
+from sqlalchemy import event
+
+import app
+import database
+
+# (method, url, user, request body, most SQL statements the request may run)
+BUDGETS = [
+    ("POST", "/login", None, {"username": "bob", "password": "password"}, 1),
+    ("POST", "/users", None, {"username": "carol", "password": "password", "phone": "+441234567890"}, 2),
+    ("GET", "/users", "admin", None, 2),
+    ("GET", "/users/bob", "bob", None, 3),
+    ("PUT", "/users/bob", "bob", {"phone": "+441234567891"}, 6),
+    ("PUT", "/users/bob", "bob", {"password": "password"}, 4),
+    ("PUT", "/users/bob", "admin", {"role": "regular"}, 3),
+    ("GET", "/loan-items", "admin", None, 2),
+    ("GET", "/loan-items?loanedto=bob&contains=drill&limit=5", "admin", None, 2),
+    ("GET", "/loan-items?tag=power tools,drills&available=true", "admin", None, 2),
+    ("GET", "/loan-items?ids=1,2,3", "admin", None, 2),
+    ("POST", "/loan-items/lookup", "bob", {"ids": [str(i) for i in range(300)]}, 2),
+    ("POST", "/loan-items", "admin", {"id": "2", "description": "saw"}, 4),
+    ("POST", "/loan-items", "admin", {"id": "2", "description": "saw", "tags": ["power tools"]}, 5),
+    ("PUT", "/loan-items/1", "admin", {"tags": ["power tools"]}, 5),
+    ("GET", "/tags", "admin", None, 2),
+    ("GET", "/holds", "bob", None, 2),
+    ("GET", "/loan-items/1", "admin", None, 3),
+    # The user, the item, removing the user's hold, one upsert of the loan counters, the item's tag counters, the loan
+    ("PUT", "/loan-items/1", "admin", {"loanedto": "bob"}, 6),
+    ("PUT", "/loan-items/1", "admin", {"loanedto": None}, 2),
+    ("DELETE", "/loan-items/1", "admin", None, 6),
+    ("DELETE", "/users/bob", "admin", None, 5),
+    ("GET", "/stats", "admin", None, 2),
+    ("GET", "/stats", "bob", None, 2),
+    ("GET", "/mode", "admin", None, 2),
+    ("PUT", "/mode", "admin", {"mode": "admin-operated"}, 3),
+]
+
+
+class TestQueryBudget(TestCase):
+    """Fails when a request runs more SQL statements than its route's budget, listing the statements it ran."""
+    def test_budgets(self):
+        for method, url, user, data, budget in BUDGETS:
+            with self.subTest(method=method, url=url, data=data):
+                self.setUp()
+                headers = {"access-token": self.tokens[user]} if user else {}
+                statements = []
+                with self.count_statements(statements):
+                    response = self.client.open(url, method=method, headers=headers, json=data)
+                self.assertLess(response.status_code, 400, response.json)
+                self.assertLessEqual(
+                    len(statements), budget,
+                    f"{method} {url} ran {len(statements)} SQL statements, the budget is {budget}:\n"
+                    + "\n".join(statements),
+                )
+
+    def setUp(self) -> None:
+        database.recreate_db()
+        app.create_admin_user()
+        self.client.post("/users", json={"username": "bob", "password": "password", "phone": "+441234567890"})
+        self.tokens = {}
+        for user in ("admin", "bob"):
+            password = "admin" if user == "admin" else "password"
+            self.tokens[user] = self.client.post(
+                "/login", json={"username": user, "password": password}
+            ).json["auth_token"]
+        self.client.post("/loan-items", json={"id": "1", "description": "drill"},
+                         headers={"access-token": self.tokens["admin"]})
+
+    def tearDown(self):
+        database.recreate_db()
+        app.create_admin_user()
+
+    def create_app(self):
+        flask_app = app.create_app()
+        flask_app.config["RATE_LIMIT"] = False
+        return flask_app
+
+    class count_statements:
+        """Records the SQL run by the default engine while in the with block."""
+        def __init__(self, statements):
+            self.statements = statements
+
+        def record(self, conn, cursor, statement, parameters, context, executemany):
+            self.statements.append(statement)
+
+        def __enter__(self):
+            event.listen(database.engine, "before_cursor_execute", self.record)
+
+        def __exit__(self, exc_type, exc_value, exc_traceback):
+            event.remove(database.engine, "before_cursor_execute", self.record)
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+import app
+import ratelimit
+
+
+class TestTokenBucket(unittest.TestCase):
+    def check_store(self, store):
+        burst, rate = ratelimit.parse_limit("2/10")
+        self.assertEqual(0, store.take("k", burst, rate, now=100))
+        self.assertEqual(0, store.take("k", burst, rate, now=100))
+        self.assertAlmostEqual(5, store.take("k", burst, rate, now=100))
+        self.assertEqual(0, store.take("other", burst, rate, now=100))
+        self.assertEqual(0, store.take("k", burst, rate, now=105))
+
+    def check_pruning(self, store, keys):
+        store.take("fast", *ratelimit.parse_limit("2/10"), now=100)
+        store.take("slow", *ratelimit.parse_limit("1/1000"), now=100)
+        store.take("other", *ratelimit.parse_limit("2/10"), now=100 + store.PRUNE_SECONDS)
+        self.assertEqual({"slow", "other"}, keys())  # Refilled buckets go, judged by their own limit
+
+    def test_memory_store(self):
+        self.check_store(ratelimit.MemoryStore())
+        store = ratelimit.MemoryStore()
+        self.check_pruning(store, lambda: set(store._buckets))
+
+    def test_memory_store_forgets_least_recently_used(self):
+        store = ratelimit.MemoryStore()
+        store.MAX_KEYS = 2
+        burst, rate = ratelimit.parse_limit("2/10")
+        for key in ("a", "b", "a", "c"):
+            store.take(key, burst, rate, now=100)
+        self.assertEqual(["a", "c"], list(store._buckets))
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.check_store(ratelimit.make_store(f"sqlite:///{os.path.join(tmp_dir, 'buckets.db')}"))
+            store = ratelimit.make_store(f"sqlite:///{os.path.join(tmp_dir, 'pruned.db')}")
+            self.check_pruning(store, lambda: {key for key, in store._connect().execute("SELECT key FROM bucket")})
+
+
+class TestRateLimitedRoutes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.old_store = ratelimit.store
+        ratelimit.store = ratelimit.MemoryStore()
+        self.client = app.create_app().test_client()
+
+    def tearDown(self):
+        ratelimit.store = self.old_store
+
+    def test_login_limited_per_username(self):
+        burst, _ = ratelimit.parse_limit(ratelimit.USERNAME_LIMIT)
+        for _ in range(int(burst)):
+            response = self.client.post("/login", json={"username": "mallory", "password": "guess"})
+            self.assertEqual(401, response.status_code)
+        response = self.client.post("/login", json={"username": "mallory", "password": "guess"})
+        self.assertEqual(429, response.status_code)
+        self.assertEqual({"error": "Too many requests."}, response.json)
+        self.assertGreater(int(response.headers["Retry-After"]), 0)
+
+        # Other usernames are unaffected
+        response = self.client.post("/login", json={"username": "trudy", "password": "guess"})
+        self.assertEqual(401, response.status_code)
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+
+import app
+import database
+from database import Base, LoanItem, User
+
+
+class TestReplicas(unittest.TestCase):
+    """Uses a second SQLite file as a stand-in for a lagging read replica."""
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.replica = database.make_engine(f"sqlite:///{self.tmp_dir.name}/replica.db")
+        Base.metadata.create_all(self.replica)
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        primary_session = database.get_db_session()
+        admin = primary_session.query(User).get("admin")
+        replica_session = database.ReplicaSession(bind=self.replica)
+        replica_session.add(User(username="admin", hashed_password=admin.hashed_password, role="admin", phone=admin.phone))
+        replica_session.add(LoanItem(id="replica-only", description="stale"))
+        replica_session.commit()
+        replica_session.close()
+        primary_session.close()
+        database.replica_engines.append(self.replica)
+        self.client = self.app.test_client()
+        self.token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+
+    def tearDown(self):
+        database.replica_engines.remove(self.replica)
+        self.replica.dispose()
+        self.tmp_dir.cleanup()
+
+    def item_ids(self):
+        response = self.client.get("/loan-items", headers={"access-token": self.token})
+        return [item["id"] for item in response.json["loan-items"]]
+
+    def test_reads_use_replica(self):
+        self.assertIn("replica-only", self.item_ids())
+
+    def test_reads_after_write_use_primary(self):
+        response = self.client.post(
+            "/loan-items", json={"id": "new", "description": "drill"}, headers={"access-token": self.token}
+        )
+        self.assertEqual(200, response.status_code)
+        ids = self.item_ids()
+        self.assertIn("new", ids)
+        self.assertNotIn("replica-only", ids)
+        self.client.delete("/loan-items/new", headers={"access-token": self.token})
+
+    def test_reads_that_must_be_current_use_primary(self):
+        self.client.post("/users", json={"username": "carol", "password": "password", "phone": "+441234567890"})
+        self.addCleanup(self.client.delete, "/users/carol", headers={"access-token": self.token})
+        self.client.cookie_jar.clear()  # Not a recent writer
+        response = self.client.post("/login", json={"username": "carol", "password": "password"})
+        self.assertEqual(200, response.status_code)  # Carol isn't on the replica yet
+
+    def test_requests_that_dont_write_get_read_only_sessions(self):
+        for method, url, read_only, replica in (("POST", "/login", True, False),
+                                                ("POST", "/loan-items/lookup", True, False),
+                                                ("GET", "/loan-items", True, True),
+                                                ("PUT", "/mode", True, False),
+                                                ("PUT", "/loan-items/1", False, False)):
+            with self.app.test_request_context(url, method=method):
+                user_management = app.user_management()
+                self.assertEqual((read_only, replica), (user_management.read_only, user_management.replica), url)
@@ -0,0 +1,94 @@
+import io
+import json
+import logging
+import os
+import queue
+import tempfile
+import unittest
+from unittest import mock
+
+import app
+import loans
+import metrics
+import notifiers
+import requestlog
+
+
+class TestRequestLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_settings = (requestlog.ACCESS_LOG, requestlog.ERROR_LOG, requestlog.SAMPLE_RATE, requestlog.MAX_BYTES)
+        requestlog.stop()  # Picks up the paths when it starts again
+        requestlog.ACCESS_LOG = os.path.join(self.tmp_dir.name, "access.log")
+        requestlog.ERROR_LOG = os.path.join(self.tmp_dir.name, "error.log")
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        self.token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+
+    def tearDown(self):
+        requestlog.stop()
+        requestlog.ACCESS_LOG, requestlog.ERROR_LOG, requestlog.SAMPLE_RATE, requestlog.MAX_BYTES = self.old_settings
+        self.tmp_dir.cleanup()
+
+    def entries(self, path):
+        requestlog.flush()
+        if not os.path.exists(path):
+            return []
+        with open(path) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_access_log(self):
+        response = self.client.get("/loan-items?available=true", headers={"access-token": self.token})
+        self.assertEqual(200, response.status_code)
+        login, read = self.entries(requestlog.ACCESS_LOG)
+        self.assertEqual(("POST", "/login", None, 200), (login["method"], login["route"], login["user"], login["status"]))
+        self.assertEqual(("GET", "/loan-items", "admin", 200), (read["method"], read["route"], read["user"], read["status"]))
+        self.assertGreaterEqual(read["sql_count"], 2)  # The user and the items
+        self.assertGreater(read["latency_ms"], 0)
+        self.assertEqual(len(response.data), read["bytes"])
+        self.assertNotIn("sample_rate", read)
+        self.assertEqual("GET /loan-items 200", read["message"])
+
+    def test_successes_are_sampled(self):
+        requestlog.SAMPLE_RATE = 0
+        self.client.get("/mode", headers={"access-token": self.token})
+        self.client.get("/loan-items/missing", headers={"access-token": self.token})
+        entries = self.entries(requestlog.ACCESS_LOG)
+        self.assertEqual([(200, None), (404, "/loan-items/<item_id>")],  # Just the login, before sampling
+                         [(entry["status"], entry["route"] if entry["status"] == 404 else None) for entry in entries])
+
+    def test_unexpected_errors_are_logged(self):
+        with mock.patch.object(loans.Loans, "read", side_effect=RuntimeError("disk on fire")):
+            response = self.client.get("/loan-items", headers={"access-token": self.token})
+        self.assertEqual(500, response.status_code)
+        error, = self.entries(requestlog.ERROR_LOG)
+        self.assertEqual(("ERROR", "/loan-items", "admin", "disk on fire"),
+                         (error["level"], error["route"], error["user"], error["error"]))
+        self.assertIn("RuntimeError: disk on fire", error["exception"])
+        self.assertEqual("GET /loan-items failed: disk on fire", error["message"])
+        self.assertEqual(500, self.entries(requestlog.ACCESS_LOG)[-1]["status"])
+
+    def test_rotation(self):
+        requestlog.stop()
+        requestlog.MAX_BYTES = 1000
+        for _ in range(10):
+            self.client.get("/mode", headers={"access-token": self.token})
+        requestlog.flush()
+        rotated = [name for name in os.listdir(self.tmp_dir.name) if name.startswith("access.log.")]
+        self.assertTrue(rotated)
+        self.assertLessEqual(os.path.getsize(requestlog.ACCESS_LOG), 1000)
+
+    def test_full_queue_drops_entries(self):
+        handler = requestlog._DroppingQueueHandler(queue.Queue(1))
+        before = metrics.snapshot().get("log_entries_dropped", 0)
+        for _ in range(3):
+            handler.emit(logging.makeLogRecord({"msg": ""}))
+        self.assertEqual(before + 2, metrics.snapshot()["log_entries_dropped"])
+
+    def test_notifications_go_to_stderr(self):
+        requestlog.stop()
+        with mock.patch("sys.stderr", io.StringIO()) as stderr:
+            notifiers.log_notifier("bob", "+441234567890", {"id": "1", "description": "drill"})
+            requestlog.flush()
+        self.assertEqual("Hold ready: 1 (drill) is now loaned to bob\n", stderr.getvalue())
@@ -0,0 +1,50 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from time import sleep
+
+import requests
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            self.port = free_socket.getsockname()[1]
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{self.tmp_dir.name}/server.db")
+        self.process = subprocess.Popen(
+            [sys.executable, "server.py", "--host", "127.0.0.1", "--port", str(self.port), "--workers", "2",
+             "--max-requests", "3"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stderr=subprocess.DEVNULL,
+        )
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.tmp_dir.cleanup()
+
+    def login(self):
+        for _ in range(100):
+            try:
+                return requests.post(f"http://127.0.0.1:{self.port}/login",
+                                     json={"username": "admin", "password": "admin"}, timeout=5)
+            except requests.ConnectionError:
+                sleep(0.1)
+        self.fail("Server did not start")
+
+    def test_serves_recycles_reloads_and_stops(self):
+        # More requests than the workers are allowed to serve before being recycled
+        for _ in range(10):
+            self.assertEqual(200, self.login().status_code)
+
+        self.process.send_signal(signal.SIGHUP)
+        self.assertEqual(200, self.login().status_code)
+
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.process.wait(timeout=10))
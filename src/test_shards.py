@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+from datetime import datetime
+
+import app
+import modes
+import shards
+from database import Hold, LoanItem
+from exceptions import UnknownSiteException, SiteUnavailableException
+from users import UserManagement
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_shards = shards.SHARDS
+        shards.SHARDS = {
+            "a": f"sqlite:///{self.tmp_dir.name}/a-{{site}}.db",
+            "b": f"sqlite:///{self.tmp_dir.name}/b-{{site}}.db",
+        }
+        shards.add_site("library", "a")
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with shards._directory() as directory:
+            directory.query(shards.Site).delete()
+            directory.commit()
+        shards._session_makers.clear()
+        for engine in shards._engines.values():
+            engine.dispose()
+        shards._engines.clear()
+        shards.SHARDS = self.old_shards
+        self.tmp_dir.cleanup()
+
+    def login(self, site):
+        response = self.client.post("/login", json={"username": "admin", "password": "admin"}, headers={"site": site})
+        return response.json["auth_token"]
+
+    def test_sites_are_isolated(self):
+        token = self.login("library")
+        response = self.client.post(
+            "/loan-items", json={"id": "1", "description": "book"}, headers={"site": "library", "access-token": token}
+        )
+        self.assertEqual(200, response.status_code)
+
+        response = self.client.get("/loan-items", headers={"site": "library", "access-token": token})
+        self.assertEqual([{"id": "1", "description": "book", "loanedto": None}], response.json["loan-items"])
+        response = self.client.get("/loan-items", headers={"access-token": self.login(shards.DEFAULT_SITE)})
+        self.assertNotIn("book", [item["description"] for item in response.json["loan-items"]])
+
+    def test_sites_have_their_own_mode(self):
+        headers = {"site": "library", "access-token": self.login("library")}
+        response = self.client.put("/mode", json={"mode": modes.SELF_SERVICE}, headers=headers)
+        self.addCleanup(modes.set_mode, modes.DEFAULT_MODE, "library")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(modes.SELF_SERVICE, self.client.get("/mode", headers=headers).json["mode"])
+        response = self.client.get("/mode", headers={"access-token": self.login(shards.DEFAULT_SITE)})
+        self.assertEqual(modes.DEFAULT_MODE, response.json["mode"])
+
+    def test_token_is_bound_to_site(self):
+        token = self.login(shards.DEFAULT_SITE)
+        response = self.client.get("/loan-items", headers={"site": "library", "access-token": token})
+        self.assertEqual(403, response.status_code)
+
+    def test_unknown_site(self):
+        response = self.client.post("/login", json={"username": "admin", "password": "admin"}, headers={"site": "nope"})
+        self.assertEqual(404, response.status_code)
+        self.assertEqual({"error": "Site not found."}, response.json)
+        self.assertRaises(UnknownSiteException, shards.session_for, "../etc")
+
+    def test_move_site(self):
+        with UserManagement("library") as user_manage:
+            user_manage.set_user_session("admin")
+            user_manage.Loans.create("1", "drill")
+        shards.move_site("library", "b", settle_seconds=0)
+
+        self.assertEqual({"library": "b"}, shards.list_sites())
+        session = shards.session_for("library")
+        self.assertEqual(["drill"], [item.description for item in session.query(LoanItem)])
+        session.close()
+
+    def test_rows_added_after_a_move_get_new_ids(self):
+        with UserManagement("library") as user_manage:
+            user_manage.set_user_session("admin")
+            user_manage.Loans.create("1", "drill")
+            user_manage.Loans.create("2", "saw")
+        session = shards.session_for("library")
+        session.add(Hold(item_id="1", username="admin", created=datetime.utcnow()))
+        session.commit()
+        session.close()
+        shards.move_site("library", "b", settle_seconds=0)
+
+        session = shards.session_for("library")
+        session.add(Hold(item_id="2", username="admin", created=datetime.utcnow()))
+        session.commit()
+        self.assertEqual([1, 2], [hold.id for hold in session.query(Hold).order_by(Hold.id)])
+        session.close()
+
+    def test_locked_site(self):
+        with shards._directory() as directory:
+            directory.query(shards.Site).get("library").locked = True
+            directory.commit()
+        shards._session_makers.clear()
+        self.assertRaises(SiteUnavailableException, shards.session_for, "library")
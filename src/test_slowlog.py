@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import unittest
+
+import app
+import database
+import slowlog
+
+
+class TestSlowLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_threshold, self.old_path = slowlog.THRESHOLD_SECONDS, slowlog.LOG_PATH
+        slowlog.THRESHOLD_SECONDS = 1e-9  # Every statement is "slow"
+        slowlog.LOG_PATH = os.path.join(self.tmp_dir.name, "slow.log")
+        slowlog.reset()
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        self.token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+
+    def tearDown(self):
+        slowlog.THRESHOLD_SECONDS, slowlog.LOG_PATH = self.old_threshold, self.old_path
+        slowlog.reset()
+        self.tmp_dir.cleanup()
+
+    def test_normalise_and_redact(self):
+        self.assertEqual("SELECT * FROM t WHERE a = ? AND b = ?", slowlog.normalise("SELECT *  FROM t\nWHERE a = 'x' AND b = 12"))
+        self.assertEqual(["<str>", None, "<int>"], slowlog.redact(("secret", None, 3)))
+
+    def test_slow_statements_are_logged_once_and_counted(self):
+        for _ in range(3):
+            response = self.client.get("/loan-items?contains=drill", headers={"access-token": self.token})
+            self.assertEqual(200, response.status_code)
+
+        with open(slowlog.LOG_PATH) as log_file:
+            entries = [json.loads(line) for line in log_file]
+        search = [entry for entry in entries if "LIKE" in entry["statement"].upper()]
+        self.assertEqual(1, len(search))
+        self.assertEqual("GET api.loan_items", search[0]["route"])
+        self.assertIn("SCAN", " ".join(search[0]["plan"]))
+        self.assertNotIn("drill", json.dumps(search[0]["parameters"]))
+
+        body = self.client.get("/slow-queries", headers={"access-token": self.token}).json
+        counted = [entry for entry in body["slow-queries"] if entry["statement"] == search[0]["statement"]]
+        self.assertEqual(3, counted[0]["count"])
+
+    def test_failed_statements_are_not_logged(self):
+        slowlog.reset()
+        os.remove(slowlog.LOG_PATH)
+        with database.engine.connect() as connection:
+            for _ in range(3):
+                self.assertRaises(Exception, connection.execute, "SELECT * FROM no_such_table")
+            self.assertEqual(1, connection.execute("SELECT 1").scalar())
+        self.assertEqual([("SELECT ?", 1)], [(entry["statement"], entry["count"]) for entry in slowlog.summary()])
+        with open(slowlog.LOG_PATH) as log_file:
+            self.assertEqual(["SELECT ?"], [json.loads(line)["statement"] for line in log_file])
+
+    def test_in_lists_share_a_statement(self):
+        self.assertEqual("SELECT * FROM t WHERE id IN (?) AND a IN (SELECT b FROM u)",
+                         slowlog.normalise("SELECT * FROM t WHERE id IN (?, ?, ?) AND a IN (SELECT b FROM u)"))
+        self.assertEqual("SELECT * FROM t WHERE id IN (?)", slowlog.normalise("SELECT * FROM t WHERE id IN (%(id_1)s)"))
+
+    def test_statements_are_bounded(self):
+        slowlog.reset()
+        slowlog.MAX_STATEMENTS = 2
+        self.addCleanup(setattr, slowlog, "MAX_STATEMENTS", 1000)
+        with database.engine.connect() as connection:
+            for table in ("user", "LoanItem", "hold"):
+                connection.execute(f'SELECT count(*) FROM "{table}"')
+        self.assertEqual(2, len(slowlog.summary()))
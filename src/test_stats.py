@@ -0,0 +1,79 @@
+import unittest
+
+import app
+import database
+import stats
+from database import LoanItem
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self) -> None:
+        database.recreate_db()
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        for username in ("bob", "carol"):
+            self.client.post("/users", json={"username": username, "password": "password", "phone": "+441234567890"})
+        self.admin = self.login("admin", "admin")
+        for item_id in ("1", "2", "3"):
+            self.client.post("/loan-items", json={"id": item_id, "description": "drill"}, headers=self.admin)
+
+    def tearDown(self):
+        database.recreate_db()
+        app.create_admin_user()
+
+    def login(self, username, password):
+        token = self.client.post("/login", json={"username": username, "password": password}).json["auth_token"]
+        return {"access-token": token}
+
+    def loan(self, item_id, username):
+        response = self.client.put(f"/loan-items/{item_id}", json={"loanedto": username}, headers=self.admin)
+        return response.status_code
+
+    def stats(self, headers):
+        return self.client.get("/stats", headers=headers).json["stats"]
+
+    def test_counters_follow_loans(self):
+        self.assertEqual({"items": 3, "loaned": 0, "available": 3, "loanedto": {}}, self.stats(self.admin))
+        self.loan("1", "bob")
+        self.loan("2", "bob")
+        self.loan("2", "carol")
+        self.assertEqual({"items": 3, "loaned": 2, "available": 1, "loanedto": {"bob": 1, "carol": 1}},
+                         self.stats(self.admin))
+        self.loan("1", None)
+        self.client.delete("/loan-items/3", headers=self.admin)
+        self.assertEqual({"items": 2, "loaned": 1, "available": 1, "loanedto": {"carol": 1}}, self.stats(self.admin))
+
+    def test_failed_loan_leaves_counters_alone(self):
+        self.assertEqual(404, self.loan("1", "nobody"))
+        self.assertEqual({"items": 3, "loaned": 0, "available": 3, "loanedto": {}}, self.stats(self.admin))
+
+    def test_regular_users_only_see_their_own_count(self):
+        self.loan("1", "bob")
+        self.loan("2", "carol")
+        bob_stats = self.stats(self.login("bob", "password"))
+        self.assertEqual({"bob": 1}, bob_stats["loanedto"])
+        self.assertEqual(2, bob_stats["loaned"])
+
+    def test_rebuild(self):
+        self.loan("1", "bob")
+        self.client.put("/loan-items/1", json={"tags": ["drills"]}, headers=self.admin)
+        session = database.get_db_session()
+        session.add(LoanItem(id="4", description="saw", loanedto="carol"))  # Bypasses the counters
+        session.commit()
+        session.close()
+
+        self.assertEqual({"items": 4, "loaned": 2, "loanedto:bob": 1, "loanedto:carol": 1, "tag:drills": 1,
+                          "tagloaned:drills": 1}, stats.rebuild())
+        self.assertEqual({"items": 4, "loaned": 2, "available": 2, "loanedto": {"bob": 1, "carol": 1}},
+                         self.stats(self.admin))
+
+    def test_loans_after_a_rebuild_count_against_their_tags(self):
+        self.client.put("/loan-items/1", json={"tags": ["drills"]}, headers=self.admin)
+        stats.rebuild()  # Writes no counter for tags with nothing loaned
+        self.loan("1", "bob")
+        self.assertEqual({"drills": {"items": 1, "loaned": 1, "available": 0}},
+                         self.client.get("/tags", headers=self.admin).json["tags"])
+        self.loan("1", None)
+        self.assertEqual({"drills": {"items": 1, "loaned": 0, "available": 1}},
+                         self.client.get("/tags", headers=self.admin).json["tags"])
@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import app
+import tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class _Collector(BaseHTTPRequestHandler):
+    """Stands in for an OTLP/HTTP collector."""
+    received = []
+
+    def do_POST(self):
+        self.received.append((self.path, json.loads(self.rfile.read(int(self.headers["Content-Length"])))))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def spans(export_requests):
+    return [span for export_request in export_requests for resource_spans in export_request["resourceSpans"]
+            for scope_spans in resource_spans["scopeSpans"] for span in scope_spans["spans"]]
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_export, self.old_rate = tracing.EXPORT, tracing.SAMPLE_RATE
+        tracing.EXPORT = os.path.join(self.tmp_dir.name, "traces.jsonl")
+        self.app = app.create_app()
+        self.app.config["RATE_LIMIT"] = False
+        self.client = self.app.test_client()
+        self.token = self.client.post("/login", json={"username": "admin", "password": "admin"}).json["auth_token"]
+        tracing.flush()  # So the login's trace is in the file
+
+    def tearDown(self):
+        tracing.flush()
+        tracing.EXPORT, tracing.SAMPLE_RATE = self.old_export, self.old_rate
+        self.tmp_dir.cleanup()
+
+    def exported(self):
+        tracing.flush()
+        if not os.path.exists(tracing.EXPORT):
+            return []
+        with open(tracing.EXPORT) as trace_file:
+            return spans(json.loads(line) for line in trace_file)
+
+    def test_spans_cover_each_layer(self):
+        os.remove(tracing.EXPORT)  # Without the login
+        response = self.client.get("/loan-items?available=true", headers={"access-token": self.token})
+        self.assertEqual(200, response.status_code)
+
+        exported = self.exported()
+        trace_id = response.headers["traceparent"].split("-")[1]
+        self.assertEqual({trace_id}, {span["traceId"] for span in exported})
+        by_name = {span["name"]: span for span in exported}
+        root = by_name["GET /loan-items"]
+        self.assertNotIn("parentSpanId", root)
+        self.assertIn({"key": "http.status_code", "value": {"intValue": "200"}}, root["attributes"])
+        self.assertEqual(root["spanId"], response.headers["traceparent"].split("-")[2])
+        for name, parent in (
+            ("check_token_and_set_session", "GET /loan-items"),
+            ("users.Users.set_user_session", "check_token_and_set_session"),
+            ("users._Storage.get", "users.Users.set_user_session"),
+            ("read_loan_items", "GET /loan-items"),
+            ("loans.Loans.read", "read_loan_items"),
+            ("loans._Storage.get_filter_offset", "loans.Loans.read"),
+            ("encode", "read_loan_items"),
+        ):
+            self.assertEqual(by_name[parent]["spanId"], by_name[name]["parentSpanId"], name)
+        sql = [span for span in exported if span["name"] == "sql"]
+        self.assertTrue(any('FROM "LoanItem"' in attribute["value"]["stringValue"]
+                            for span in sql for attribute in span["attributes"]))
+        self.assertTrue(all(int(span["startTimeUnixNano"]) <= int(span["endTimeUnixNano"]) for span in exported))
+
+    def test_errors_are_recorded(self):
+        os.remove(tracing.EXPORT)
+        self.client.get("/loan-items/missing", headers={"access-token": self.token})
+        read = [span for span in self.exported() if span["name"] == "read_loan_item"][0]
+        self.assertEqual(2, read["status"]["code"])
+        self.assertIn("UnknownLoanItemException", read["status"]["message"])
+
+    def test_traceparent_is_followed(self):
+        os.remove(tracing.EXPORT)
+        response = self.client.get("/mode", headers={"access-token": self.token,
+                                                     "traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+        self.assertEqual(TRACE_ID, response.headers["traceparent"].split("-")[1])
+        root = [span for span in self.exported() if span["name"] == "GET /mode"][0]
+        self.assertEqual(TRACE_ID, root["traceId"])
+        self.assertEqual(PARENT_ID, root["parentSpanId"])
+
+        # Not sampled by the caller
+        response = self.client.get("/mode", headers={"access-token": self.token,
+                                                     "traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+        self.assertNotIn("traceparent", response.headers)
+        self.assertEqual(1, len([span for span in self.exported() if span["name"] == "GET /mode"]))
+
+    def test_parse_traceparent(self):
+        self.assertEqual((TRACE_ID, PARENT_ID, True), tracing.parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01"))
+        self.assertIsNone(tracing.parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01"))
+        self.assertIsNone(tracing.parse_traceparent(f"ff-{TRACE_ID}-{PARENT_ID}-01"))
+        self.assertIsNone(tracing.parse_traceparent(f"00-{TRACE_ID.upper()}-{PARENT_ID}-01"))
+        self.assertIsNone(tracing.parse_traceparent("garbage"))
+
+    def test_sampling(self):
+        os.remove(tracing.EXPORT)
+        tracing.SAMPLE_RATE = 0
+        response = self.client.get("/mode", headers={"access-token": self.token})
+        self.assertNotIn("traceparent", response.headers)
+        tracing.EXPORT = ""  # Off, even for sampled callers
+        response = self.client.get("/mode", headers={"access-token": self.token,
+                                                     "traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+        self.assertNotIn("traceparent", response.headers)
+        tracing.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "traces.jsonl")))
+
+    def test_otlp_collector(self):
+        _Collector.received = []
+        server = HTTPServer(("127.0.0.1", 0), _Collector)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            tracing.EXPORT = f"http://127.0.0.1:{server.server_port}/v1/traces"
+            response = self.client.get("/mode", headers={"access-token": self.token})
+            tracing.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual({"/v1/traces"}, {path for path, _ in _Collector.received})
+        trace_id = response.headers["traceparent"].split("-")[1]
+        self.assertIn("GET /mode", {span["name"] for span in spans(body for _, body in _Collector.received)
+                                    if span["traceId"] == trace_id})
+        resource = _Collector.received[0][1]["resourceSpans"][0]["resource"]
+        self.assertEqual([{"key": "service.name", "value": {"stringValue": "loan-items"}}], resource["attributes"])
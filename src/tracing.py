@@ -0,0 +1,331 @@
+"""Request tracing.
+
+A traced request records a tree of timed spans: the request, each function eval_and_respond runs (the token check and
+the handler), the Users and Loans methods with their _Storage calls, every SQL statement and the response encoding.
+Set TRACE_EXPORT to turn tracing on, either to a file path, where each batch of traces is appended as a line of OTLP
+JSON (as the OpenTelemetry collector's file exporter writes them), or to the URL of an OTLP/HTTP collector, e.g.
+"http://localhost:4318/v1/traces". A background thread exports the batches, so requests don't wait for it.
+
+Trace ids come from the W3C Trace Context "traceparent" header. A request that has one joins the caller's trace and is
+traced if the caller sampled it. Other requests start a new trace and TRACE_SAMPLE_RATE (0 to 1, default 1) of them are
+traced. Traced responses carry a traceparent header naming their trace. A span of a request that isn't traced costs a
+thread local lookup.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import re
+import threading
+import urllib.request
+from functools import wraps
+from time import time_ns
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+EXPORT = os.environ["TRACE_EXPORT"] if "TRACE_EXPORT" in os.environ else ""
+SAMPLE_RATE = float(os.environ["TRACE_SAMPLE_RATE"]) if "TRACE_SAMPLE_RATE" in os.environ else 1.0
+SERVICE_NAME = os.environ["TRACE_SERVICE_NAME"] if "TRACE_SERVICE_NAME" in os.environ else "loan-items"
+TRACEPARENT = "traceparent"
+BATCH_SIZE = 50  # Traces per export
+MAX_QUEUED = 1000  # Traces waiting to be exported, more are dropped
+TIMEOUT_SECONDS = 5
+
+_traceparent = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+_listening = False
+_listen_lock = threading.Lock()
+
+
+class _Active(threading.local):
+    trace = None  # A class default, since a missing attribute of a thread local is slow to look up
+
+
+_active = _Active()
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans", "stack")
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []  # Finished
+        self.stack = []  # Open, innermost last
+
+
+class _Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start", "end", "error")
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time_ns()
+        self.end = None
+        self.error = None
+
+    def __enter__(self):
+        self.trace.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.trace.stack.pop()
+        self.finish(exc_value)
+
+    def finish(self, error=None):
+        self.end = time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.trace.spans.append(self)
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+
+class _NoSpan:
+    """What span() returns when the request isn't traced."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **attributes):
+    """Context manager timing a block of the current request, e.g. "with span("encode", format=media_type):"."""
+    trace = _active.trace
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, trace.stack[-1].span_id, attributes)
+
+
+def traced(function, name=None):
+    """Wrap a function so that each call in a traced request gets a span, named after the function by default."""
+    name = name or function.__qualname__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        trace = _active.trace
+        if trace is None:
+            return function(*args, **kwargs)
+        with _Span(trace, name, trace.stack[-1].span_id, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def traced_methods(cls):
+    """Class decorator tracing every method but the dunder ones, as "<module>.<class>.<method>"."""
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith("__"):
+            setattr(cls, name, traced(value, f"{cls.__module__}.{cls.__qualname__}.{name}"))
+    return cls
+
+
+def current_trace_id():
+    """The trace id of the current request, or None if it isn't traced."""
+    trace = _active.trace
+    return trace.trace_id if trace is not None else None
+
+
+def install(flask_app):
+    flask_app.before_request(_start_request)
+    flask_app.after_request(_add_traceparent)
+    flask_app.teardown_request(_end_request)
+
+
+def parse_traceparent(header):
+    """(trace id, parent span id, sampled) from a traceparent header, or None if it isn't valid."""
+    match = _traceparent.fullmatch(header.strip()) if header else None
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def _start_request():
+    if not EXPORT:
+        return
+    parent = parse_traceparent(request.headers.get(TRACEPARENT))
+    if parent:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = _random_id(16), None, random.random() < SAMPLE_RATE
+    if not sampled:
+        return
+    _listen_for_sql()
+    trace = _Trace(trace_id)
+    route = request.url_rule.rule if request.url_rule else request.path
+    _Span(trace, f"{request.method} {route}", parent_id, {
+        "http.method": request.method,
+        "http.route": route,
+        "http.target": request.full_path.rstrip("?"),
+        "site": request.headers.get("site"),
+    }).__enter__()
+    _active.trace = trace
+
+
+def _add_traceparent(response):
+    trace = _active.trace
+    if trace is not None:
+        root = trace.stack[0]
+        root.set("http.status_code", response.status_code)
+        response.headers[TRACEPARENT] = f"00-{trace.trace_id}-{root.span_id}-01"
+    return response
+
+
+def _end_request(error):
+    trace = _active.trace
+    if trace is None:
+        return
+    _active.trace = None
+    while trace.stack:  # Just the request's span, unless a span was left open
+        trace.stack.pop().finish(error)
+    _exporter.submit(trace)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _active.trace
+    if trace is not None:
+        attributes = {"db.system": conn.dialect.name, "db.statement": statement}
+        conn.info.setdefault("tracing_spans", []).append(_Span(trace, "sql", trace.stack[-1].span_id, attributes))
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("tracing_spans")
+    if spans:
+        spans.pop().finish()
+
+
+def _handle_error(context):
+    spans = context.connection.info.get("tracing_spans") if context.connection is not None else None
+    if spans:
+        spans.pop().finish(context.original_exception)
+
+
+def _listen_for_sql():
+    """Only hook into SQL execution once the first request is traced."""
+    global _listening
+    with _listen_lock:
+        if not _listening:
+            event.listen(Engine, "before_cursor_execute", _before_execute)
+            event.listen(Engine, "after_cursor_execute", _after_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+            _listening = True
+
+
+def _random_id(size):
+    return random.getrandbits(size * 8).to_bytes(size, "big").hex()
+
+
+def to_otlp(traces):
+    """An OTLP/HTTP JSON export request for the traces."""
+    spans = []
+    for trace in traces:
+        for each_span in trace.spans:
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": each_span.span_id,
+                "name": each_span.name,
+                "kind": _kind(trace, each_span),
+                "startTimeUnixNano": str(each_span.start),
+                "endTimeUnixNano": str(each_span.end),
+                "attributes": [{"key": key, "value": _otlp_value(value)}
+                               for key, value in each_span.attributes.items() if value is not None],
+                "status": {"code": 2, "message": each_span.error} if each_span.error else {"code": 0},
+            }
+            if each_span.parent_id:
+                otlp_span["parentSpanId"] = each_span.parent_id
+            spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+    }]}
+
+
+def _kind(trace, each_span):
+    if each_span is trace.spans[-1]:  # The request's span, which finishes last
+        return 2  # Server
+    return 3 if "db.statement" in each_span.attributes else 1  # Client, internal
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    return {"stringValue": str(value)}
+
+
+class _Exporter:
+    """Exports traces from a background thread, started in each process that traces (server.py forks workers)."""
+    def __init__(self):
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, trace):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            metrics.increment("traces_dropped")
+
+    def flush(self):
+        """Wait until the traces submitted so far are exported."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def _start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(MAX_QUEUED)
+                threading.Thread(target=self._run, args=(self.queue,), name="trace-exporter", daemon=True).start()
+                if self.pid is None:
+                    atexit.register(self.flush)
+                self.pid = os.getpid()
+
+    def _run(self, traces):
+        while True:
+            batch = [traces.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(traces.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                _export(json.dumps(to_otlp(batch)).encode())
+            except Exception:
+                metrics.increment("trace_export_errors")
+            finally:
+                for _ in batch:
+                    traces.task_done()
+
+
+def _export(body):
+    if EXPORT.startswith(("http://", "https://")):
+        export_request = urllib.request.Request(EXPORT, data=body, method="POST",
+                                                headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(export_request, timeout=TIMEOUT_SECONDS):
+            pass
+    else:
+        with open(EXPORT, "ab") as trace_file:
+            trace_file.write(body + b"\n")
+
+
+_exporter = _Exporter()
+flush = _exporter.flush
@@ -4,30 +4,38 @@ from exceptions import (
     InitialAdminRoleException,
     UserAlreadyExistsException
 )
-from database import User, DBSession
+from database import User
 from loans import Loans
+from shards import session_for
+from tracing import traced_methods
 
 
 initial_admin = "admin"
 
 
 class UserManagement:
+    def __init__(self, site=None, read_only=False, replica=True):
+        self.site = site
+        self.read_only = read_only
+        self.replica = replica
+
     def __enter__(self):
-        self.db_session = DBSession()
-        return Users(self.db_session)
+        self.db_session = session_for(self.site, self.read_only, self.replica)
+        return Users(self.db_session, self.site)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.db_session.close()
 
 
+@traced_methods
 class Users:
 
     # Functions used outside of a user session
-    def __init__(self, db_session):
+    def __init__(self, db_session, site=None):
         self._storage = _Storage(db_session)
         self._current_user = None
         self._current_role = None
-        self.Loans = Loans(db_session)
+        self.Loans = Loans(db_session, site)
 
     def non_session_read(self, username):
         return self._storage.get(username)
@@ -126,6 +134,7 @@ class Users:
         return self.read(user_to_change)
 
 
+@traced_methods
 class _Storage:
     def __init__(self, db_session):
         self._db_session = db_session